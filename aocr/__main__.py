@@ -1,5 +1,4 @@
 # TODO: update the readme with new parameters
-# TODO: restoring a model without recreating it (use constants / op names in the code?)
 # TODO: move all the training parameters inside the training parser
 # TODO: switch to https://www.tensorflow.org/api_docs/python/tf/nn/dynamic_rnn instead of buckets
 
@@ -11,11 +10,20 @@ import logging
 
 import tensorflow as tf
 
-from .model.model import Model
+from .model.cnn import BACKBONES
+from .model.model import ARCHITECTURE_OPTIONS, HEADS, Model
 from .defaults import Config
 from .util import dataset
+from .util.archive import Archive, is_archive
+from .util.attention_dump import AttentionDump
+from .util.benchmark import MODEL_VARIANTS, input_throughput, model_throughput
 from .util.data_gen import DataGen
+from .util.evaluation import test_checkpoints, test_sharded
 from .util.export import Exporter
+from .util.pruning import (model_from_values, pruning_report, strip_pruned_filters,
+                           variable_values)
+from .util.stats import DatasetStats, find_stats, log_savings, recommend_shape
+from .util.teacher import Teacher
 
 tf.logging.set_verbosity(tf.logging.ERROR)
 
@@ -34,8 +42,32 @@ def process_args(args, defaults):
                              help=('log file path (default: %s)'
                                    % (defaults.LOG_PATH)))
 
+    # Input size and charmap arguments, shared by the model and dataset generation
+    parser_shape = argparse.ArgumentParser(add_help=False)
+    parser_shape.add_argument('--max-width', dest="max_width",
+                              metavar=defaults.MAX_WIDTH,
+                              type=int, default=defaults.MAX_WIDTH,
+                              help=('max image width (default: %s)'
+                                    % (defaults.MAX_WIDTH)))
+    parser_shape.add_argument('--max-height', dest="max_height",
+                              metavar=defaults.MAX_HEIGHT,
+                              type=int, default=defaults.MAX_HEIGHT,
+                              help=('max image height (default: %s)'
+                                    % (defaults.MAX_HEIGHT)))
+    parser_shape.add_argument('--color', dest="channels", action='store_const', const=3,
+                              default=defaults.CHANNELS,
+                              help=('do not convert source images to grayscale'))
+    parser_shape.add_argument('--max-prediction', dest="max_prediction",
+                              metavar=defaults.MAX_PREDICTION,
+                              type=int, default=defaults.MAX_PREDICTION,
+                              help=('max length of predicted strings (default: %s)'
+                                    % (defaults.MAX_PREDICTION)))
+    parser_shape.add_argument('--full-ascii', dest='full_ascii', action='store_true',
+                              help=('use lowercase in addition to uppercase'))
+    parser_shape.set_defaults(full_ascii=defaults.FULL_ASCII)
+
     # Dataset generation
-    parser_dataset = subparsers.add_parser('dataset', parents=[parser_base],
+    parser_dataset = subparsers.add_parser('dataset', parents=[parser_base, parser_shape],
                                            help='create a dataset in the TFRecords format')
     parser_dataset.set_defaults(phase='dataset')
     parser_dataset.add_argument('annotations_path', metavar='annotations',
@@ -56,32 +88,83 @@ def process_args(args, defaults):
     parser_dataset.add_argument('--save-filename', dest='save_filename',
                                 action='store_true', default=defaults.SAVE_FILENAME,
                                 help='save filename as a field in the dataset')
+    parser_dataset.add_argument('--workers', dest='workers',
+                                type=int, default=defaults.DATASET_WORKERS,
+                                metavar=defaults.DATASET_WORKERS,
+                                help=('number of processes writing shards in parallel'
+                                      ' (default: %s)' % defaults.DATASET_WORKERS))
+    parser_dataset.add_argument('--num-shards', dest='num_shards',
+                                type=int, default=defaults.NUM_SHARDS,
+                                metavar=defaults.NUM_SHARDS,
+                                help=('number of output shards (default: %s)'
+                                      % defaults.NUM_SHARDS))
+    parser_dataset.add_argument('--records-per-shard', dest='records_per_shard',
+                                type=int, default=defaults.RECORDS_PER_SHARD,
+                                metavar=defaults.RECORDS_PER_SHARD,
+                                help=('annotation lines per output shard, overrides --num-shards'
+                                      ' (default: %s)' % defaults.RECORDS_PER_SHARD))
+    parser_dataset.add_argument('--archive', dest='archive', metavar='path',
+                                type=str, default=None,
+                                help=('tar or zip archive holding the images; the paths in the'
+                                      ' annotation file then refer to its members'))
+    parser_dataset.add_argument('--record-format', dest='record_format',
+                                type=str, default=defaults.RECORD_FORMAT,
+                                choices=['tfrecords', 'indexed'],
+                                help=('format of the output: TFRecords, or an indexed data file'
+                                      ' with random access, read with a global shuffle'
+                                      ' (default: %s)' % defaults.RECORD_FORMAT))
+    parser_dataset.add_argument('--compression', dest='compression',
+                                type=str, default=defaults.COMPRESSION,
+                                choices=['none', 'gzip', 'zlib'],
+                                help=('compression of the output TFRecords, detected'
+                                      ' automatically when reading (default: %s)'
+                                      % defaults.COMPRESSION))
+    parser_dataset.add_argument('--append', dest='append', action='store_true',
+                                default=defaults.APPEND,
+                                help=('only add the samples missing from the dataset, as new'
+                                      ' shards recorded in <output>.manifest; also resumes an'
+                                      ' interrupted build'))
+    parser_dataset.add_argument('--manifest-key', dest='manifest_key',
+                                type=str, default=defaults.MANIFEST_KEY,
+                                choices=['path', 'hash'],
+                                help=('identify ingested samples by image path or by image'
+                                      ' content hash (default: %s)' % defaults.MANIFEST_KEY))
+    parser_dataset.add_argument('--dedup', dest='dedup', action='store_true',
+                                default=defaults.DEDUP,
+                                help=('leave out images whose content is identical to an'
+                                      ' earlier one'))
+    parser_dataset.add_argument('--dedup-policy', dest='dedup_policy',
+                                type=str, default=defaults.DEDUP_POLICY,
+                                choices=['first', 'drop', 'report'],
+                                help=('for duplicates with conflicting labels: keep the first'
+                                      ' occurrence, drop them all, or keep the first and write'
+                                      ' them to <output>.conflicts.txt (default: %s)'
+                                      % defaults.DEDUP_POLICY))
+    parser_dataset.add_argument('--dedup-memory-limit', dest='dedup_memory_limit',
+                                type=int, default=defaults.DEDUP_MEMORY_LIMIT,
+                                metavar=defaults.DEDUP_MEMORY_LIMIT,
+                                help=('hashes kept in memory before the index moves to disk'
+                                      ' (default: %s)' % defaults.DEDUP_MEMORY_LIMIT))
+    parser_dataset.add_argument('--validate', dest='validate', action='store_true',
+                                default=defaults.VALIDATE,
+                                help=('decode every image and check labels against the charmap'
+                                      ' and --max-prediction, skipping and reporting bad samples'))
+    parser_dataset.add_argument('--rejected-path', dest='rejected_path', type=str,
+                                metavar='<output>.rejected.txt',
+                                help=('report file for the lines rejected by --validate'))
+    parser_dataset.add_argument('--preprocess', dest='preprocess', action='store_true',
+                                default=defaults.PREPROCESS,
+                                help=('store decoded and resized images instead of the encoded'
+                                      ' ones; --max-width, --max-height and --color must match'
+                                      ' the training parameters'))
+    parser_dataset.add_argument('--keep-original', dest='keep_original', action='store_true',
+                                help=('with --preprocess, also store the encoded images to allow'
+                                      ' augmentation before the resize'))
 
     # Shared model arguments
-    parser_model = argparse.ArgumentParser(add_help=False)
+    parser_model = argparse.ArgumentParser(add_help=False, parents=[parser_shape])
     parser_model.set_defaults(visualize=defaults.VISUALIZE)
     parser_model.set_defaults(load_model=defaults.LOAD_MODEL)
-    parser_model.add_argument('--max-width', dest="max_width",
-                              metavar=defaults.MAX_WIDTH,
-                              type=int, default=defaults.MAX_WIDTH,
-                              help=('max image width (default: %s)'
-                                    % (defaults.MAX_WIDTH)))
-    parser_model.add_argument('--max-height', dest="max_height",
-                              metavar=defaults.MAX_HEIGHT,
-                              type=int, default=defaults.MAX_HEIGHT,
-                              help=('max image height (default: %s)'
-                                    % (defaults.MAX_HEIGHT)))
-    parser_model.add_argument('--max-prediction', dest="max_prediction",
-                              metavar=defaults.MAX_PREDICTION,
-                              type=int, default=defaults.MAX_PREDICTION,
-                              help=('max length of predicted strings (default: %s)'
-                                    % (defaults.MAX_PREDICTION)))
-    parser_model.add_argument('--full-ascii', dest='full_ascii', action='store_true',
-                              help=('use lowercase in addition to uppercase'))
-    parser_model.set_defaults(full_ascii=defaults.FULL_ASCII)
-    parser_model.add_argument('--color', dest="channels", action='store_const', const=3,
-                              default=defaults.CHANNELS,
-                              help=('do not convert source images to grayscale'))
     parser_model.add_argument('--no-distance', dest="use_distance", action="store_false",
                               default=defaults.USE_DISTANCE,
                               help=('require full match when calculating accuracy'))
@@ -90,6 +173,44 @@ def process_args(args, defaults):
                               help='specify a GPU ID')
     parser_model.add_argument('--use-gru', dest='use_gru', action='store_true',
                               help='use GRU instead of LSTM')
+    parser_model.add_argument('--fused-lstm', dest='fused_lstm', action='store_true',
+                              default=defaults.FUSED_LSTM,
+                              help=('use fused block LSTM kernels, with a time-major'
+                                    ' bidirectional encoder; checkpoints are compatible'
+                                    ' either way'))
+    parser_model.add_argument('--matmul-attention', dest='matmul_attention', action='store_true',
+                              default=defaults.MATMUL_ATTENTION,
+                              help=('compute the attention with batched matmuls over'
+                                    ' precomputed keys; same weights and results'))
+    parser_model.add_argument('--backbone', dest='backbone',
+                              type=str, default=defaults.BACKBONE, choices=BACKBONES,
+                              help=('CNN backbone: the VGG-style stack, or the same with depthwise'
+                                    ' separable convolutions; recorded with the checkpoints'
+                                    ' (default: %s)' % (defaults.BACKBONE)))
+    parser_model.add_argument('--width-multiplier', dest='width_multiplier',
+                              type=float, default=defaults.WIDTH_MULTIPLIER,
+                              metavar=defaults.WIDTH_MULTIPLIER,
+                              help=('scale the number of filters of the backbone; recorded with'
+                                    ' the checkpoints (default: %s)'
+                                    % (defaults.WIDTH_MULTIPLIER)))
+    parser_model.add_argument('--head', dest='head',
+                              type=str, default=defaults.HEAD, choices=HEADS,
+                              help=('output head: the attention decoder, or a CTC head that'
+                                    ' decodes all the positions at once; recorded with the'
+                                    ' checkpoints (default: %s)' % (defaults.HEAD)))
+    parser_model.add_argument('--ctc-beam-width', dest='ctc_beam_width',
+                              type=int, default=defaults.CTC_BEAM_WIDTH,
+                              metavar=defaults.CTC_BEAM_WIDTH,
+                              help=('decode the CTC head with a prefix beam search of this'
+                                    ' width rather than the best path (default: %s)'
+                                    % (defaults.CTC_BEAM_WIDTH)))
+    parser_model.add_argument('--attention-window', dest='attention_window',
+                              type=int, default=defaults.ATTENTION_WINDOW,
+                              metavar=defaults.ATTENTION_WINDOW,
+                              help=('only attend to this many encoder columns on each side of'
+                                    ' the previous focus, 0 to attend to all of them; works with'
+                                    ' existing checkpoints (default: %s)'
+                                    % (defaults.ATTENTION_WINDOW)))
     parser_model.add_argument('--attn-num-layers', dest="attn_num_layers",
                               type=int, default=defaults.ATTN_NUM_LAYERS,
                               metavar=defaults.ATTN_NUM_LAYERS,
@@ -129,14 +250,40 @@ def process_args(args, defaults):
                               help=('do not perform gradient clipping'))
     parser_model.set_defaults(clip_gradients=defaults.CLIP_GRADIENTS)
 
+    # Shared input pipeline arguments
+    parser_input = argparse.ArgumentParser(add_help=False)
+    parser_input.add_argument('--shuffle-buffer-size', dest="shuffle_buffer_size",
+                              type=int, default=defaults.SHUFFLE_BUFFER_SIZE,
+                              metavar=defaults.SHUFFLE_BUFFER_SIZE,
+                              help=('records in the shuffle buffer, 0 to disable shuffling'
+                                    ' (default: %s)' % (defaults.SHUFFLE_BUFFER_SIZE)))
+    parser_input.add_argument('--num-parallel-reads', dest="num_parallel_reads",
+                              type=int, default=defaults.NUM_PARALLEL_READS,
+                              metavar=defaults.NUM_PARALLEL_READS,
+                              help=('TFRecords shards read concurrently (default: %s)'
+                                    % (defaults.NUM_PARALLEL_READS)))
+    parser_input.add_argument('--num-parallel-calls', dest="num_parallel_calls",
+                              type=int, default=defaults.NUM_PARALLEL_CALLS,
+                              metavar=defaults.NUM_PARALLEL_CALLS,
+                              help=('record batches parsed concurrently (default: %s)'
+                                    % (defaults.NUM_PARALLEL_CALLS)))
+    parser_input.add_argument('--shape-from-stats', dest="shape_from_stats",
+                              type=float, nargs='?', const=defaults.STATS_COVERAGE,
+                              default=None, metavar='coverage',
+                              help=('set --max-width and --max-prediction from the statistics'
+                                    ' recorded by `aocr dataset`, so that the given fraction of'
+                                    ' the images fits the model input (default: %s)'
+                                    % (defaults.STATS_COVERAGE)))
+
     # Training
-    parser_train = subparsers.add_parser('train', parents=[parser_base, parser_model],
+    parser_train = subparsers.add_parser('train',
+                                         parents=[parser_base, parser_model, parser_input],
                                          help='Train the model and save checkpoints.')
     parser_train.set_defaults(phase='train')
-    parser_train.add_argument('dataset_path', metavar='dataset',
+    parser_train.add_argument('dataset_path', metavar='dataset', nargs='+',
                               type=str, default=defaults.DATA_PATH,
-                              help=('training dataset in the TFRecords format'
-                                    ' (default: %s)'
+                              help=('training dataset in the TFRecords format: one or more'
+                                    ' files or glob patterns (default: %s)'
                                     % (defaults.DATA_PATH)))
     parser_train.add_argument('--steps-per-checkpoint', dest="steps_per_checkpoint",
                               type=int, default=defaults.STEPS_PER_CHECKPOINT,
@@ -158,22 +305,123 @@ def process_args(args, defaults):
                               type=int, default=defaults.DATA_AUGMENTATION_PROB,
                               help=('probability of applying data augmentation functions to each sample (default: %s)'
                                     % (defaults.DATA_AUGMENTATION_PROB)))
+    parser_train.add_argument('--augment-preprocessed', dest="augment_preprocessed",
+                              type=str, default=defaults.AUGMENT_PREPROCESSED,
+                              choices=['after', 'before'],
+                              help=('augment preprocessed records after the cached resize or'
+                                    ' before it, from the original image (default: %s)'
+                                    % (defaults.AUGMENT_PREPROCESSED)))
     parser_train.add_argument('--no-resume', dest='load_model', action='store_false',
                               help=('create a new model even if checkpoints already exist'))
+    parser_train.add_argument('--teacher-model-dir', dest='teacher_model_dir', metavar='dir',
+                              type=str, default=None,
+                              help=('distill the model in this directory: train on its soft'
+                                    ' targets in addition to the labels'))
+    parser_train.add_argument('--distillation-weight', dest='distillation_weight',
+                              type=float, default=defaults.DISTILLATION_WEIGHT,
+                              metavar=defaults.DISTILLATION_WEIGHT,
+                              help=('weight of the distillation loss, the loss on the labels'
+                                    ' getting the rest (default: %s)'
+                                    % (defaults.DISTILLATION_WEIGHT)))
+    parser_train.add_argument('--distillation-temperature', dest='distillation_temperature',
+                              type=float, default=defaults.DISTILLATION_TEMPERATURE,
+                              metavar=defaults.DISTILLATION_TEMPERATURE,
+                              help=('softmax temperature of the soft targets (default: %s)'
+                                    % (defaults.DISTILLATION_TEMPERATURE)))
+    parser_train.add_argument('--teacher-cache', dest='teacher_cache',
+                              type=int, nargs='?', const=defaults.TEACHER_CACHE_SIZE,
+                              default=0, metavar='entries',
+                              help=('keep the soft targets of up to this many samples in'
+                                    ' memory, and only run the teacher on new samples;'
+                                    ' requires --data-augmentation-prob=0 (default without'
+                                    ' a value: %s)' % (defaults.TEACHER_CACHE_SIZE)))
+    parser_train.add_argument('--prune-sparsity', dest='prune_sparsity',
+                              type=float, default=defaults.PRUNE_SPARSITY,
+                              metavar=defaults.PRUNE_SPARSITY,
+                              help=('fraction of the weights to prune gradually, 0 to train'
+                                    ' without pruning (default: %s)'
+                                    % (defaults.PRUNE_SPARSITY)))
+    parser_train.add_argument('--prune-steps', dest='prune_steps',
+                              type=int, default=defaults.PRUNE_STEPS,
+                              metavar=defaults.PRUNE_STEPS,
+                              help=('steps over which the sparsity rises to --prune-sparsity'
+                                    ' (default: %s)' % (defaults.PRUNE_STEPS)))
+    parser_train.add_argument('--prune-frequency', dest='prune_frequency',
+                              type=int, default=defaults.PRUNE_FREQUENCY,
+                              metavar=defaults.PRUNE_FREQUENCY,
+                              help=('steps between updates of the pruned weights'
+                                    ' (default: %s)' % (defaults.PRUNE_FREQUENCY)))
 
     # Testing
-    parser_test = subparsers.add_parser('test', parents=[parser_base, parser_model],
+    parser_test = subparsers.add_parser('test',
+                                        parents=[parser_base, parser_model, parser_input],
                                         help='Test the saved model.')
-    parser_test.set_defaults(phase='test', steps_per_checkpoint=0, batch_size=1,
+    parser_test.set_defaults(phase='test', steps_per_checkpoint=0,
                              max_width=defaults.MAX_WIDTH, max_height=defaults.MAX_HEIGHT,
                              max_prediction=defaults.MAX_PREDICTION, full_ascii=defaults.FULL_ASCII)
-    parser_test.add_argument('dataset_path', metavar='dataset',
+    parser_test.add_argument('dataset_path', metavar='dataset', nargs='+',
                              type=str, default=defaults.DATA_PATH,
-                             help=('Testing dataset in the TFRecords format'
-                                   ', default=%s'
+                             help=('Testing dataset in the TFRecords format: one or more'
+                                   ' files or glob patterns, default=%s'
                                    % (defaults.DATA_PATH)))
     parser_test.add_argument('--visualize', dest='visualize', action='store_true',
                              help=('visualize attentions'))
+    parser_test.add_argument('--visualize-mistakes', dest='visualize_mistakes',
+                             action='store_true',
+                             help=('only visualize the samples that are not predicted correctly'))
+    parser_test.add_argument('--visualize-lowest', dest='visualize_lowest', metavar='n',
+                             type=int, default=0,
+                             help=('only visualize the n samples with the lowest probability'))
+    parser_test.add_argument('--visualize-workers', dest='visualize_workers',
+                             type=int, default=defaults.VISUALIZE_WORKERS,
+                             metavar=defaults.VISUALIZE_WORKERS,
+                             help=('processes rendering the visualizations in the background'
+                                   ' (default: %s)' % (defaults.VISUALIZE_WORKERS)))
+    parser_test.add_argument('--attention-dump', dest='attention_dump', metavar='dir',
+                             type=str, default=None,
+                             help=('write the attentions, inputs, predictions and probabilities'
+                                   ' of all the samples to this directory, for render-attention'
+                                   ' or offline analysis'))
+    parser_test.add_argument('--dump-chunk-size', dest='dump_chunk_size',
+                             type=int, default=defaults.DUMP_CHUNK_SIZE,
+                             metavar=defaults.DUMP_CHUNK_SIZE,
+                             help=('samples per file of --attention-dump (default: %s)'
+                                   % (defaults.DUMP_CHUNK_SIZE)))
+    parser_test.add_argument('--batch-size', dest="batch_size",
+                             type=int, default=defaults.BATCH_SIZE,
+                             metavar=defaults.BATCH_SIZE,
+                             help=('number of samples evaluated at once (default: %s)'
+                                   % (defaults.BATCH_SIZE)))
+    parser_test.add_argument('--log-step', dest='log_step',
+                             type=int, default=defaults.LOG_STEP,
+                             metavar=defaults.LOG_STEP,
+                             help=('log the metrics every this many samples (default: %s)'
+                                   % (defaults.LOG_STEP)))
+    parser_test.add_argument('--workers', dest='workers',
+                             type=int, default=defaults.TEST_WORKERS,
+                             metavar=defaults.TEST_WORKERS,
+                             help=('processes evaluating parts of the dataset in parallel,'
+                                   ' each with its own session (default: %s)'
+                                   % (defaults.TEST_WORKERS)))
+    parser_test.add_argument('--rebuild-model', dest='import_graph', action='store_false',
+                             help=('build the model from the code instead of importing the'
+                                   ' inference graph written with the checkpoints'))
+    parser_test.add_argument('--all-checkpoints', dest='all_checkpoints', action='store_true',
+                             help=('evaluate every checkpoint of the model directory, with'
+                                   ' --workers processes, and write a summary table'))
+    parser_test.add_argument('--summary-path', dest='summary_path', metavar='path',
+                             type=str, default=None,
+                             help=('summary table of --all-checkpoints'
+                                   ' (default: <model-dir>/evaluation.tsv)'))
+    parser_test.add_argument('--export-best', dest='export_best', metavar='dir',
+                             type=str, default=None,
+                             help=('export the best checkpoint of --all-checkpoints'
+                                   ' to this directory'))
+    parser_test.add_argument('--export-format', dest='export_format',
+                             type=str, default=defaults.EXPORT_FORMAT,
+                             choices=['frozengraph', 'savedmodel'],
+                             help=('format of --export-best (default: %s)'
+                                   % (defaults.EXPORT_FORMAT)))
 
     # Exporting
     parser_export = subparsers.add_parser('export', parents=[parser_base, parser_model],
@@ -190,16 +438,140 @@ def process_args(args, defaults):
                                help=('export format'
                                      ' (default: %s)'
                                      % (defaults.EXPORT_FORMAT)))
+    parser_export.add_argument('--strip-pruned', dest='strip_pruned', action='store_true',
+                               help=('remove the backbone filters whose weights were all'
+                                     ' pruned from the exported model'))
 
     # Predicting
     parser_predict = subparsers.add_parser('predict', parents=[parser_base, parser_model],
                                            help='Predict text from files (feed through stdin).')
     parser_predict.set_defaults(phase='predict', steps_per_checkpoint=0, batch_size=1)
+    parser_predict.add_argument('--rebuild-model', dest='import_graph', action='store_false',
+                                help=('build the model from the code instead of importing the'
+                                      ' inference graph written with the checkpoints'))
+    parser_predict.add_argument('--archive', dest='archive', metavar='path',
+                                type=str, default=None,
+                                help=('predict every image of a tar or zip archive instead of'
+                                      ' the files fed through stdin'))
+
+    # Attention dump rendering
+    parser_render = subparsers.add_parser(
+        'render-attention', parents=[parser_base],
+        help='Render the attention of samples of a dump written by test --attention-dump.')
+    parser_render.set_defaults(phase='render-attention', full_ascii=defaults.FULL_ASCII)
+    parser_render.add_argument('dump_path', metavar='dump',
+                               type=str, help=('attention dump directory'))
+    parser_render.add_argument('output_dir', nargs='?', metavar='dir',
+                               type=str, default=defaults.OUTPUT_DIR,
+                               help=('directory to render the images to (default: %s)'
+                                     % (defaults.OUTPUT_DIR)))
+    parser_render.add_argument('--samples', dest='samples', metavar='i',
+                               type=int, nargs='+', default=None,
+                               help=('indexes of the samples to render (default: all)'))
+    parser_render.add_argument('--mistakes', dest='mistakes', action='store_true',
+                               help=('only render the samples that are not predicted correctly'))
+    parser_render.add_argument('--lowest', dest='lowest', metavar='n',
+                               type=int, default=0,
+                               help=('only render the n samples with the lowest probability'))
+    parser_render.add_argument('--threshold', dest='threshold',
+                               type=float, default=0.5, metavar=0.5,
+                               help=('hide attention weights below this fraction of the'
+                                     ' strongest one of each step (default: 0.5)'))
+
+    # Input pipeline benchmark
+    parser_benchmark_input = subparsers.add_parser(
+        'benchmark-input', parents=[parser_base, parser_shape, parser_input],
+        help='Measure the training input throughput of a dataset.')
+    parser_benchmark_input.set_defaults(phase='benchmark-input')
+    parser_benchmark_input.add_argument('dataset_path', metavar='dataset', nargs='+',
+                                        type=str, default=defaults.DATA_PATH,
+                                        help=('dataset in the TFRecords format: one or more'
+                                              ' files or glob patterns (default: %s)'
+                                              % (defaults.DATA_PATH)))
+    parser_benchmark_input.add_argument('--batch-size', dest="batch_size",
+                                        type=int, default=defaults.BATCH_SIZE,
+                                        metavar=defaults.BATCH_SIZE,
+                                        help=('batch size (default: %s)'
+                                              % (defaults.BATCH_SIZE)))
+    parser_benchmark_input.add_argument('--num-batches', dest="num_batches",
+                                        type=int, default=0, metavar=0,
+                                        help=('number of batches to read, 0 for the whole'
+                                              ' dataset (default: 0)'))
+
+    # Model benchmark
+    parser_benchmark_model = subparsers.add_parser(
+        'benchmark-model', parents=[parser_base, parser_model],
+        help='Measure the training and inference step times of the model on synthetic data.')
+    parser_benchmark_model.set_defaults(phase='benchmark-model', steps_per_checkpoint=0)
+    parser_benchmark_model.add_argument('--batch-size', dest="batch_size",
+                                        type=int, default=defaults.BATCH_SIZE,
+                                        metavar=defaults.BATCH_SIZE,
+                                        help=('batch size (default: %s)'
+                                              % (defaults.BATCH_SIZE)))
+    parser_benchmark_model.add_argument('--num-steps', dest="num_steps",
+                                        type=int, default=20, metavar=20,
+                                        help=('timed steps per configuration (default: 20)'))
+    parser_benchmark_model.add_argument('--compare', dest="variants", nargs='+',
+                                        default=[], choices=sorted(MODEL_VARIANTS),
+                                        help=('model variants to compare to the given'
+                                              ' model options'))
+    parser_benchmark_model.add_argument('--widths', dest="widths", nargs='+',
+                                        type=int, default=None, metavar='width',
+                                        help=('run every configuration for each of these'
+                                              ' maximum image widths (default: --max-width)'))
+
+    # Pruning report
+    parser_prune_report = subparsers.add_parser(
+        'prune-report', parents=[parser_base, parser_model, parser_input],
+        help=('Compare the size, CPU inference time and accuracy of a pruned model to the'
+              ' model it was pruned from.'))
+    parser_prune_report.set_defaults(phase='prune-report', steps_per_checkpoint=0)
+    parser_prune_report.add_argument('dataset_path', metavar='dataset', nargs='+',
+                                     type=str, default=defaults.DATA_PATH,
+                                     help=('testing dataset in the TFRecords format: one or'
+                                           ' more files or glob patterns (default: %s)'
+                                           % (defaults.DATA_PATH)))
+    parser_prune_report.add_argument('--baseline-model-dir', dest='baseline_model_dir',
+                                     metavar='dir', type=str, required=True,
+                                     help=('directory of the model that was pruned'))
+    parser_prune_report.add_argument('--batch-size', dest="batch_size",
+                                     type=int, default=defaults.BATCH_SIZE,
+                                     metavar=defaults.BATCH_SIZE,
+                                     help=('batch size (default: %s)'
+                                           % (defaults.BATCH_SIZE)))
+    parser_prune_report.add_argument('--num-steps', dest="num_steps",
+                                     type=int, default=20, metavar=20,
+                                     help=('timed inference steps per model (default: 20)'))
 
     parameters = parser.parse_args(args)
+    if getattr(parameters, 'archive', None) and not is_archive(parameters.archive):
+        parser.error('--archive: {} is not a tar or zip archive.'.format(parameters.archive))
+    if getattr(parameters, 'teacher_cache', 0) and parameters.augment_data_prob > 0:
+        parser.error('--teacher-cache: the soft targets of augmented samples cannot be'
+                     ' cached, set --data-augmentation-prob=0.')
     return parameters
 
 
+def apply_stats_shape(parameters):
+    """Size the model to the dataset statistics, see `--shape-from-stats`."""
+    path = find_stats(parameters.dataset_path)
+    if path is None:
+        logging.warning('No dataset statistics found for %s, keeping the model shape.',
+                        ' '.join(parameters.dataset_path))
+        return
+
+    stats = DatasetStats.load(path)
+    max_width, max_prediction = recommend_shape(stats, parameters.shape_from_stats,
+                                                parameters.max_height)
+    logging.info('Sizing the model from %s (%i samples, %.1f%% coverage): max_width %i -> %i,'
+                 ' max_prediction %i -> %i.', path, len(stats), 100. * parameters.shape_from_stats,
+                 parameters.max_width, max_width, parameters.max_prediction, max_prediction)
+    log_savings((parameters.max_width, parameters.max_height, parameters.max_prediction),
+                (max_width, parameters.max_height, max_prediction))
+    parameters.max_width = max_width
+    parameters.max_prediction = max_prediction
+
+
 def main(args=None):
 
     if args is None:
@@ -216,22 +588,70 @@ def main(args=None):
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
 
+    if parameters.phase == 'render-attention':
+        dump = AttentionDump(parameters.dump_path)
+        samples = parameters.samples
+        if samples is None:
+            samples = dump.select(mistakes=parameters.mistakes, lowest=parameters.lowest)
+        logging.info('Rendering %i of %i samples to %s.', len(samples), len(dump),
+                     parameters.output_dir)
+        dump.render(parameters.output_dir, samples, threshold=parameters.threshold)
+        return
+
     with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
 
+        if parameters.full_ascii:
+            DataGen.set_full_ascii_charmap()
+
         if parameters.phase == 'dataset':
             dataset.generate(
                 parameters.annotations_path,
                 parameters.output_path,
                 parameters.log_step,
                 parameters.force_uppercase,
-                parameters.save_filename
+                parameters.save_filename,
+                preprocess=parameters.preprocess,
+                max_width=parameters.max_width,
+                max_height=parameters.max_height,
+                channels=parameters.channels,
+                keep_original=parameters.keep_original,
+                workers=parameters.workers,
+                num_shards=parameters.num_shards,
+                records_per_shard=parameters.records_per_shard,
+                validate=parameters.validate,
+                max_prediction=parameters.max_prediction,
+                charmap=DataGen.CHARMAP,
+                rejected_path=parameters.rejected_path,
+                append=parameters.append,
+                manifest_key=parameters.manifest_key,
+                compression=parameters.compression,
+                dedup=parameters.dedup,
+                dedup_policy=parameters.dedup_policy,
+                dedup_memory_limit=parameters.dedup_memory_limit,
+                record_format=parameters.record_format,
+                archive=parameters.archive
             )
             return
 
-        if parameters.full_ascii:
-            DataGen.set_full_ascii_charmap()
+        if getattr(parameters, 'shape_from_stats', None):
+            apply_stats_shape(parameters)
 
-        model = Model(
+        if parameters.phase == 'benchmark-input':
+            input_throughput(
+                parameters.dataset_path,
+                parameters.batch_size,
+                num_batches=parameters.num_batches,
+                max_width=parameters.max_width,
+                max_height=parameters.max_height,
+                max_prediction=parameters.max_prediction,
+                channels=parameters.channels,
+                shuffle_buffer_size=parameters.shuffle_buffer_size,
+                num_parallel_reads=parameters.num_parallel_reads,
+                num_parallel_calls=parameters.num_parallel_calls
+            )
+            return
+
+        model_params = dict(
             phase=parameters.phase,
             visualize=parameters.visualize,
             output_dir=parameters.output_dir,
@@ -244,7 +664,6 @@ def main(args=None):
             attn_num_layers=parameters.attn_num_layers,
             clip_gradients=parameters.clip_gradients,
             max_gradient_norm=parameters.max_gradient_norm,
-            session=sess,
             load_model=parameters.load_model,
             gpu_id=parameters.gpu_id,
             use_gru=parameters.use_gru,
@@ -253,18 +672,106 @@ def main(args=None):
             max_image_height=parameters.max_height,
             max_prediction_length=parameters.max_prediction,
             channels=parameters.channels,
+            fused_lstm=parameters.fused_lstm,
+            matmul_attention=parameters.matmul_attention,
+            attention_window=parameters.attention_window,
+            backbone=parameters.backbone,
+            width_multiplier=parameters.width_multiplier,
+            head=parameters.head,
+            ctc_beam_width=parameters.ctc_beam_width,
+            charmap=list(DataGen.CHARMAP),
+            import_graph=getattr(parameters, 'import_graph', True),
         )
 
-        if parameters.phase == 'train':
-            model.train(
+        if parameters.phase in ('test', 'predict', 'export') and \
+                tf.train.get_checkpoint_state(parameters.model_dir):
+            # Build the model that was trained, whatever the options given.
+            model_params.update(Model.resolve_architecture(
+                parameters.model_dir,
+                dict((key, model_params[key]) for key in ARCHITECTURE_OPTIONS),
+                restore=True, record=False))
+
+        if parameters.phase == 'benchmark-model':
+            model_throughput(model_params, parameters.variants,
+                             batch_size=parameters.batch_size, num_steps=parameters.num_steps,
+                             widths=parameters.widths)
+            return
+
+        if parameters.phase == 'prune-report':
+            pruning_report(model_params, parameters.dataset_path,
+                           parameters.baseline_model_dir,
+                           batch_size=parameters.batch_size, num_steps=parameters.num_steps,
+                           test_params=dict(
+                               shuffle_buffer_size=parameters.shuffle_buffer_size,
+                               num_parallel_reads=parameters.num_parallel_reads,
+                               num_parallel_calls=parameters.num_parallel_calls))
+            return
+
+        if parameters.phase == 'test':
+            test_params = dict(
                 data_path=parameters.dataset_path,
-                num_epoch=parameters.num_epoch,
-                augment_data_prob=parameters.augment_data_prob
-            )
-        elif parameters.phase == 'test':
-            model.test(
-                data_path=parameters.dataset_path
+                shuffle_buffer_size=parameters.shuffle_buffer_size,
+                num_parallel_reads=parameters.num_parallel_reads,
+                num_parallel_calls=parameters.num_parallel_calls,
+                log_step=parameters.log_step,
+                visualize_mistakes=parameters.visualize_mistakes,
+                visualize_lowest=parameters.visualize_lowest,
+                visualize_workers=parameters.visualize_workers,
+                attention_dump=parameters.attention_dump,
+                dump_chunk_size=parameters.dump_chunk_size
             )
+            if parameters.all_checkpoints:
+                if parameters.attention_dump:
+                    logging.warning('--attention-dump is ignored with --all-checkpoints.')
+                test_checkpoints(model_params, test_params, parameters.workers,
+                                 full_ascii=parameters.full_ascii,
+                                 summary_path=parameters.summary_path,
+                                 export_path=parameters.export_best,
+                                 export_format=parameters.export_format)
+            elif parameters.workers > 1:
+                test_sharded(model_params, test_params, parameters.workers,
+                             full_ascii=parameters.full_ascii)
+            else:
+                Model(session=sess, **model_params).test(**test_params)
+            return
+
+        if parameters.phase == 'train':
+            teacher = None
+            if parameters.teacher_model_dir:
+                teacher = Teacher(model_params, parameters.teacher_model_dir,
+                                  temperature=parameters.distillation_temperature,
+                                  cache_size=parameters.teacher_cache)
+                model_params.update(distillation_weight=parameters.distillation_weight,
+                                    distillation_temperature=parameters.distillation_temperature)
+            model_params.update(prune_sparsity=parameters.prune_sparsity,
+                                prune_steps=parameters.prune_steps,
+                                prune_frequency=parameters.prune_frequency)
+            try:
+                model = Model(session=sess, **model_params)
+                Model.write_inference_graph(model_params, model.architecture)
+                model.train(
+                    data_path=parameters.dataset_path,
+                    num_epoch=parameters.num_epoch,
+                    augment_data_prob=parameters.augment_data_prob,
+                    shuffle_buffer_size=parameters.shuffle_buffer_size,
+                    num_parallel_reads=parameters.num_parallel_reads,
+                    num_parallel_calls=parameters.num_parallel_calls,
+                    augment_preprocessed=parameters.augment_preprocessed,
+                    teacher=teacher
+                )
+            finally:
+                if teacher is not None:
+                    teacher.close()
+            return
+
+        model = Model(session=sess, **model_params)
+
+        if parameters.phase == 'predict' and parameters.archive:
+            archive = Archive(parameters.archive)
+            for name, img_file_data in archive.members():
+                text, probability = model.predict(img_file_data)
+                logging.info('Result: OK. %s %s %s', name, '{:.2f}'.format(probability), text)
+            archive.close()
         elif parameters.phase == 'predict':
             for line in sys.stdin:
                 filename = line.rstrip()
@@ -277,6 +784,14 @@ def main(args=None):
                 text, probability = model.predict(img_file_data)
                 logging.info('Result: OK. %s %s', '{:.2f}'.format(probability), text)
         elif parameters.phase == 'export':
+            if parameters.strip_pruned:
+                filters, values = strip_pruned_filters(variable_values(sess))
+                with tf.Graph().as_default(), \
+                        tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as strip_sess:
+                    stripped = model_from_values(strip_sess, model_params, values,
+                                                 model.architecture, filters=filters)
+                    Exporter(stripped).save(parameters.export_path, parameters.format)
+                return
             exporter = Exporter(model)
             exporter.save(parameters.export_path, parameters.format)
             return
@@ -36,6 +36,13 @@ class Config(object):
     ATTN_NUM_HIDDEN = 128  # number of hidden units in attention decoder cell
     ATTN_NUM_LAYERS = 2  # number of layers in attention decoder cell
     # (Encoder number of hidden units will be ATTN_NUM_HIDDEN*ATTN_NUM_LAYERS)
+    FUSED_LSTM = False  # whether to use the fused block LSTM kernels
+    MATMUL_ATTENTION = False  # whether to compute the attention with batched matmuls
+    ATTENTION_WINDOW = 0  # encoder columns attended to on each side of the focus, 0 for all
+    BACKBONE = 'vgg'  # CNN backbone: 'vgg' or 'separable'
+    WIDTH_MULTIPLIER = 1.0  # scale of the number of filters of the backbone
+    HEAD = 'attention'  # output head: 'attention' or 'ctc'
+    CTC_BEAM_WIDTH = 0  # width of the CTC prefix beam search, 0 for the best path
     LOAD_MODEL = True
     OLD_MODEL_VERSION = False
     TARGET_VOCAB_SIZE = 26+10+3  # 0: PADDING, 1: GO, 2: EOS, >2: 0-9, a-z
@@ -48,5 +55,39 @@ class Config(object):
 
     USE_DISTANCE = True
 
+    # Distillation
+    DISTILLATION_WEIGHT = 0.5
+    DISTILLATION_TEMPERATURE = 2.0
+    TEACHER_CACHE_SIZE = 100000
+
+    # Pruning
+    PRUNE_SPARSITY = 0.0
+    PRUNE_STEPS = 10000
+    PRUNE_FREQUENCY = 100
+
+    # Input pipeline
+    SHUFFLE_BUFFER_SIZE = 10000
+    NUM_PARALLEL_READS = 4
+    NUM_PARALLEL_CALLS = 4
+    AUGMENT_PREPROCESSED = 'after'
+    STATS_COVERAGE = 0.999
+
+    # Testing
+    TEST_WORKERS = 1
+    VISUALIZE_WORKERS = 2
+    DUMP_CHUNK_SIZE = 4096
+
     # Dataset generation
     LOG_STEP = 500
+    PREPROCESS = False
+    DATASET_WORKERS = 1
+    NUM_SHARDS = 1
+    RECORDS_PER_SHARD = 0
+    VALIDATE = False
+    APPEND = False
+    MANIFEST_KEY = 'path'
+    RECORD_FORMAT = 'tfrecords'
+    COMPRESSION = 'none'
+    DEDUP = False
+    DEDUP_POLICY = 'first'
+    DEDUP_MEMORY_LIMIT = 5000000
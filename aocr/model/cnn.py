@@ -101,6 +101,66 @@ def ConvReluBN(incoming, num_filters, filter_size, name, is_training):
         return tf.nn.relu(after_bn)
 
 
+def SeparableConvRelu(incoming, num_filters, filter_size, name):
+    '''
+    Add a depthwise separable convolution layer (a depthwise convolution
+    followed by a 1x1 convolution) followed by a Relu layer.
+    :param incoming:
+    :param num_filters:
+    :param filter_size:
+    :param name:
+    :return:
+    '''
+    num_filters_from = incoming.get_shape().as_list()[3]
+    with tf.variable_scope(name):
+        depthwise_W = var_random(
+            'W_depthwise',
+            tuple(filter_size) + (num_filters_from, 1),
+            regularizable=True
+        )
+        pointwise_W = var_random(
+            'W_pointwise',
+            (1, 1, num_filters_from, num_filters),
+            regularizable=True
+        )
+
+        after_conv = tf.nn.separable_conv2d(incoming, depthwise_W, pointwise_W,
+                                            strides=(1, 1, 1, 1), padding='SAME')
+
+        return tf.nn.relu(after_conv)
+
+
+def SeparableConvReluBN(incoming, num_filters, filter_size, name, is_training):
+    '''
+    Depthwise separable convolution -> Batch normalization -> Relu
+    :param incoming:
+    :param num_filters:
+    :param filter_size:
+    :param name:
+    :param is_training:
+    :return:
+    '''
+    num_filters_from = incoming.get_shape().as_list()[3]
+    with tf.variable_scope(name):
+        depthwise_W = var_random(
+            'W_depthwise',
+            tuple(filter_size) + (num_filters_from, 1),
+            regularizable=True
+        )
+        pointwise_W = var_random(
+            'W_pointwise',
+            (1, 1, num_filters_from, num_filters),
+            regularizable=True
+        )
+
+        after_conv = tf.nn.separable_conv2d(incoming, depthwise_W, pointwise_W,
+                                            strides=(1, 1, 1, 1), padding='SAME')
+
+        after_bn = batch_norm(after_conv, is_training)
+
+        return tf.nn.relu(after_bn)
+
+
 def dropout(incoming, is_training, keep_prob=0.5):
     return tf.contrib.layers.dropout(incoming, keep_prob=keep_prob, is_training=is_training)
 
@@ -115,39 +175,74 @@ def tf_create_attention_map(incoming):
     return tf.reshape(incoming, (-1, np.prod(shape[1:3]), shape[3]))
 
 
+BACKBONES = ('vgg', 'separable')
+
+# Layers without batch normalization, whose output channels can be removed
+# when all their weights are zero, and the layers that read these channels.
+STRIPPABLE_LAYERS = {
+    'conv_conv1': 'conv_conv2',
+    'conv_conv2': 'conv_conv3',
+    'conv_conv4': 'conv_conv5',
+    'conv_conv6': 'conv_conv7',
+}
+
+
 class CNN(object):
     """
     Usage for tf tensor output:
     o = CNN(x).tf_output()
 
+    The backbone is either the VGG-style stack of the CRNN model (`vgg`), or
+    the same stack with depthwise separable convolutions after the first
+    layer (`separable`). `width_multiplier` scales the number of filters of
+    every layer, and `filters` can set that of given layers, by name.
     """
 
-    def __init__(self, input_tensor, is_training):
+    def __init__(self, input_tensor, is_training, backbone='vgg', width_multiplier=1.0,
+                 filters=None):
+        if backbone not in BACKBONES:
+            raise ValueError('Unknown backbone: {}.'.format(backbone))
+        self.backbone = backbone
+        self.width_multiplier = width_multiplier
+        self.filters = filters or {}
         self._build_network(input_tensor, is_training)
 
+    def _filters(self, num_filters, name):
+        if name in self.filters:
+            return self.filters[name]
+        return max(8, int(round(num_filters * self.width_multiplier)))
+
     def _build_network(self, input_tensor, is_training):
         """
         https://github.com/bgshih/crnn/blob/master/model/crnn_demo/config.lua
         :return:
         """
+        # The first layer sees a single channel (or three), where a depthwise
+        # separable convolution would save next to nothing.
+        if self.backbone == 'separable':
+            conv_relu, conv_relu_bn = SeparableConvRelu, SeparableConvReluBN
+        else:
+            conv_relu, conv_relu_bn = ConvRelu, ConvReluBN
+        f = self._filters
+
         net = tf.add(input_tensor, (-128.0))
         net = tf.multiply(net, (1/128.0))
 
-        net = ConvRelu(net, 64, (3, 3), 'conv_conv1')
+        net = ConvRelu(net, f(64, 'conv_conv1'), (3, 3), 'conv_conv1')
         net = max_2x2pool(net, 'conv_pool1')
 
-        net = ConvRelu(net, 128, (3, 3), 'conv_conv2')
+        net = conv_relu(net, f(128, 'conv_conv2'), (3, 3), 'conv_conv2')
         net = max_2x2pool(net, 'conv_pool2')
 
-        net = ConvReluBN(net, 256, (3, 3), 'conv_conv3', is_training)
-        net = ConvRelu(net, 256, (3, 3), 'conv_conv4')
+        net = conv_relu_bn(net, f(256, 'conv_conv3'), (3, 3), 'conv_conv3', is_training)
+        net = conv_relu(net, f(256, 'conv_conv4'), (3, 3), 'conv_conv4')
         net = max_2x1pool(net, 'conv_pool3')
 
-        net = ConvReluBN(net, 512, (3, 3), 'conv_conv5', is_training)
-        net = ConvRelu(net, 512, (3, 3), 'conv_conv6')
+        net = conv_relu_bn(net, f(512, 'conv_conv5'), (3, 3), 'conv_conv5', is_training)
+        net = conv_relu(net, f(512, 'conv_conv6'), (3, 3), 'conv_conv6')
         net = max_2x1pool(net, 'conv_pool4')
 
-        net = ConvReluBN(net, 512, (2, 2), 'conv_conv7', is_training)
+        net = conv_relu_bn(net, f(512, 'conv_conv7'), (2, 2), 'conv_conv7', is_training)
         net = max_2x1pool(net, 'conv_pool5')
         net = dropout(net, is_training)
 
@@ -0,0 +1,81 @@
+"""Recognition head trained with the CTC loss on the encoder outputs."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import tensorflow as tf
+
+from .metrics import sparse_ids
+from .seq2seq_model import bidirectional_encoder
+
+
+class CTCModel(object):
+    """Bidirectional LSTM encoder followed by a per-position projection on the
+    characters and a blank, trained with the CTC loss.
+
+    Unlike the attention decoder, which runs `decoder_size` dependent steps,
+    every position is classified at once, and the output sequence is decoded
+    from all the positions together, by merging the repeated labels and
+    dropping the blanks of the best path, or with a prefix beam search.
+
+    The labels are taken from the same decoder inputs as the attention
+    decoder: the characters between the GO and EOS ids.
+
+    :param encoder_masks: list of ``[batch, 1]`` masks of the encoder positions
+    :param encoder_inputs_tensor: ``[time, batch, depth]`` CNN features
+    :param decoder_inputs: list of ``[batch]`` decoder inputs holding the labels
+    :param num_symbols: size of the vocabulary, not counting the blank
+    :param eos_id: end of sequence id; ids up to it are not characters
+    :param encoder_size: number of encoder positions
+    :param num_hidden: number of units of each direction of the encoder
+    :param fused_lstm: use the fused LSTM kernels in the encoder
+    :param beam_width: width of the prefix beam search, or 0 for the best path
+    """
+
+    def __init__(self, encoder_masks, encoder_inputs_tensor, decoder_inputs, num_symbols,
+                 eos_id, encoder_size, num_hidden, fused_lstm=False, beam_width=0):
+        self.num_classes = num_symbols + 1
+        self.blank_id = num_symbols
+
+        with tf.variable_scope('ctc'):
+            inputs = tf.unstack(encoder_inputs_tensor, num=encoder_size)
+            outputs, _, _ = bidirectional_encoder(inputs, num_hidden, fused_lstm)
+            outputs = tf.stack(outputs)
+
+            weights = tf.get_variable('W', [2 * num_hidden, self.num_classes])
+            bias = tf.get_variable('b', [self.num_classes],
+                                   initializer=tf.zeros_initializer())
+            # [time, batch, classes], the last class being the blank.
+            self.logits = tf.tensordot(outputs, weights, [[2], [0]]) + bias
+
+        masks = tf.concat(encoder_masks[:encoder_size], 1)
+        self.sequence_length = tf.cast(tf.reduce_sum(masks, axis=1), tf.int32)
+        num_images = tf.shape(masks)[0]
+
+        with tf.name_scope('ctc_loss'):
+            targets = tf.stack(decoder_inputs[1:], axis=1)
+            labels = sparse_ids(targets, tf.greater(targets, eos_id))
+            self.loss = tf.reduce_mean(tf.nn.ctc_loss(
+                labels, self.logits, self.sequence_length,
+                ignore_longer_outputs_than_inputs=True))
+
+        with tf.name_scope('ctc_decoder'):
+            log_probs = tf.nn.log_softmax(self.logits)
+            if beam_width > 1:
+                decoded, log_probabilities = tf.nn.ctc_beam_search_decoder(
+                    log_probs, self.sequence_length, beam_width=beam_width, top_paths=1,
+                    merge_repeated=False)
+                log_probability = log_probabilities[:, 0]
+            else:
+                decoded, neg_sum_log_probs = tf.nn.ctc_greedy_decoder(
+                    log_probs, self.sequence_length)
+                log_probability = -neg_sum_log_probs[:, 0]
+
+            # ``[batch, time]`` predicted ids, with at least one EOS after
+            # every sequence, like the outputs of the attention decoder.
+            predictions = tf.sparse_tensor_to_dense(decoded[0], default_value=eos_id)
+            self.predictions = tf.concat(
+                [predictions, tf.fill([num_images, 1], tf.cast(eos_id, predictions.dtype))], 1)
+            # Probability of the decoded path: the best alignment without a
+            # beam search, the sum over the alignments of the prefix with it.
+            self.probability = tf.exp(log_probability)
@@ -0,0 +1,28 @@
+"""Knowledge distillation loss."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import tensorflow as tf
+
+
+def distillation_loss(logits, soft_targets, weights, temperature=1.0, name=None):
+    """Cross-entropy between the soft targets of a teacher and the predictions
+    of the student softened by the same temperature.
+
+    It is averaged over the positions of every sample and then over the
+    batch, like `sequence_loss`, and scaled by the squared temperature to
+    keep the magnitude of its gradients independent of the temperature.
+
+    :param logits: list of ``[batch, vocab]`` student logits, one per decoder step
+    :param soft_targets: ``[batch, steps, vocab]`` teacher probabilities
+    :param weights: list of ``[batch]`` target weights, one per decoder step
+    :param temperature: softmax temperature of both the teacher and the student
+    """
+    with tf.name_scope(name, 'distillation_loss', logits + weights + [soft_targets]):
+        log_probs = tf.nn.log_softmax(tf.stack(logits, axis=1) / temperature)
+        weights = tf.stack(weights, axis=1)
+        cross_entropy = -tf.reduce_sum(soft_targets * log_probs, axis=2)
+        per_sample = (tf.reduce_sum(cross_entropy * weights, axis=1)
+                      / (tf.reduce_sum(weights, axis=1) + 1e-12))
+        return temperature ** 2 * tf.reduce_mean(per_sample)
@@ -0,0 +1,123 @@
+"""Streaming evaluation metrics computed in the graph."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import tensorflow as tf
+
+
+def sparse_ids(ids, mask):
+    """Turn the masked entries of a ``[batch, time]`` id tensor into a sparse
+    tensor of sequences, as expected by `tf.edit_distance`."""
+    positions = tf.cumsum(tf.cast(mask, tf.int64), axis=1, exclusive=True)
+    where = tf.where(mask)
+    indices = tf.stack([where[:, 0], tf.gather_nd(positions, where)], axis=1)
+    return tf.SparseTensor(indices, tf.gather_nd(ids, where), tf.shape(ids, out_type=tf.int64))
+
+
+class EvaluationMetrics(object):
+    """Accuracy, character and word error rates, accumulated across batches.
+
+    The sums behind the metrics are kept in local variables, so that
+    `update` adds a batch to them, `reset` clears them, and the sums of
+    several evaluations can be added up before computing the rates (see
+    `rates`).
+
+    :param predicted_ids: ``[batch, time]`` predicted character ids
+    :param target_ids: ``[batch, time]`` decoder inputs holding the labels
+    :param table: lookup table from character ids to characters
+    :param eos_id: end of sequence id; ids below it are not characters
+    :param use_distance: score samples by edit distance rather than exact match
+    """
+
+    SUMS = ('samples', 'correct', 'exact', 'char_errors', 'chars', 'word_errors', 'words')
+
+    def __init__(self, predicted_ids, target_ids, table, eos_id, use_distance=True):
+        with tf.name_scope('metrics'):
+            predicted_ids = tf.cast(predicted_ids, tf.int64)
+            target_ids = tf.cast(target_ids, tf.int64)
+
+            # A prediction ends at its first EOS, like the output string does.
+            before_eos = tf.equal(
+                tf.cumsum(tf.cast(tf.equal(predicted_ids, eos_id), tf.int32), axis=1), 0)
+            predicted_mask = tf.logical_and(before_eos, tf.greater(predicted_ids, eos_id))
+            target_mask = tf.greater(target_ids, eos_id)
+
+            char_errors = tf.edit_distance(sparse_ids(predicted_ids, predicted_mask),
+                                           sparse_ids(target_ids, target_mask),
+                                           normalize=False)
+            chars = tf.reduce_sum(tf.cast(target_mask, tf.float32), axis=1)
+
+            def words(ids, mask):
+                text = tf.reduce_join(table.lookup(tf.where(mask, ids, tf.zeros_like(ids))),
+                                      axis=1)
+                return tf.string_split(text, delimiter=' ')
+
+            target_words = words(target_ids, target_mask)
+            word_errors = tf.edit_distance(words(predicted_ids, predicted_mask), target_words,
+                                           normalize=False)
+            num_words = tf.cast(tf.size(target_words.values), tf.float32)
+
+            exact = tf.cast(tf.equal(char_errors, 0.), tf.float32)
+            if use_distance:
+                # Character error rate of the sample, capped at 1; any output
+                # is wrong for an empty label.
+                self.incorrect = tf.where(
+                    tf.greater(chars, 0.),
+                    tf.minimum(1., char_errors / tf.maximum(chars, 1.)),
+                    tf.cast(tf.greater(char_errors, 0.), tf.float32))
+            else:
+                self.incorrect = 1. - exact
+
+            batch = {
+                'samples': tf.cast(tf.size(chars), tf.float32),
+                'correct': tf.reduce_sum(1. - self.incorrect),
+                'exact': tf.reduce_sum(exact),
+                'char_errors': tf.reduce_sum(char_errors),
+                'chars': tf.reduce_sum(chars),
+                'word_errors': tf.reduce_sum(word_errors),
+                'words': num_words,
+            }
+
+            self.sums = {}
+            for name in self.SUMS:
+                self.sums[name] = tf.Variable(0., dtype=tf.float64, trainable=False, name=name,
+                                              collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            self.update = tf.group(*[tf.assign_add(self.sums[name],
+                                                   tf.cast(batch[name], tf.float64))
+                                     for name in self.SUMS])
+            self.reset = tf.variables_initializer(list(self.sums.values()))
+
+    def result(self, sess):
+        """Current sums, as a dict of floats."""
+        return sess.run(self.sums)
+
+    def add_to_collections(self, prefix):
+        """Add the tensors of the metrics to graph collections, so that
+        `from_collections` finds them in an imported meta graph."""
+        for name in self.SUMS:
+            tf.add_to_collection(prefix + 'sums', self.sums[name].value())
+        tf.add_to_collection(prefix + 'incorrect', self.incorrect)
+        tf.add_to_collection(prefix + 'update', self.update)
+        tf.add_to_collection(prefix + 'reset', self.reset)
+
+    @classmethod
+    def from_collections(cls, prefix):
+        """Metrics of the default graph, see `add_to_collections`."""
+        metrics = cls.__new__(cls)
+        metrics.sums = dict(zip(cls.SUMS, tf.get_collection(prefix + 'sums')))
+        metrics.incorrect = tf.get_collection(prefix + 'incorrect')[0]
+        metrics.update = tf.get_collection(prefix + 'update')[0]
+        metrics.reset = tf.get_collection(prefix + 'reset')[0]
+        return metrics
+
+    @staticmethod
+    def rates(sums):
+        """Compute the metrics from (possibly merged) sums."""
+        return {
+            'samples': int(sums['samples']),
+            'accuracy': sums['correct'] / max(sums['samples'], 1),
+            'exact_match': sums['exact'] / max(sums['samples'], 1),
+            'cer': sums['char_errors'] / max(sums['chars'], 1),
+            'wer': sums['word_errors'] / max(sums['words'], 1),
+        }
@@ -3,21 +3,46 @@
 from __future__ import absolute_import
 from __future__ import division
 
+import json
 import time
 import os
 import math
 import logging
 import sys
 
-import distance
 import numpy as np
 import tensorflow as tf
 
 from six.moves import xrange  # pylint: disable=redefined-builtin
 from .cnn import CNN
+from .ctc_model import CTCModel
+from .distillation import distillation_loss
+from .pruning import MagnitudePruning, prunable_variables, sparsity_schedule
+from .metrics import EvaluationMetrics
 from .seq2seq_model import Seq2SeqModel
-from ..util.data_gen import DataGen
-from ..util.visualizations import visualize_attention
+from ..util.attention_dump import AttentionDumpWriter
+from ..util.data_gen import DataGen, prepare_image, resized_max_width
+from ..util.visualizations import VisualizationWriter
+
+
+# Options that change the variables or the shapes of the model, recorded with
+# the checkpoints.
+ARCHITECTURE_FILE = 'architecture.json'
+# The keyword arguments of `Model` that are recorded.
+ARCHITECTURE_OPTIONS = (
+    'backbone', 'width_multiplier', 'head', 'max_image_width', 'max_image_height',
+    'max_prediction_length', 'channels', 'target_embedding_size', 'attn_num_hidden',
+    'attn_num_layers', 'use_gru', 'charmap')
+
+# Forward-only graph of the model, written when the training starts, that
+# `test` and `predict` import instead of rebuilding the model.
+INFERENCE_GRAPH_FILE = 'inference.meta'
+
+# Prefix of the graph collections of the tensors of the inference graph.
+COLLECTION_PREFIX = 'aocr/'
+
+# Output heads: the attention decoder, or a CTC head on the encoder outputs.
+HEADS = ('attention', 'ctc')
 
 
 class Model(object):
@@ -43,15 +68,66 @@ class Model(object):
                  max_image_height=60,
                  max_prediction_length=8,
                  channels=1,
-                 reg_val=0):
+                 reg_val=0,
+                 checkpoint_path=None,
+                 fused_lstm=False,
+                 matmul_attention=False,
+                 attention_window=0,
+                 backbone='vgg',
+                 width_multiplier=1.0,
+                 teacher_forcing=False,
+                 distillation_weight=0.,
+                 distillation_temperature=1.,
+                 prune_sparsity=0.,
+                 prune_steps=10000,
+                 prune_frequency=100,
+                 filters=None,
+                 head='attention',
+                 ctc_beam_width=0,
+                 charmap=None,
+                 import_graph=True):
+
+        if not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+
+        restore = checkpoint_path or (load_model and tf.train.get_checkpoint_state(model_dir))
+        architecture = self.resolve_architecture(
+            model_dir, {
+                'backbone': backbone,
+                'width_multiplier': width_multiplier,
+                'head': head,
+                'max_image_width': max_image_width,
+                'max_image_height': max_image_height,
+                'max_prediction_length': max_prediction_length,
+                'channels': channels,
+                'target_embedding_size': target_embedding_size,
+                'attn_num_hidden': attn_num_hidden,
+                'attn_num_layers': attn_num_layers,
+                'use_gru': use_gru,
+                'charmap': list(charmap if charmap is not None else DataGen.CHARMAP),
+            },
+            restore=bool(restore), record=phase == 'train')
+        backbone = architecture['backbone']
+        width_multiplier = architecture['width_multiplier']
+        head = architecture['head']
+        max_image_width = architecture['max_image_width']
+        max_image_height = architecture['max_image_height']
+        max_prediction_length = architecture['max_prediction_length']
+        channels = architecture['channels']
+        target_embedding_size = architecture['target_embedding_size']
+        attn_num_hidden = architecture['attn_num_hidden']
+        attn_num_layers = architecture['attn_num_layers']
+        use_gru = architecture['use_gru']
+        # The labels are encoded with the character map of the model.
+        self.charmap = list(architecture['charmap'])
+        self.architecture = architecture
 
         self.use_distance = use_distance
 
         # We need resized width, not the actual width
-        max_resized_width = 1. * max_image_width / max_image_height * DataGen.IMAGE_HEIGHT
-
         self.max_original_width = max_image_width
-        self.max_width = int(math.ceil(max_resized_width))
+        self.max_width = resized_max_width(max_image_width, max_image_height,
+                                           DataGen.IMAGE_HEIGHT)
 
         self.encoder_size = int(math.ceil(1. * self.max_width / 4))
         self.decoder_size = max_prediction_length + 2
@@ -63,11 +139,12 @@ class Model(object):
             device_id = '/cpu:0'
         self.device_id = device_id
 
-        if not os.path.exists(model_dir):
-            os.makedirs(model_dir)
-
-        if phase == 'test':
-            batch_size = 1
+        if head not in HEADS:
+            raise ValueError('Unknown head: {}.'.format(head))
+        if head == 'ctc' and (distillation_weight or teacher_forcing):
+            raise ValueError('Distillation requires the attention head.')
+        if head == 'ctc' and visualize:
+            raise ValueError('The CTC head has no attention to visualize.')
 
         logging.info('phase: %s', phase)
         logging.info('model_dir: %s', model_dir)
@@ -86,6 +163,21 @@ class Model(object):
         logging.info('attn_num_hidden: %d', attn_num_hidden)
         logging.info('attn_num_layers: %d', attn_num_layers)
         logging.info('visualize: %s', visualize)
+        logging.info('fused_lstm: %s', fused_lstm)
+        logging.info('matmul_attention: %s', matmul_attention)
+        logging.info('attention_window: %d', attention_window)
+        logging.info('backbone: %s', backbone)
+        logging.info('width_multiplier: %f', width_multiplier)
+        logging.info('head: %s', head)
+        if head == 'ctc':
+            logging.info('ctc_beam_width: %d', ctc_beam_width)
+        if prune_sparsity:
+            logging.info('prune_sparsity: %f', prune_sparsity)
+            logging.info('prune_steps: %d', prune_steps)
+            logging.info('prune_frequency: %d', prune_frequency)
+        if distillation_weight:
+            logging.info('distillation_weight: %f', distillation_weight)
+            logging.info('distillation_temperature: %f', distillation_temperature)
 
         if use_gru:
             logging.info('using GRU in the decoder.')
@@ -96,18 +188,39 @@ class Model(object):
         self.model_dir = model_dir
         self.output_dir = output_dir
         self.batch_size = batch_size
-        self.global_step = tf.Variable(0, trainable=False)
         self.phase = phase
         self.visualize = visualize
         self.learning_rate = initial_learning_rate
         self.clip_gradients = clip_gradients
         self.channels = channels
+        self.head = head
+        self.pruning = None
+        self.prune_sparsity = prune_sparsity
+        self.prune_steps = prune_steps
+        self.prune_frequency = prune_frequency
 
         if phase == 'train':
             self.forward_only = False
         else:
             self.forward_only = True
 
+        # Options baked into the inference graph, see `read_inference_graph`.
+        self.graph_options = {
+            'fused_lstm': fused_lstm,
+            'matmul_attention': matmul_attention,
+            'attention_window': attention_window,
+            'ctc_beam_width': ctc_beam_width,
+            'use_distance': use_distance,
+        }
+        if phase in ('test', 'predict') and restore and import_graph:
+            meta_graph = self.read_inference_graph(model_dir, self.graph_options)
+            if meta_graph is not None:
+                self._import_inference_graph(meta_graph)
+                self._restore(checkpoint_path, load_model)
+                return
+
+        self.global_step = tf.Variable(0, trainable=False)
+
         with tf.device(device_id):
 
             self.height = tf.constant(DataGen.IMAGE_HEIGHT, dtype=tf.int32)
@@ -140,21 +253,48 @@ class Model(object):
                 else:
                     self.target_weights.append(tf.tile([0.], [num_images]))
 
-            cnn_model = CNN(self.img_data, not self.forward_only)
+            cnn_model = CNN(self.img_data, not self.forward_only,
+                            backbone=backbone, width_multiplier=width_multiplier,
+                            filters=filters)
             self.conv_output = cnn_model.tf_output()
             self.perm_conv_output = tf.transpose(self.conv_output, perm=[1, 0, 2])
-            self.attention_decoder_model = Seq2SeqModel(
-                encoder_masks=self.encoder_masks,
-                encoder_inputs_tensor=self.perm_conv_output,
-                decoder_inputs=self.decoder_inputs,
-                target_weights=self.target_weights,
-                target_vocab_size=len(DataGen.CHARMAP),
-                buckets=self.buckets,
-                target_embedding_size=target_embedding_size,
-                attn_num_layers=attn_num_layers,
-                attn_num_hidden=attn_num_hidden,
-                forward_only=self.forward_only,
-                use_gru=use_gru)
+            if head == 'ctc':
+                self.attention_decoder_model = None
+                self.ctc_model = CTCModel(
+                    encoder_masks=self.encoder_masks,
+                    encoder_inputs_tensor=self.perm_conv_output,
+                    decoder_inputs=self.decoder_inputs,
+                    num_symbols=len(self.charmap),
+                    eos_id=DataGen.EOS_ID,
+                    encoder_size=self.encoder_size,
+                    num_hidden=attn_num_layers * attn_num_hidden,
+                    fused_lstm=fused_lstm,
+                    beam_width=ctc_beam_width)
+                self.loss = self.ctc_model.loss
+                self.logits = None
+                self.attentions = []
+            else:
+                self.attention_decoder_model = Seq2SeqModel(
+                    encoder_masks=self.encoder_masks,
+                    encoder_inputs_tensor=self.perm_conv_output,
+                    decoder_inputs=self.decoder_inputs,
+                    target_weights=self.target_weights,
+                    target_vocab_size=len(self.charmap),
+                    buckets=self.buckets,
+                    target_embedding_size=target_embedding_size,
+                    attn_num_layers=attn_num_layers,
+                    attn_num_hidden=attn_num_hidden,
+                    # A distillation teacher is fed the labels, like in training.
+                    forward_only=self.forward_only and not teacher_forcing,
+                    use_gru=use_gru,
+                    fused_lstm=fused_lstm,
+                    matmul_attention=matmul_attention,
+                    attention_window=attention_window)
+                self.loss = self.attention_decoder_model.loss
+
+                # Decoder logits, one [batch, vocabulary] tensor per step.
+                self.logits = self.attention_decoder_model.output
+                self.attentions = self.attention_decoder_model.attentions
 
             table = tf.contrib.lookup.MutableHashTable(
                 key_dtype=tf.int64,
@@ -164,23 +304,26 @@ class Model(object):
             )
 
             insert = table.insert(
-                tf.constant(list(range(len(DataGen.CHARMAP))), dtype=tf.int64),
-                tf.constant(DataGen.CHARMAP),
+                tf.constant(list(range(len(self.charmap))), dtype=tf.int64),
+                tf.constant(self.charmap),
             )
 
             with tf.control_dependencies([insert]):
-                num_feed = []
-                prb_feed = []
+                if head == 'ctc':
+                    predicted_ids = self.ctc_model.predictions
+                else:
+                    num_feed = []
+                    prb_feed = []
 
-                for line in xrange(len(self.attention_decoder_model.output)):
-                    guess = tf.argmax(self.attention_decoder_model.output[line], axis=1)
-                    proba = tf.reduce_max(
-                        tf.nn.softmax(self.attention_decoder_model.output[line]), axis=1)
-                    num_feed.append(guess)
-                    prb_feed.append(proba)
+                    for line in xrange(len(self.attention_decoder_model.output)):
+                        guess = tf.argmax(self.attention_decoder_model.output[line], axis=1)
+                        proba = tf.reduce_max(
+                            tf.nn.softmax(self.attention_decoder_model.output[line]), axis=1)
+                        num_feed.append(guess)
+                        prb_feed.append(proba)
+                    predicted_ids = tf.transpose(num_feed)
 
                 # Join the predictions into a single output string.
-                trans_output = tf.transpose(num_feed)
                 trans_output = tf.map_fn(
                     lambda m: tf.foldr(
                         lambda a, x: tf.cond(
@@ -191,22 +334,25 @@ class Model(object):
                         m,
                         initializer=''
                     ),
-                    trans_output,
+                    predicted_ids,
                     dtype=tf.string
                 )
 
                 # Calculate the total probability of the output string.
-                trans_outprb = tf.transpose(prb_feed)
-                trans_outprb = tf.gather(trans_outprb, tf.range(tf.size(trans_output)))
-                trans_outprb = tf.map_fn(
-                    lambda m: tf.foldr(
-                        lambda a, x: tf.multiply(tf.cast(x, tf.float64), a),
-                        m,
-                        initializer=tf.cast(1, tf.float64)
-                    ),
-                    trans_outprb,
-                    dtype=tf.float64
-                )
+                if head == 'ctc':
+                    trans_outprb = tf.cast(self.ctc_model.probability, tf.float64)
+                else:
+                    trans_outprb = tf.transpose(prb_feed)
+                    trans_outprb = tf.gather(trans_outprb, tf.range(tf.size(trans_output)))
+                    trans_outprb = tf.map_fn(
+                        lambda m: tf.foldr(
+                            lambda a, x: tf.multiply(tf.cast(x, tf.float64), a),
+                            m,
+                            initializer=tf.cast(1, tf.float64)
+                        ),
+                        trans_outprb,
+                        dtype=tf.float64
+                    )
 
                 self.prediction = tf.cond(
                     tf.equal(tf.shape(trans_output)[0], 1),
@@ -222,13 +368,33 @@ class Model(object):
                 self.prediction = tf.identity(self.prediction, name='prediction')
                 self.probability = tf.identity(self.probability, name='probability')
 
+                self.metrics = None
+                if phase == 'test':
+                    self.metrics = EvaluationMetrics(
+                        predicted_ids,
+                        tf.stack(self.decoder_inputs[1:], axis=1),
+                        table,
+                        DataGen.EOS_ID,
+                        use_distance=use_distance)
+
             if not self.forward_only:  # train
                 self.updates = []
                 self.summaries_by_bucket = []
 
                 params = tf.trainable_variables()
                 opt = tf.train.AdamOptimizer()
-                loss_op = self.attention_decoder_model.loss
+                loss_op = self.loss
+
+                if distillation_weight:
+                    # Soft targets computed by a teacher, see `Teacher`.
+                    self.soft_targets = tf.placeholder(
+                        tf.float32, [None, self.decoder_size, len(self.charmap)],
+                        name='soft_targets')
+                    self.distillation_loss = distillation_loss(
+                        self.logits, self.soft_targets, self.target_weights[:self.decoder_size],
+                        distillation_temperature)
+                    loss_op = ((1. - distillation_weight) * loss_op
+                               + distillation_weight * self.distillation_loss)
 
                 if self.reg_val > 0:
                     reg_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
@@ -245,31 +411,171 @@ class Model(object):
                     tf.summary.scalar("loss", loss_op),
                     tf.summary.scalar("total_gradient_norm", tf.global_norm(gradients))
                 ]
+                if distillation_weight:
+                    summaries.append(
+                        tf.summary.scalar("distillation_loss", self.distillation_loss))
                 all_summaries = tf.summary.merge(summaries)
                 self.summaries_by_bucket.append(all_summaries)
 
+                if prune_sparsity:
+                    self.pruning = MagnitudePruning(prunable_variables(params))
+
                 # update op - apply gradients
                 update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
                 with tf.control_dependencies(update_ops):
-                    self.updates.append(
-                        opt.apply_gradients(
-                            list(zip(gradients, params)),
-                            global_step=self.global_step
-                        )
+                    update = opt.apply_gradients(
+                        list(zip(gradients, params)),
+                        global_step=self.global_step
                     )
+                if self.pruning is not None:
+                    # Pruned weights stay at zero.
+                    with tf.control_dependencies([update]):
+                        update = self.pruning.apply_masks()
+                self.updates.append(update)
 
         self.saver_all = tf.train.Saver(tf.all_variables())
+        self._restore(checkpoint_path, load_model)
+
+        if self.pruning is not None:
+            self.sess.run(self.pruning.init_masks)
+
+    def _restore(self, checkpoint_path, load_model):
+        """Restore `checkpoint_path`, or the latest checkpoint if `load_model`,
+        or initialize the variables if there is none."""
         self.checkpoint_path = os.path.join(self.model_dir, "model.ckpt")
 
-        ckpt = tf.train.get_checkpoint_state(model_dir)
-        if ckpt and load_model:
+        ckpt = tf.train.get_checkpoint_state(self.model_dir)
+        if checkpoint_path:
+            logging.info("Reading model parameters from %s", checkpoint_path)
+            self._restore_checkpoint(checkpoint_path)
+        elif ckpt and load_model:
             # pylint: disable=no-member
             logging.info("Reading model parameters from %s", ckpt.model_checkpoint_path)
-            self.saver_all.restore(self.sess, ckpt.model_checkpoint_path)
+            self._restore_checkpoint(ckpt.model_checkpoint_path)
         else:
             logging.info("Created model with fresh parameters.")
             self.sess.run(tf.initialize_all_variables())
 
+    def _restore_checkpoint(self, path):
+        """Restore the variables of the checkpoint at `path`."""
+        if self.pruning is not None and not tf.train.NewCheckpointReader(path).has_tensor(
+                self.pruning.start_step.op.name):
+            # A model trained without pruning: its pruning starts now.
+            state = set(var.op.name for var in self.pruning.state)
+            tf.train.Saver([var for var in tf.all_variables()
+                            if var.op.name not in state]).restore(self.sess, path)
+            self.sess.run(tf.variables_initializer(self.pruning.state))
+        else:
+            self.saver_all.restore(self.sess, path)
+
+    def _import_inference_graph(self, meta_graph):
+        """Import the graph written by `export_inference_graph` in the default
+        graph, and look up its tensors."""
+        logging.info('Importing the inference graph of the model.')
+        with tf.device(self.device_id):
+            self.saver_all = tf.train.import_meta_graph(meta_graph, clear_devices=True)
+
+        def collection(name):
+            return tf.get_collection(COLLECTION_PREFIX + name)
+
+        self.img_pl, self.img_data = collection('inputs')
+        self.decoder_inputs = collection('decoder_inputs')
+        self.target_weights = collection('target_weights')
+        self.prediction, self.probability, self.loss = collection('outputs')
+        self.attentions = collection('attentions')
+        self.metrics = EvaluationMetrics.from_collections(COLLECTION_PREFIX + 'metrics/')
+        self.attention_decoder_model = None
+        self.logits = None
+
+    def export_inference_graph(self, path):
+        """Write the graph of this forward-only model to `path`, with the
+        collections that `_import_inference_graph` reads and the
+        `graph_options` it was built with."""
+        def add_to_collection(name, values):
+            for value in values:
+                tf.add_to_collection(COLLECTION_PREFIX + name, value)
+
+        add_to_collection('inputs', [self.img_pl, self.img_data])
+        add_to_collection('decoder_inputs', self.decoder_inputs)
+        add_to_collection('target_weights', self.target_weights)
+        add_to_collection('outputs', [self.prediction, self.probability, self.loss])
+        add_to_collection('attentions', self.attentions)
+        add_to_collection('graph_options', [
+            json.dumps(self.graph_options, sort_keys=True).encode('utf-8')])
+        self.metrics.add_to_collections(COLLECTION_PREFIX + 'metrics/')
+        tf.train.export_meta_graph(filename=path, saver_def=self.saver_all.as_saver_def(),
+                                   clear_devices=True)
+
+    @staticmethod
+    def write_inference_graph(model_params, architecture):
+        """Build the forward-only model described by `model_params` (keyword
+        arguments of `Model`, except the session) and its recorded
+        `architecture` in a new graph, and write it to `INFERENCE_GRAPH_FILE`
+        in the model directory, for `test` and `predict` to import."""
+        params = dict(model_params)
+        params.update(architecture)
+        path = os.path.join(params['model_dir'], INFERENCE_GRAPH_FILE)
+        logging.info('Writing the inference graph to %s.', path)
+        with tf.Graph().as_default(), \
+                tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+            model = Model(session=sess, **dict(
+                params, phase='test', load_model=False, checkpoint_path=None,
+                visualize=False, distillation_weight=0., prune_sparsity=0.))
+            model.export_inference_graph(path)
+
+    @staticmethod
+    def read_inference_graph(model_dir, graph_options):
+        """The `MetaGraphDef` written by `write_inference_graph` in
+        `model_dir`, or None if there is none, or if it was built with other
+        `graph_options` (options of the model that do not change its
+        variables)."""
+        path = os.path.join(model_dir, INFERENCE_GRAPH_FILE)
+        if not tf.gfile.Exists(path):
+            return None
+        meta_graph = tf.MetaGraphDef()
+        with tf.gfile.GFile(path, 'rb') as graph_file:
+            meta_graph.ParseFromString(graph_file.read())
+
+        key = COLLECTION_PREFIX + 'graph_options'
+        if key not in meta_graph.collection_def:
+            return None
+        recorded = json.loads(meta_graph.collection_def[key].bytes_list.value[0].decode('utf-8'))
+        if recorded != graph_options:
+            logging.info('The inference graph was built with %s, rebuilding the model for %s.',
+                         recorded, graph_options)
+            return None
+        return meta_graph
+
+    @staticmethod
+    def resolve_architecture(model_dir, architecture, restore, record):
+        """Options that change the variables or the shapes of the model, like
+        the backbone, the maximum sizes and the character map, are recorded
+        in `ARCHITECTURE_FILE` in the model directory when training starts.
+        When restoring a checkpoint, the recorded options take precedence
+        over the given ones, so that `test`, `predict` and `export` rebuild
+        the model that was trained. Options missing from the record of an
+        older model are added to it when its training resumes."""
+        path = os.path.join(model_dir, ARCHITECTURE_FILE)
+        architecture = dict(architecture)
+        recorded = {}
+        if restore and tf.gfile.Exists(path):
+            with tf.gfile.GFile(path, 'r') as architecture_file:
+                recorded = json.load(architecture_file)
+            for key, value in sorted(recorded.items()):
+                if key not in architecture or architecture[key] == value:
+                    continue
+                if isinstance(value, list):
+                    logging.warning('Using the recorded %s of the model (%i entries).',
+                                    key, len(value))
+                else:
+                    logging.warning('Using the recorded %s of the model, %s, instead of %s.',
+                                    key, value, architecture[key])
+            architecture.update(recorded)
+        if record and set(architecture) != set(recorded):
+            with tf.gfile.GFile(path, 'w') as architecture_file:
+                json.dump(architecture, architecture_file, sort_keys=True)
+        return architecture
+
     def predict(self, image_file_data):
         input_feed = {}
         input_feed[self.img_pl.name] = image_file_data
@@ -284,107 +590,206 @@ class Model(object):
 
         return (text, probability)
 
-    def test(self, data_path):
-        current_step = 0
-        num_correct = 0.0
-        num_total = 0.0
-
-        s_gen = DataGen(data_path, self.buckets, epochs=1, max_width=self.max_original_width, augment_data_prob=0.0)
-        for batch in s_gen.gen(1):
-            current_step += 1
-            # Get a batch (one image) and make a step.
-            start_time = time.time()
-            result = self.step(batch, self.forward_only)
-            curr_step_time = (time.time() - start_time)
-
-            num_total += 1
+    def test(self, data_path, shuffle_buffer_size=10000, num_parallel_reads=1,
+             num_parallel_calls=1, log_step=500, num_shards=1, shard_index=0,
+             decoded=None, visualize_mistakes=False, visualize_lowest=0, visualize_workers=2,
+             attention_dump=None, dump_chunk_size=4096):
+        """Evaluate the model on a dataset, `self.batch_size` samples at a time,
+        and return the sums behind the metrics (see `EvaluationMetrics`) along
+        with the total loss. Only part `shard_index` of `num_shards` of the
+        dataset is evaluated if the dataset is split. A `DecodedDataset` can
+        be given as `decoded` to skip reading and decoding the dataset.
+
+        With `self.visualize`, the attention of every sample is rendered by
+        `visualize_workers` background processes; `visualize_mistakes` limits
+        this to the mistakes, and `visualize_lowest` to that many samples with
+        the lowest probabilities.
+
+        With `attention_dump`, the attentions, model inputs, predictions,
+        labels and probabilities of all the samples are written to that
+        directory in chunks of `dump_chunk_size` samples (see
+        `AttentionDumpWriter`)."""
+        total_loss = 0.0
+
+        if decoded is not None:
+            batches = decoded.batches(self.batch_size, self.buckets)
+        else:
+            s_gen = DataGen(
+                data_path,
+                self.buckets,
+                epochs=1,
+                max_width=self.max_original_width,
+                augment_data_prob=0.0,
+                shuffle_buffer_size=shuffle_buffer_size,
+                num_parallel_reads=num_parallel_reads,
+                num_parallel_calls=num_parallel_calls,
+                image_width=self.max_width,
+                channels=self.channels,
+                charmap=self.charmap,
+                num_shards=num_shards,
+                shard_index=shard_index
+            )
+            batches = s_gen.gen(self.batch_size, drop_remainder=False)
+
+        self.sess.run(self.metrics.reset)
+        num_total = 0
+        start_time = time.time()
+        next_log = log_step
+        writer = None
+        if self.visualize:
+            writer = VisualizationWriter(workers=visualize_workers, lowest=visualize_lowest)
+        dump = None
+        if attention_dump:
+            if self.head == 'ctc':
+                raise ValueError('The CTC head has no attention to dump.')
+            dump = AttentionDumpWriter(attention_dump, chunk_size=dump_chunk_size)
+
+        try:
+            for batch in batches:
+                total_loss += self._test_batch(batch, writer, visualize_mistakes, dump)
+                num_total += len(batch['labels'])
+
+                if num_total >= next_log:
+                    self.log_test_summary(self.metrics.result(self.sess), total_loss, start_time)
+                    next_log = (num_total // log_step + 1) * log_step
+        finally:
+            if writer is not None:
+                logging.info('Waiting for the visualizations to be written.')
+                writer.close()
+            if dump is not None:
+                dump.close()
+
+        sums = self.metrics.result(self.sess)
+        sums['loss'] = total_loss
+        self.log_test_summary(sums, total_loss, start_time)
+        return sums
+
+    def _test_batch(self, batch, writer=None, visualize_mistakes=False, dump=None):
+        """Evaluate a batch, log its mistakes, queue its visualizations and
+        add it to the attention dump. Returns the total loss of the batch."""
+        result = self.step(batch, self.forward_only,
+                           attentions=self.visualize or dump is not None,
+                           inputs=dump is not None)
+
+        # A single prediction comes out as a scalar.
+        outputs = np.atleast_1d(result['prediction'])
+        probabilities = np.atleast_1d(result['probability'])
+
+        if dump is not None:
+            texts = [outputs, batch['labels'], batch['comments']]
+            if sys.version_info >= (3,):
+                texts = [[text.decode('iso-8859-1') for text in column] for column in texts]
+            dump.add_batch(np.stack(result['attentions'], axis=1), result['inputs'],
+                           texts[0], texts[1], probabilities, result['incorrect'], texts[2])
+
+        for idx, (output, ground, comment, probability, incorrect) in enumerate(zip(
+                outputs, batch['labels'], batch['comments'], probabilities,
+                result['incorrect'])):
+            visualize = writer is not None and (incorrect or not visualize_mistakes)
+            if not incorrect and not visualize:
+                continue
 
-            output = result['prediction']
-            ground = batch['labels'][0]
-            comment = batch['comments'][0]
             if sys.version_info >= (3,):
                 output = output.decode('iso-8859-1')
                 ground = ground.decode('iso-8859-1')
                 comment = comment.decode('iso-8859-1')
 
-            probability = result['probability']
+            if visualize:
+                # Attention visualization, rendered in the background.
+                attns = np.array([step_attn[idx] for step_attn in result['attentions']])
+                writer.submit(probability,
+                              batch.get('images', batch['data'])[idx],
+                              'out',
+                              attns[np.newaxis],
+                              output,
+                              self.max_width,
+                              DataGen.IMAGE_HEIGHT,
+                              threshold=0.5,
+                              normalize=True,
+                              binarize=True,
+                              ground=ground,
+                              flag=None)
 
-            if self.use_distance:
-                incorrect = distance.levenshtein(output, ground)
-                if not ground:
-                    if not output:
-                        incorrect = 0
-                    else:
-                        incorrect = 1
-                else:
-                    incorrect = float(incorrect) / len(ground)
-                incorrect = min(1, incorrect)
-            else:
-                incorrect = 0 if output == ground else 1
-
-            num_correct += 1. - incorrect
-
-            if self.visualize:
-                # Attention visualization.
-                threshold = 0.5
-                normalize = True
-                binarize = True
-                attns_list = [[a.tolist() for a in step_attn] for step_attn in result['attentions']]
-                attns = np.array(attns_list).transpose([1, 0, 2])
-                visualize_attention(batch['data'],
-                                    'out',
-                                    attns,
-                                    output,
-                                    self.max_width,
-                                    DataGen.IMAGE_HEIGHT,
-                                    threshold=threshold,
-                                    normalize=normalize,
-                                    binarize=binarize,
-                                    ground=ground,
-                                    flag=None)
-
-            step_accuracy = "{:>4.0%}".format(1. - incorrect)
             if incorrect:
-                correctness = step_accuracy + " ({} vs {}) {}".format(output, ground, comment)
-            else:
-                correctness = step_accuracy + " (" + ground + ")"
-
-            logging.info('Step {:.0f} ({:.3f}s). '
-                         'Accuracy: {:6.2%}, '
-                         'loss: {:f}, perplexity: {:0<7.6}, probability: {:6.2%} {}'.format(
-                             current_step,
-                             curr_step_time,
-                             num_correct / num_total,
-                             result['loss'],
-                             math.exp(result['loss']) if result['loss'] < 300 else float('inf'),
-                             probability,
-                             correctness))
-
-    def train(self, data_path, num_epoch, augment_data_prob):
+                logging.debug('Mistake: %4.0f%%, probability: %6.2f%% (%s vs %s) %s',
+                              100. * (1. - incorrect), 100. * probability,
+                              output, ground, comment)
+
+        return result['loss'] * len(batch['labels'])
+
+    @staticmethod
+    def log_test_summary(sums, total_loss, start_time):
+        rates = EvaluationMetrics.rates(sums)
+        loss = total_loss / max(rates['samples'], 1)
+        perplexity = math.exp(loss) if loss < 300 else float('inf')
+        logging.info('Evaluated %i samples (%.1f samples/s). Accuracy: %6.2f%%, '
+                     'exact match: %6.2f%%, CER: %6.2f%%, WER: %6.2f%%, '
+                     'loss: %f, perplexity: %.2f.', rates['samples'],
+                     rates['samples'] / max(time.time() - start_time, 1e-6),
+                     100. * rates['accuracy'], 100. * rates['exact_match'],
+                     100. * rates['cer'], 100. * rates['wer'], loss, perplexity)
+
+    def train(self, data_path, num_epoch, augment_data_prob, shuffle_buffer_size=10000,
+              num_parallel_reads=1, num_parallel_calls=1, augment_preprocessed='after',
+              teacher=None):
+        """Train the model on a dataset. When the model was built with a
+        distillation weight, `teacher` computes the soft targets of every
+        batch (see `Teacher`)."""
         logging.info('num_epoch: %d', num_epoch)
         s_gen = DataGen(
             data_path,
             self.buckets,
             epochs=num_epoch,
             max_width=self.max_original_width,
-            augment_data_prob=augment_data_prob
+            augment_data_prob=augment_data_prob,
+            shuffle_buffer_size=shuffle_buffer_size,
+            num_parallel_reads=num_parallel_reads,
+            num_parallel_calls=num_parallel_calls,
+            image_width=self.max_width,
+            channels=self.channels,
+            charmap=self.charmap,
+            augment_preprocessed=augment_preprocessed
         )
+        logging.info('Reading %d TFRecords file(s).', len(s_gen.filenames))
         step_time = 0.0
         loss = 0.0
         current_step = 0
         skipped_counter = 0
+        teacher_time = 0.0
         writer = tf.summary.FileWriter(self.model_dir, self.sess.graph)
 
+        if self.pruning is not None:
+            prune_start_step, initial_sparsity = self.pruning.start(
+                self.sess, self.sess.run(self.global_step), self.prune_sparsity)
+            logging.info('Pruning from %.1f%% to %.1f%% sparsity in %d steps from step %d.',
+                         100. * initial_sparsity, 100. * self.prune_sparsity, self.prune_steps,
+                         prune_start_step)
+
         logging.info('Starting the training process.')
+        checkpoint_start_time = time.time()
         for batch in s_gen.gen(self.batch_size):
 
             current_step += 1
 
+            if self.pruning is not None:
+                # The schedule follows the global step, so that it carries on
+                # where it stopped when the training resumes.
+                prune_step = self.sess.run(self.global_step) - prune_start_step
+                if prune_step % self.prune_frequency == 0:
+                    self.sess.run(self.pruning.update_masks, {
+                        self.pruning.sparsity: sparsity_schedule(
+                            prune_step, self.prune_steps, initial_sparsity,
+                            self.prune_sparsity)})
+
             start_time = time.time()
             # result = self.step(batch, self.forward_only)
             result = None
             try:
-                result = self.step(batch, self.forward_only)
+                soft_targets = None
+                if teacher is not None:
+                    soft_targets = teacher(batch)
+                    teacher_time += time.time() - start_time
+                result = self.step(batch, self.forward_only, soft_targets=soft_targets)
             except Exception as e:
                 skipped_counter += 1
                 logging.info("Step {} failed, batch skipped." +
@@ -428,10 +833,23 @@ class Model(object):
                 # Print statistics for the previous epoch.
                 logging.info("Global step %d. Time: %.3f, loss: %f, perplexity: %.2f.",
                              self.sess.run(self.global_step), step_time, loss, perplexity)
+                # Wall-clock throughput, including the input pipeline.
+                samples_per_sec = (self.steps_per_checkpoint * self.batch_size
+                                   / (time.time() - checkpoint_start_time))
+                logging.info("Throughput: %.1f samples/s.", samples_per_sec)
+                if self.pruning is not None:
+                    logging.info("Sparsity: %.1f%%.",
+                                 100. * self.pruning.current_sparsity(self.sess))
+                if teacher is not None:
+                    logging.info("Teacher: %.1f%% of the time, %d soft targets cached.",
+                                 100. * teacher_time / (time.time() - checkpoint_start_time),
+                                 len(teacher.cache or ()))
+                    teacher_time = 0.0
                 # Save checkpoint and reset timer and loss.
                 logging.info("Saving the model at step %d.", current_step)
                 self.saver_all.save(self.sess, self.checkpoint_path, global_step=self.global_step)
                 step_time, loss = 0.0, 0.0
+                checkpoint_start_time = time.time()
 
         # Print statistics for the previous epoch.
         perplexity = math.exp(loss) if loss < 300 else float('inf')
@@ -446,14 +864,20 @@ class Model(object):
         self.saver_all.save(self.sess, self.checkpoint_path, global_step=self.global_step)
 
     # step, read one batch, generate gradients
-    def step(self, batch, forward_only):
+    def input_feed(self, batch):
+        """Feed dict of the inputs of a batch."""
         img_data = batch['data']
         decoder_inputs = batch['decoder_inputs']
         target_weights = batch['target_weights']
 
         # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
+        # Preprocessed batches are already decoded and resized, so they skip
+        # the image preparation part of the graph.
         input_feed = {}
-        input_feed[self.img_pl.name] = img_data
+        if batch.get('preprocessed'):
+            input_feed[self.img_data.name] = img_data
+        else:
+            input_feed[self.img_pl.name] = img_data
 
         for idx in xrange(self.decoder_size):
             input_feed[self.decoder_inputs[idx].name] = decoder_inputs[idx]
@@ -461,11 +885,23 @@ class Model(object):
 
         # Since our targets are decoder inputs shifted by one, we need one more.
         last_target = self.decoder_inputs[self.decoder_size].name
-        input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+        input_feed[last_target] = np.zeros([len(batch['labels'])], dtype=np.int32)
+        return input_feed
+
+    def step(self, batch, forward_only, attentions=None, inputs=False, soft_targets=None):
+        """Run the model on a batch. In forward-only mode, the attentions are
+        also fetched if `attentions` (by default if `self.visualize`), and
+        the prepared model inputs if `inputs`. When training with
+        distillation, the `soft_targets` of the teacher must be given."""
+        if attentions is None:
+            attentions = self.visualize
+        input_feed = self.input_feed(batch)
+        if soft_targets is not None:
+            input_feed[self.soft_targets.name] = soft_targets
 
         # Output feed: depends on whether we do a backward step or not.
         output_feed = [
-            self.attention_decoder_model.loss,  # Loss for this batch.
+            self.loss,  # Loss for this batch.
         ]
 
         if not forward_only:
@@ -474,8 +910,12 @@ class Model(object):
         else:
             output_feed += [self.prediction]
             output_feed += [self.probability]
-            if self.visualize:
-                output_feed += self.attention_decoder_model.attentions
+            if self.metrics is not None:
+                output_feed += [self.metrics.incorrect, self.metrics.update]
+            if inputs:
+                output_feed += [self.img_data]
+            if attentions:
+                output_feed += self.attentions
 
         outputs = self.sess.run(output_feed, input_feed)
 
@@ -488,8 +928,15 @@ class Model(object):
         else:
             res['prediction'] = outputs[1]
             res['probability'] = outputs[2]
-            if self.visualize:
-                res['attentions'] = outputs[3:]
+            extra_start = 3
+            if self.metrics is not None:
+                res['incorrect'] = outputs[3]
+                extra_start = 5
+            if inputs:
+                res['inputs'] = outputs[extra_start]
+                extra_start += 1
+            if attentions:
+                res['attentions'] = outputs[extra_start:]
 
         return res
 
@@ -497,24 +944,4 @@ class Model(object):
         """Resize the image to a maximum height of `self.height` and maximum
         width of `self.width` while maintaining the aspect ratio. Pad the
         resized image to a fixed size of ``[self.height, self.width]``."""
-        img = tf.image.decode_png(image, channels=self.channels)
-        dims = tf.shape(img)
-        width = self.max_width
-
-        max_width = tf.to_int32(tf.ceil(tf.truediv(dims[1], dims[0]) * self.height_float))
-        max_height = tf.to_int32(tf.ceil(tf.truediv(width, max_width) * self.height_float))
-
-        resized = tf.cond(
-            tf.greater_equal(width, max_width),
-            lambda: tf.cond(
-                tf.less_equal(dims[0], self.height),
-                lambda: tf.to_float(img),
-                lambda: tf.image.resize_images(img, [self.height, max_width],
-                                               method=tf.image.ResizeMethod.BICUBIC),
-            ),
-            lambda: tf.image.resize_images(img, [max_height, width],
-                                           method=tf.image.ResizeMethod.BICUBIC)
-        )
-
-        padded = tf.image.pad_to_bounding_box(resized, 0, 0, self.height, width)
-        return padded
+        return prepare_image(image, self.max_width, self.height, self.channels)
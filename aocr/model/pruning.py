@@ -0,0 +1,107 @@
+"""Gradual magnitude pruning of the weights."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+import tensorflow as tf
+
+
+def prunable_variables(variables=None):
+    """Weight matrices and convolution kernels: the trainable variables of
+    rank 2 or more, except the embeddings."""
+    if variables is None:
+        variables = tf.trainable_variables()
+    return [var for var in variables
+            if var.get_shape().ndims >= 2 and 'embedding' not in var.op.name]
+
+
+def sparsity_schedule(step, num_steps, initial_sparsity, target_sparsity):
+    """Sparsity after `step` of `num_steps` steps of gradual pruning: it rises
+    quickly at first, while there are many small weights, and slowly at the
+    end (Zhu & Gupta, https://arxiv.org/abs/1710.01878)."""
+    progress = min(1., step / max(num_steps, 1))
+    return target_sparsity + (initial_sparsity - target_sparsity) * (1. - progress) ** 3
+
+
+class MagnitudePruning(object):
+    """Masks that keep the pruned weights of `variables` at zero.
+
+    `update_masks` prunes the smallest weights of every variable down to the
+    `sparsity` fed for it, and `apply_masks` zeroes the pruned weights again,
+    to be run after every update of the weights. The masks are local
+    variables: `init_masks` derives them from the zeros of the weights, so
+    that pruned checkpoints resume with their masks, and checkpoints of
+    models trained without pruning load unchanged.
+
+    The step, sparsity and target the pruning started with are saved with
+    the checkpoints in the `state` variables (see `start`), so that an
+    interrupted pruning resumes its schedule where it stopped.
+    """
+
+    def __init__(self, variables):
+        self.variables = list(variables)
+        self.size = sum(var.get_shape().num_elements() for var in self.variables)
+        with tf.variable_scope('pruning'):
+            self.start_step = tf.get_variable('start_step', [], tf.int32, trainable=False,
+                                              initializer=tf.constant_initializer(-1))
+            self.initial_sparsity = tf.get_variable('initial_sparsity', [], tf.float32,
+                                                    trainable=False,
+                                                    initializer=tf.zeros_initializer())
+            self.target_sparsity = tf.get_variable('target_sparsity', [], tf.float32,
+                                                   trainable=False,
+                                                   initializer=tf.zeros_initializer())
+            self.state = [self.start_step, self.initial_sparsity, self.target_sparsity]
+
+            self.sparsity = tf.placeholder(tf.float32, [], name='sparsity')
+            self.masks = [
+                tf.Variable(tf.ones(var.get_shape(), dtype=var.dtype.base_dtype),
+                            trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                            name='mask')
+                for var in self.variables]
+
+            self.init_masks = tf.group(*[
+                tf.assign(mask, tf.cast(tf.not_equal(var, 0.), mask.dtype))
+                for var, mask in zip(self.variables, self.masks)])
+
+            new_masks = []
+            for var, mask in zip(self.variables, self.masks):
+                size = var.get_shape().num_elements()
+                magnitudes = tf.reshape(tf.abs(var), [-1])
+                keep = size - tf.cast(tf.floor(self.sparsity * size), tf.int32)
+                descending = tf.nn.top_k(magnitudes, k=size, sorted=True).values
+                # The largest of the pruned magnitudes, if any weight is pruned.
+                threshold = tf.where(keep < size,
+                                     descending[tf.minimum(keep, size - 1)],
+                                     tf.constant(-1., dtype=var.dtype.base_dtype))
+                new_masks.append(tf.assign(mask, tf.cast(tf.abs(var) > threshold, mask.dtype)))
+            with tf.control_dependencies(new_masks):
+                self.update_masks = self.apply_masks()
+
+            self.nonzero = tf.add_n([tf.count_nonzero(var) for var in self.variables])
+
+    def apply_masks(self):
+        """Op zeroing the pruned weights."""
+        return tf.group(*[tf.assign(var, var * mask)
+                          for var, mask in zip(self.variables, self.masks)])
+
+    def current_sparsity(self, sess):
+        return 1. - sess.run(self.nonzero) / float(self.size)
+
+    def start(self, sess, global_step, target_sparsity):
+        """Return the step and the sparsity the schedule towards
+        `target_sparsity` starts from: those saved in the checkpoint if it
+        was pruned towards the same target, or `global_step` and the
+        current sparsity otherwise."""
+        start_step, initial_sparsity, saved_target = sess.run(self.state)
+        if start_step < 0 or not np.isclose(saved_target, target_sparsity):
+            start_step, initial_sparsity = global_step, self.current_sparsity(sess)
+            for var, value in zip(self.state, (start_step, initial_sparsity, target_sparsity)):
+                var.load(value, sess)
+        return int(start_step), float(initial_sparsity)
+
+
+def variable_sparsity(values):
+    """Fraction of zeros in a dict of weight arrays."""
+    size = sum(value.size for value in values.values())
+    return 1. - sum(np.count_nonzero(value) for value in values.values()) / float(max(size, 1))
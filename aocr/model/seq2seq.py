@@ -108,7 +108,8 @@ def _extract_argmax_and_embed(embedding, output_projection=None,
 def attention_decoder(decoder_inputs, initial_state, attention_states, cell,
                       output_size=None, num_heads=1, loop_function=None,
                       dtype=tf.float32, scope=None,
-                      initial_state_attention=False, attn_num_hidden=128):
+                      initial_state_attention=False, attn_num_hidden=128,
+                      matmul_attention=False, attention_window=0):
     """RNN decoder with attention for the sequence-to-sequence model.
 
     In this context "attention" means that, during decoding, the RNN can look up
@@ -139,6 +140,13 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell,
             If True, initialize the attentions from the initial state and attention
             states -- useful when we wish to resume decoding from a previously
             stored decoder state and attention states.
+        matmul_attention: If True, compute the attention with matrix products
+            over 3D tensors instead of the 1x1 convolution and the broadcast
+            reductions over 4D tensors. The variables and results are the same.
+        attention_window: If positive, every step only attends to the
+            2 * attention_window + 1 positions around the focus of the previous
+            step (the expected position of its attention), starting from the
+            first position. Implies matmul_attention. The variables are the same.
 
     Returns:
         A tuple of the form (outputs, state), where:
@@ -186,12 +194,43 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell,
         for a in xrange(num_heads):
             k = tf.get_variable("AttnW_%d" % a,
                                 [1, 1, attn_size, attention_vec_size])
-            hidden_features.append(tf.nn.conv2d(hidden, k, [1, 1, 1, 1], "SAME"))
+            if matmul_attention or attention_window:
+                # The keys W1 * h_t, projected once for the whole sequence:
+                # [batch_size x attn_length x attention_vec_size].
+                keys = tf.matmul(tf.reshape(attention_states, [-1, attn_size]),
+                                 tf.reshape(k, [attn_size, attention_vec_size]))
+                hidden_features.append(
+                    tf.reshape(keys, [-1, attn_length, attention_vec_size]))
+            else:
+                hidden_features.append(tf.nn.conv2d(hidden, k, [1, 1, 1, 1], "SAME"))
             v.append(tf.get_variable("AttnV_%d" % a,
                                      [attention_vec_size]))
 
+        if attention_window:
+            window_size = min(2 * attention_window + 1, attn_length)
+            window_batch = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, window_size])
+            # Position around which the next window is centered, for every sample.
+            focus = [tf.zeros([batch_size], dtype=tf.int32)]
+
         state = initial_state
 
+        def windowed_attention(query, a):
+            """Attention restricted to the window around the previous focus.
+            Returns the attention read and the weights over all the positions."""
+            y = linear(query, attention_vec_size, True)
+            # The window is kept inside the sequence.
+            start = tf.clip_by_value(focus[0] - attention_window, 0, attn_length - window_size)
+            positions = tf.expand_dims(start, 1) + tf.range(window_size)
+            indices = tf.stack([window_batch, positions], axis=2)
+            keys = tf.gather_nd(hidden_features[a], indices)
+            s = tf.tensordot(tf.tanh(keys + tf.expand_dims(y, 1)), v[a], [[2], [0]])
+            weights = tf.nn.softmax(s)
+            d = tf.squeeze(tf.matmul(tf.expand_dims(weights, 1),
+                                     tf.gather_nd(attention_states, indices)), [1])
+            focus[0] = tf.stop_gradient(tf.cast(tf.round(
+                tf.reduce_sum(weights * tf.cast(positions, dtype), 1)), tf.int32))
+            return d, tf.scatter_nd(indices, weights, tf.stack([batch_size, attn_length]))
+
         # MODIFIED: return both context vector and attention weights
         def attention(query):
             """Put attention masks on hidden using hidden_features and query."""
@@ -201,18 +240,31 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell,
             ds = []  # Results of attention reads will be stored here.
             for a in xrange(num_heads):
                 with tf.variable_scope("Attention_%d" % a):
+                    if attention_window:
+                        d, ss = windowed_attention(query, a)
+                        ds.append(d)
+                        continue
                     y = linear(query, attention_vec_size, True)
-                    y = tf.reshape(y, [-1, 1, 1, attention_vec_size])
-                    # Attention mask is a softmax of v^T * tanh(...).
-                    s = tf.reduce_sum(v[a] * tf.tanh(hidden_features[a] + y), [2, 3])
+                    if matmul_attention:
+                        # Contract [batch_size x attn_length x attention_vec_size]
+                        # with v, and compute d with a batched matmul.
+                        s = tf.tensordot(tf.tanh(hidden_features[a] + tf.expand_dims(y, 1)),
+                                         v[a], [[2], [0]])
+                    else:
+                        y = tf.reshape(y, [-1, 1, 1, attention_vec_size])
+                        # Attention mask is a softmax of v^T * tanh(...).
+                        s = tf.reduce_sum(v[a] * tf.tanh(hidden_features[a] + y), [2, 3])
                     a = tf.nn.softmax(s)
                     ss = a
                     # a = tf.Print(a, [a], message="a: ",summarize=30)
                     # Now calculate the attention-weighted vector d.
-                    d = tf.reduce_sum(
-                        tf.reshape(a, [-1, attn_length, 1, 1]) * hidden,
-                        [1, 2]
-                    )
+                    if matmul_attention:
+                        d = tf.squeeze(tf.matmul(tf.expand_dims(a, 1), attention_states), [1])
+                    else:
+                        d = tf.reduce_sum(
+                            tf.reshape(a, [-1, attn_length, 1, 1]) * hidden,
+                            [1, 2]
+                        )
                     ds.append(tf.reshape(d, [-1, attn_size]))
             # MODIFIED DELETED return ds
             # MODIFIED ADD START
@@ -283,7 +335,9 @@ def embedding_attention_decoder(decoder_inputs, initial_state, attention_states,
                                 update_embedding_for_previous=True,
                                 dtype=tf.float32, scope=None,
                                 initial_state_attention=False,
-                                attn_num_hidden=128):
+                                attn_num_hidden=128,
+                                matmul_attention=False,
+                                attention_window=0):
     """RNN decoder with embedding and attention and a pure-decoding option.
 
     Args:
@@ -317,6 +371,10 @@ def embedding_attention_decoder(decoder_inputs, initial_state, attention_states,
             If True, initialize the attentions from the initial state and attention
             states -- useful when we wish to resume decoding from a previously
             stored decoder state and attention states.
+        matmul_attention: Whether to compute the attention with matrix products,
+            see attention_decoder.
+        attention_window: Number of positions attended to on each side of the
+            previous focus, or 0 to attend to all of them, see attention_decoder.
 
     Returns:
         A tuple of the form (outputs, state), where:
@@ -346,7 +404,8 @@ def embedding_attention_decoder(decoder_inputs, initial_state, attention_states,
         return attention_decoder(
             emb_inp, initial_state, attention_states, cell, output_size=output_size,
             num_heads=num_heads, loop_function=loop_function,
-            initial_state_attention=initial_state_attention, attn_num_hidden=attn_num_hidden)
+            initial_state_attention=initial_state_attention, attn_num_hidden=attn_num_hidden,
+            matmul_attention=matmul_attention, attention_window=attention_window)
 
 
 def sequence_loss_by_example(logits, targets, weights,
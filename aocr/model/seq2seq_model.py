@@ -26,6 +26,88 @@ from .seq2seq import model_with_buckets
 from .seq2seq import embedding_attention_decoder
 
 
+# Name of the variable scope of `BasicLSTMCell`, which the fused cells reuse
+# so that checkpoints are interchangeable: the block kernels use the same
+# ``[input + hidden, 4 * hidden]`` kernel, with the same gate order.
+LSTM_SCOPE = 'basic_lstm_cell'
+
+
+class ConcatStateLSTMBlockCell(object):
+    """`LSTMBlockCell` whose state is the concatenation of ``c`` and ``h``, like
+    `BasicLSTMCell` with ``state_is_tuple=False``, and with the same variables."""
+
+    def __init__(self, num_units, forget_bias=0.0):
+        self._num_units = num_units
+        self._cell = tf.contrib.rnn.LSTMBlockCell(num_units, forget_bias=forget_bias,
+                                                  name=LSTM_SCOPE)
+
+    @property
+    def state_size(self):
+        return 2 * self._num_units
+
+    @property
+    def output_size(self):
+        return self._num_units
+
+    def zero_state(self, batch_size, dtype):
+        return tf.zeros(tf.stack([batch_size, self.state_size]), dtype=dtype)
+
+    def __call__(self, inputs, state, scope=None):
+        c, h = tf.split(value=state, num_or_size_splits=2, axis=1)
+        output, new_state = self._cell(inputs, tf.contrib.rnn.LSTMStateTuple(c, h))
+        return output, tf.concat([new_state.c, new_state.h], 1)
+
+
+def fused_bidirectional_rnn(num_hidden, inputs, forget_bias=0.0):
+    """Bidirectional LSTM over a list of ``[batch, depth]`` inputs, computed by
+    two fused kernels on the time-major stack of the inputs.
+
+    Returns the same values, and creates the same variables, as
+    `static_bidirectional_rnn` with `BasicLSTMCell`s with
+    ``state_is_tuple=False``: the list of concatenated forward and backward
+    outputs, and the forward and backward states.
+    """
+    time_major = tf.stack(inputs)
+    with tf.variable_scope('bidirectional_rnn'):
+        with tf.variable_scope('fw'):
+            fw_cell = tf.contrib.rnn.LSTMBlockFusedCell(num_hidden, forget_bias=forget_bias,
+                                                        name=LSTM_SCOPE)
+            outputs_fw, state_fw = fw_cell(time_major, dtype=tf.float32)
+        with tf.variable_scope('bw'):
+            bw_cell = tf.contrib.rnn.TimeReversedFusedRNN(
+                tf.contrib.rnn.LSTMBlockFusedCell(num_hidden, forget_bias=forget_bias,
+                                                  name=LSTM_SCOPE))
+            outputs_bw, state_bw = bw_cell(time_major, dtype=tf.float32)
+
+    outputs = tf.unstack(tf.concat([outputs_fw, outputs_bw], 2))
+    return (outputs,
+            tf.concat([state_fw.c, state_fw.h], 1),
+            tf.concat([state_bw.c, state_bw.h], 1))
+
+
+def bidirectional_encoder(inputs, num_hidden, fused_lstm=False):
+    """Bidirectional LSTM encoder over a list of ``[batch, depth]`` inputs.
+
+    Returns the list of concatenated forward and backward outputs, and the
+    forward and backward states; see `fused_bidirectional_rnn` for
+    `fused_lstm`.
+    """
+    if fused_lstm:
+        return fused_bidirectional_rnn(num_hidden, inputs)
+
+    lstm_fw_cell = tf.contrib.rnn.BasicLSTMCell(
+        num_hidden, forget_bias=0.0, state_is_tuple=False
+    )
+    # Backward direction cell
+    lstm_bw_cell = tf.contrib.rnn.BasicLSTMCell(
+        num_hidden, forget_bias=0.0, state_is_tuple=False
+    )
+    return tf.contrib.rnn.static_bidirectional_rnn(
+        lstm_fw_cell, lstm_bw_cell, inputs,
+        initial_state_fw=None, initial_state_bw=None,
+        dtype=tf.float32, sequence_length=None, scope=None)
+
+
 class Seq2SeqModel(object):
     """Sequence-to-sequence model with attention and for multiple buckets.
     This class implements a multi-layer recurrent neural network as encoder,
@@ -49,7 +131,10 @@ class Seq2SeqModel(object):
                  attn_num_layers,
                  attn_num_hidden,
                  forward_only,
-                 use_gru):
+                 use_gru,
+                 fused_lstm=False,
+                 matmul_attention=False,
+                 attention_window=0):
         """Create the model.
 
         Args:
@@ -68,6 +153,14 @@ class Seq2SeqModel(object):
           use_lstm: if true, we use LSTM cells instead of GRU cells.
           num_samples: number of samples for sampled softmax.
           forward_only: if set, we do not construct the backward pass in the model.
+          fused_lstm: if set, use the block LSTM kernels: a fused time-major
+            bidirectional encoder, and `LSTMBlockCell` in the decoder. The
+            variables are the same as without it.
+          matmul_attention: if set, compute the attention with batched matmuls,
+            with the keys projected once per image. The variables are the same.
+          attention_window: if positive, every decoder step only attends to
+            that many encoder positions on each side of the previous focus.
+            The variables are the same.
         """
         self.encoder_inputs_tensor = encoder_inputs_tensor
         self.decoder_inputs = decoder_inputs
@@ -77,9 +170,12 @@ class Seq2SeqModel(object):
         self.encoder_masks = encoder_masks
 
         # Create the internal multi-layer cell for our RNN.
-        single_cell = tf.contrib.rnn.BasicLSTMCell(
-            attn_num_hidden, forget_bias=0.0, state_is_tuple=False
-        )
+        if fused_lstm:
+            single_cell = ConcatStateLSTMBlockCell(attn_num_hidden, forget_bias=0.0)
+        else:
+            single_cell = tf.contrib.rnn.BasicLSTMCell(
+                attn_num_hidden, forget_bias=0.0, state_is_tuple=False
+            )
         if use_gru:
             print("using GRU CELL in decoder")
             single_cell = tf.contrib.rnn.GRUCell(attn_num_hidden)
@@ -94,20 +190,9 @@ class Seq2SeqModel(object):
         def seq2seq_f(lstm_inputs, decoder_inputs, seq_length, do_decode):
 
             num_hidden = attn_num_layers * attn_num_hidden
-            lstm_fw_cell = tf.contrib.rnn.BasicLSTMCell(
-                num_hidden, forget_bias=0.0, state_is_tuple=False
-            )
-            # Backward direction cell
-            lstm_bw_cell = tf.contrib.rnn.BasicLSTMCell(
-                num_hidden, forget_bias=0.0, state_is_tuple=False
-            )
-
             (pre_encoder_inputs,
              output_state_fw,
-             output_state_bw) = tf.contrib.rnn.static_bidirectional_rnn(
-                 lstm_fw_cell, lstm_bw_cell, lstm_inputs,
-                 initial_state_fw=None, initial_state_bw=None,
-                 dtype=tf.float32, sequence_length=None, scope=None)
+             output_state_bw) = bidirectional_encoder(lstm_inputs, num_hidden, fused_lstm)
 
             encoder_inputs = [e*f for e, f in zip(pre_encoder_inputs, encoder_masks[:seq_length])]
             top_states = [tf.reshape(e, [-1, 1, num_hidden*2])
@@ -123,7 +208,9 @@ class Seq2SeqModel(object):
                 output_projection=None,
                 feed_previous=do_decode,
                 initial_state_attention=False,
-                attn_num_hidden=attn_num_hidden)
+                attn_num_hidden=attn_num_hidden,
+                matmul_attention=matmul_attention,
+                attention_window=attention_window)
             return outputs, attention_weights_history
 
         # Our targets are decoder inputs shifted by one.
@@ -0,0 +1,264 @@
+"""
+Reading images from tar and zip archives without extracting them.
+
+Members of zip files and uncompressed tar files are read in place, by
+offset. Compressed tar files cannot be accessed randomly, so their members
+are streamed sequentially, in the order they are stored in the archive.
+"""
+
+from __future__ import absolute_import
+
+import os
+import tarfile
+import zipfile
+
+
+def member_name(path):
+    """Normalize an annotation path or a member name for lookups."""
+    while path.startswith('./'):
+        path = path[2:]
+    return path.lstrip('/')
+
+
+def is_archive(path):
+    """Whether `path` is a zip file or a (possibly compressed) tar file."""
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+def is_streamed(path):
+    """Whether the archive is a compressed tar file, which can only be read sequentially."""
+    if zipfile.is_zipfile(path):
+        return False
+    try:
+        tarfile.open(path, 'r:').close()
+    except tarfile.ReadError:
+        return True
+    return False
+
+
+class LooseFiles(object):
+    """Images stored as individual files, with the interface of `Archive`."""
+
+    random_access = True
+
+    @staticmethod
+    def read(name):
+        with open(name, 'rb') as img_file:
+            return img_file.read()
+
+    def read_many(self, items, name=lambda item: item):
+        for item in items:
+            try:
+                yield item, self.read(name(item)), None
+            except IOError as e:
+                yield item, None, e
+
+    def close(self):
+        pass
+
+
+class Archive(object):
+    """Read-only access to the regular files of a tar or zip archive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = None
+        self.file = None
+        self.index = None
+
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            self.index = dict((member_name(info.filename), info)
+                              for info in self.zip.infolist() if not info.is_dir())
+            return
+
+        try:
+            tar = tarfile.open(path, 'r:')
+        except tarfile.ReadError:
+            # Compressed: only sequential reads are possible.
+            return
+        self.index = {}
+        with tar:
+            member = tar.next()
+            while member is not None:
+                if member.isfile():
+                    self.index[member_name(member.name)] = (member.offset_data, member.size)
+                # Do not keep millions of headers around.
+                tar.members = []
+                member = tar.next()
+        self.file = open(path, 'rb')
+
+    @property
+    def random_access(self):
+        return self.index is not None
+
+    def read(self, name):
+        """Read a member; raises IOError if it is not in the archive."""
+        if not self.random_access:
+            raise IOError('Cannot read members of compressed tar archive {} by name.'.format(
+                self.path))
+        entry = self.index.get(member_name(name))
+        if entry is None:
+            raise IOError('No member {} in archive {}.'.format(name, self.path))
+        if self.zip is not None:
+            return self.zip.read(entry)
+        offset, size = entry
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def members(self, names=None):
+        """Yield ``(name, data)`` for every regular file, in archive order.
+
+        With `names`, normalized member names (see `member_name`), only the
+        data of these members is read, and the archive no further than the
+        last of them.
+        """
+        remaining = None if names is None else set(names)
+
+        def wanted(name):
+            if remaining is None:
+                return True
+            if member_name(name) not in remaining:
+                return False
+            remaining.discard(member_name(name))
+            return True
+
+        if self.zip is not None:
+            for info in self.zip.infolist():
+                if remaining is not None and not remaining:
+                    return
+                if not info.is_dir() and wanted(info.filename):
+                    yield info.filename, self.zip.read(info)
+            return
+        with tarfile.open(self.path, 'r|*') as tar:
+            member = tar.next()
+            while member is not None and (remaining is None or remaining):
+                # The data of the members that are not read is skipped over.
+                if member.isfile() and wanted(member.name):
+                    yield member.name, tar.extractfile(member).read()
+                tar.members = []
+                member = tar.next()
+
+    def read_many(self, items, name=lambda item: item):
+        for item in items:
+            try:
+                yield item, self.read(name(item)), None
+            except IOError as e:
+                yield item, None, e
+
+    def close(self):
+        pass
+
+
+class Archive(object):
+    """Read-only access to the regular files of a tar or zip archive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = None
+        self.file = None
+        self.index = None
+
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            self.index = dict((member_name(info.filename), info)
+                              for info in self.zip.infolist() if not info.is_dir())
+            return
+
+        try:
+            tar = tarfile.open(path, 'r:')
+        except tarfile.ReadError:
+            # Compressed: only sequential reads are possible.
+            return
+        self.index = {}
+        with tar:
+            member = tar.next()
+            while member is not None:
+                if member.isfile():
+                    self.index[member_name(member.name)] = (member.offset_data, member.size)
+                # Do not keep millions of headers around.
+                tar.members = []
+                member = tar.next()
+        self.file = open(path, 'rb')
+
+    @property
+    def random_access(self):
+        return self.index is not None
+
+    def read(self, name):
+        """Read a member; raises IOError if it is not in the archive."""
+        if not self.random_access:
+            raise IOError('Cannot read members of compressed tar archive {} by name.'.format(
+                self.path))
+        entry = self.index.get(member_name(name))
+        if entry is None:
+            raise IOError('No member {} in archive {}.'.format(name, self.path))
+        if self.zip is not None:
+            return self.zip.read(entry)
+        offset, size = entry
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def members(self, names=None):
+        """Yield ``(name, data)`` for every regular file, in archive order.
+
+        With `names`, a collection of normalized member names (see
+        `member_name`), only those members are read, and the archive is
+        read no further than the last of them.
+        """
+        remaining = None if names is None else set(names)
+        if self.zip is not None:
+            for info in self.zip.infolist():
+                if remaining is not None and not remaining:
+                    return
+                if info.is_dir():
+                    continue
+                if remaining is not None:
+                    if member_name(info.filename) not in remaining:
+                        continue
+                    remaining.discard(member_name(info.filename))
+                yield info.filename, self.zip.read(info)
+            return
+        with tarfile.open(self.path, 'r|*') as tar:
+            member = tar.next()
+            while member is not None and (remaining is None or remaining):
+                if member.isfile() and (remaining is None
+                                        or member_name(member.name) in remaining):
+                    if remaining is not None:
+                        remaining.discard(member_name(member.name))
+                    yield member.name, tar.extractfile(member).read()
+                # Skipping a member only reads past its data, without keeping it.
+                tar.members = []
+                member = tar.next()
+
+    def read_many(self, items, name=lambda item: item):
+        """Yield ``(item, data, error)`` for each item, reading the member
+        named `name(item)`; `error` is an IOError if it cannot be read.
+
+        Items are yielded in their own order when the archive allows random
+        access, and in archive order otherwise, with missing members last.
+        """
+        if self.random_access:
+            for item in items:
+                try:
+                    yield item, self.read(name(item)), None
+                except IOError as e:
+                    yield item, None, e
+            return
+
+        pending = {}
+        for item in items:
+            pending.setdefault(member_name(name(item)), []).append(item)
+        for member, data in self.members(names=list(pending)):
+            for item in pending.pop(member_name(member), ()):
+                yield item, data, None
+        for missing in pending.values():
+            for item in missing:
+                yield item, None, IOError('No member {} in archive {}.'.format(
+                    name(item), self.path))
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,170 @@
+"""
+Compact dumps of the attention weights of an evaluation, for offline analysis.
+
+A dump is a directory holding, in chunks of a fixed number of samples,
+NumPy arrays that can be memory-mapped:
+
+* ``attentions-NNNNN.npy``: float32 ``[samples, decoder steps, encoder steps]``
+* ``images-NNNNN.npy``: uint8 ``[samples, height, width, channels]``, the model inputs
+
+along with ``index.tsv``, which lists for every sample its chunk and row, its
+probability, whether it is a mistake, the prediction, the label and the
+comment, and ``meta.json``, which describes the dump.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import csv
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+from PIL import Image
+
+
+INDEX_COLUMNS = ('sample', 'chunk', 'row', 'probability', 'incorrect',
+                 'prediction', 'ground', 'comment')
+
+
+def _chunk_path(path, name, chunk):
+    return os.path.join(path, '{}-{:05d}.npy'.format(name, chunk))
+
+
+class AttentionDumpWriter(object):
+    """Streams the attentions and inputs of evaluated batches into a dump at `path`."""
+
+    def __init__(self, path, chunk_size=4096):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.samples = 0
+        self.chunks = 0
+        self.attentions = []
+        self.images = []
+        self.index_file = open(os.path.join(path, 'index.tsv'), 'w')
+        self.index = csv.writer(self.index_file, delimiter='\t', lineterminator='\n')
+        self.index.writerow(INDEX_COLUMNS)
+
+    def add_batch(self, attentions, images, predictions, grounds, probabilities, incorrect,
+                  comments):
+        """Add a batch: `attentions` is ``[batch, decoder steps, encoder steps]``
+        and `images` the ``[batch, height, width, channels]`` model inputs."""
+        images = np.clip(np.round(images), 0, 255).astype(np.uint8)
+        for idx in range(len(predictions)):
+            # Chunks are only written once full, possibly after this batch.
+            chunk, row = divmod(self.samples, self.chunk_size)
+            self.index.writerow((self.samples, chunk, row,
+                                 '{:.6f}'.format(probabilities[idx]),
+                                 '{:.6g}'.format(incorrect[idx]),
+                                 predictions[idx], grounds[idx], comments[idx]))
+            self.samples += 1
+
+        # Split the arrays along the chunk boundaries.
+        start = 0
+        while start < len(predictions):
+            buffered = sum(len(chunk) for chunk in self.attentions)
+            end = min(len(predictions), start + self.chunk_size - buffered)
+            self.attentions.append(attentions[start:end])
+            self.images.append(images[start:end])
+            if buffered + end - start == self.chunk_size:
+                self._flush()
+            start = end
+
+    def _flush(self):
+        if not self.attentions:
+            return
+        np.save(_chunk_path(self.path, 'attentions', self.chunks),
+                np.concatenate(self.attentions).astype(np.float32))
+        np.save(_chunk_path(self.path, 'images', self.chunks), np.concatenate(self.images))
+        self.attentions, self.images = [], []
+        self.chunks += 1
+
+    def close(self):
+        self._flush()
+        self.index_file.close()
+        with open(os.path.join(self.path, 'meta.json'), 'w') as meta:
+            json.dump({'samples': self.samples, 'chunks': self.chunks,
+                       'chunk_size': self.chunk_size}, meta)
+        logging.info('Attention dump of %i samples written to %s.', self.samples, self.path)
+
+
+class AttentionDump(object):
+    """Reads a dump written by `AttentionDumpWriter`; chunks are memory-mapped on demand."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as meta:
+            self.meta = json.load(meta)
+        with open(os.path.join(path, 'index.tsv'), 'r') as index_file:
+            self.index = list(csv.DictReader(index_file, delimiter='\t'))
+        self._chunks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def chunk(self, chunk):
+        """``(attentions, images)`` arrays of a chunk."""
+        if chunk not in self._chunks:
+            self._chunks[chunk] = (
+                np.load(_chunk_path(self.path, 'attentions', chunk), mmap_mode='r'),
+                np.load(_chunk_path(self.path, 'images', chunk), mmap_mode='r'))
+        return self._chunks[chunk]
+
+    def attentions(self, sample):
+        entry = self.index[sample]
+        return self.chunk(int(entry['chunk']))[0][int(entry['row'])]
+
+    def select(self, mistakes=False, lowest=0):
+        """Indexes of the mistakes, or of the `lowest` least probable samples, or all of them."""
+        samples = range(len(self))
+        if mistakes:
+            samples = [sample for sample in samples if float(self.index[sample]['incorrect'])]
+        if lowest:
+            samples = sorted(samples, key=lambda sample: float(self.index[sample]['probability']))
+            samples = sorted(samples[:lowest])
+        return list(samples)
+
+    def render(self, output_dir, samples=None, threshold=0.5):
+        """Render the attention of the given samples (all by default) into
+        ``<output_dir>/<sample>.png``: the model input followed by one row per
+        predicted character, highlighting where the model looked.
+
+        Whole chunks are processed at once with array operations.
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        samples = range(len(self)) if samples is None else samples
+
+        by_chunk = {}
+        for sample in samples:
+            entry = self.index[sample]
+            by_chunk.setdefault(int(entry['chunk']), []).append((sample, int(entry['row'])))
+
+        for chunk, entries in sorted(by_chunk.items()):
+            attentions, images = self.chunk(chunk)
+            rows = [row for _, row in entries]
+            attns = np.array(attentions[rows], dtype=np.float32)
+            imgs = np.array(images[rows], dtype=np.float32)
+
+            # Normalize every step and keep the strongest weights, like `--visualize`.
+            attns /= np.maximum(attns.max(axis=-1, keepdims=True), 1e-12)
+            attns[attns < threshold] = 0
+
+            # Spread every encoder step over its columns of the model input.
+            width = imgs.shape[2]
+            scale = int(math.ceil(width / attns.shape[-1]))
+            masks = np.repeat(attns, scale, axis=-1)[..., :width]
+            frames = imgs[:, np.newaxis] * np.maximum(masks, 0.3)[:, :, np.newaxis, :, np.newaxis]
+            strips = np.concatenate([imgs[:, np.newaxis], frames], axis=1).astype(np.uint8)
+
+            for (sample, _), strip in zip(entries, strips):
+                steps = len(self.index[sample]['prediction'])
+                strip = strip[:steps + 1].reshape((-1,) + strip.shape[2:])
+                if strip.shape[-1] == 1:
+                    strip = strip[..., 0]
+                Image.fromarray(strip).save(os.path.join(output_dir, '{:08d}.png'.format(sample)))
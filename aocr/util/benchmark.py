@@ -0,0 +1,195 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from ..model.cnn import CNN
+from ..model.model import Model
+from .bucketdata import BucketData
+from .data_gen import DataGen, resized_max_width
+
+
+# Model variants that `model_throughput` can compare to the given model
+# parameters, as overrides of those parameters.
+MODEL_VARIANTS = {
+    'fused-lstm': {'fused_lstm': True},
+    'matmul-attention': {'matmul_attention': True},
+    'windowed-attention': {'attention_window': 6},
+    'separable': {'backbone': 'separable'},
+    'half-width': {'width_multiplier': 0.5},
+    'separable-half-width': {'backbone': 'separable', 'width_multiplier': 0.5},
+    'ctc': {'head': 'ctc'},
+}
+
+# Variants with the same variables and results as the model they override:
+# they are run with the weights of the baseline, and their outputs are
+# compared to its outputs.
+EQUIVALENT_VARIANTS = ('fused-lstm', 'matmul-attention')
+
+
+def input_throughput(data_path, batch_size, num_batches=0, max_width=160, max_height=60,
+                     max_prediction=8, channels=1, shuffle_buffer_size=10000,
+                     num_parallel_reads=1, num_parallel_calls=1):
+    """Measure how fast the training input pipeline produces batches from a dataset.
+
+    Reads `num_batches` batches, or the whole dataset if `num_batches` is 0,
+    and logs the on-disk size of the dataset and the samples/s rate.
+    """
+    image_width = resized_max_width(max_width, max_height, DataGen.IMAGE_HEIGHT)
+    buckets = [(int(math.ceil(image_width / 4)), max_prediction + 2)]
+
+    s_gen = DataGen(
+        data_path,
+        buckets,
+        epochs=1,
+        max_width=max_width,
+        shuffle_buffer_size=shuffle_buffer_size,
+        num_parallel_reads=num_parallel_reads,
+        num_parallel_calls=num_parallel_calls,
+        image_width=image_width,
+        channels=channels
+    )
+
+    total_bytes = sum(tf.gfile.Stat(path).length for path in s_gen.filenames)
+    compression = sorted(set(ctype or 'none' for ctype in s_gen.compression_types))
+    logging.info('Dataset: %i file(s), %.1f MB, compression: %s.',
+                 len(s_gen.filenames), total_bytes / 1e6, ', '.join(compression))
+
+    samples = 0
+    batches = 0
+    start_time = time.time()
+    for batch in s_gen.gen(batch_size):
+        batches += 1
+        samples += len(batch['labels'])
+        if batches == num_batches:
+            break
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    logging.info('Read %i batches (%i samples) in %.2fs: %.1f samples/s.',
+                 batches, samples, elapsed, samples / elapsed)
+    if not num_batches or batches < num_batches:
+        logging.info('Full pass over the dataset: %.1f MB/s read from storage.',
+                     total_bytes / 1e6 / elapsed)
+
+    return samples / elapsed
+
+
+def synthetic_batch(model, batch_size, seed=0):
+    """A batch of random preprocessed images and labels of the maximum length
+    for `model`, in the format of `DataGen.gen`."""
+    rng = np.random.RandomState(seed)
+    bucket = BucketData(capacity=batch_size, decoder_input_len=model.decoder_size)
+    for _ in range(batch_size):
+        label = rng.randint(DataGen.EOS_ID + 1, len(model.charmap),
+                            size=model.decoder_size - 2)
+        word = np.concatenate([[DataGen.GO_ID], label, [DataGen.EOS_ID]]).astype(np.int32)
+        bucket.append(None, word, b'', b'')
+    batch = bucket.flush_out(model.buckets, go_shift=1)
+    batch['data'] = rng.uniform(0, 255, size=(batch_size, DataGen.IMAGE_HEIGHT,
+                                              model.max_width, model.channels)).astype(np.float32)
+    batch['preprocessed'] = True
+    return batch
+
+
+def cnn_flops(image_width, channels, backbone='vgg', width_multiplier=1.0):
+    """Floating point operations of the CNN backbone for a single image."""
+    with tf.Graph().as_default() as graph:
+        images = tf.placeholder(tf.float32, [1, DataGen.IMAGE_HEIGHT, image_width, channels])
+        CNN(images, False, backbone=backbone, width_multiplier=width_multiplier)
+        options = tf.profiler.ProfileOptionBuilder(
+            tf.profiler.ProfileOptionBuilder.float_operation()).with_empty_output().build()
+        return tf.profiler.profile(graph, options=options).total_float_ops
+
+
+def time_steps(model, batch, forward_only, num_steps, warmup):
+    """Average time of a step of `model` on `batch`, after `warmup` steps."""
+    for _ in range(warmup):
+        model.step(batch, forward_only)
+    start_time = time.time()
+    for _ in range(num_steps):
+        model.step(batch, forward_only)
+    return (time.time() - start_time) / num_steps
+
+
+def model_throughput(model_params, variants=(), batch_size=64, num_steps=20, warmup=3,
+                     widths=None):
+    """Measure the training and inference step times of the model described by
+    `model_params` (keyword arguments of `Model`, except the session), and of
+    each of the `variants` (names of `MODEL_VARIANTS`), on synthetic batches,
+    for each of the maximum image `widths` (by default, that of `model_params`),
+    along with their number of parameters and the FLOPs of their backbone.
+
+    Every configuration is built in its own graph, with freshly initialized
+    weights, except that the inference of `EQUIVALENT_VARIANTS` restores the
+    weights of the baseline, and reports the largest difference between its
+    output probabilities and those of the baseline. Logs a table and returns
+    a list of ``(width, name, train seconds per step, inference seconds per
+    step, difference, parameters, backbone FLOPs per image)``, the difference
+    being None if not compared.
+    """
+    widths = widths or [model_params['max_image_width']]
+    configurations = [('baseline', {})] + [(name, MODEL_VARIANTS[name]) for name in variants]
+    work_dir = tempfile.mkdtemp(prefix='aocr-benchmark-')
+    results = []
+    try:
+        for width in widths:
+            baseline_path = os.path.join(work_dir, 'baseline-{}.ckpt'.format(width))
+            baseline_probabilities = None
+            for name, overrides in configurations:
+                times = []
+                difference = None
+                for phase in ('train', 'test'):
+                    checkpoint_path = None
+                    if phase == 'test' and name in EQUIVALENT_VARIANTS:
+                        checkpoint_path = baseline_path
+                    with tf.Graph().as_default(), \
+                            tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+                        params = dict(model_params, phase=phase, max_image_width=width,
+                                      model_dir=os.path.join(
+                                          work_dir, '{}-{}-{}'.format(name, width, phase)),
+                                      batch_size=batch_size, load_model=False, visualize=False,
+                                      steps_per_checkpoint=0, checkpoint_path=checkpoint_path)
+                        params.update(overrides)
+                        model = Model(session=sess, **params)
+                        if model.metrics is not None:
+                            sess.run(model.metrics.reset)
+                        batch = synthetic_batch(model, batch_size)
+                        times.append(time_steps(model, batch, phase == 'test',
+                                                num_steps, warmup))
+
+                        if phase == 'test':
+                            num_params = sum(int(np.prod(var.get_shape().as_list()))
+                                             for var in tf.trainable_variables())
+                            flops = cnn_flops(model.max_width, model.channels,
+                                              params.get('backbone', 'vgg'),
+                                              params.get('width_multiplier', 1.0))
+
+                        if phase == 'test' and name == 'baseline':
+                            model.saver_all.save(sess, baseline_path)
+                            baseline_probabilities = model.step(batch, True)['probability']
+                        elif checkpoint_path:
+                            probabilities = model.step(batch, True)['probability']
+                            difference = float(
+                                np.max(np.abs(probabilities - baseline_probabilities)))
+                results.append((width, name, times[0], times[1], difference, num_params, flops))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    logging.info('%6s %-20s %9s %10s %14s %15s %14s %15s %10s', 'width', 'variant', 'params',
+                 'CNN MFLOPs', 'train ms/step', 'train samples/s', 'infer ms/step',
+                 'infer samples/s', 'max |dp|')
+    for width, name, train_time, test_time, difference, num_params, flops in results:
+        logging.info('%6i %-20s %8.2fM %10.1f %14.1f %15.1f %14.1f %15.1f %10s', width, name,
+                     num_params / 1e6, flops / 1e6,
+                     1000. * train_time, batch_size / train_time,
+                     1000. * test_time, batch_size / test_time,
+                     '-' if difference is None else '{:.2e}'.format(difference))
+    return results
@@ -4,72 +4,137 @@ import numpy as np
 
 
 class BucketData(object):
-    def __init__(self):
-        self.data_list = []
-        self.label_list = []
-        self.label_list_plain = []
-        self.comment_list = []
+    """Accumulates samples and assembles them into a batch.
+
+    When `capacity` is set, the bucket keeps fixed-size buffers that are
+    reused between flushes instead of growing and clearing lists: arrays
+    returned by `flush_out` are views into those buffers and stay valid only
+    until the next call to `flush_out`.
+    """
+
+    def __init__(self, capacity=None, decoder_input_len=None):
+        self.capacity = capacity
+        self.decoder_input_len = decoder_input_len
+        self.size = 0
+
+        if capacity is None:
+            self.data_list = []
+            self.label_list = []
+            self.label_list_plain = []
+            self.comment_list = []
+        else:
+            self.data_list = np.empty(capacity, dtype=object)
+            self.label_list = [None] * capacity
+            self.label_list_plain = [None] * capacity
+            self.comment_list = [None] * capacity
+
+        self._decoder_inputs = None
+        self._target_weights = None
+        if capacity is not None and decoder_input_len is not None:
+            self._allocate(decoder_input_len)
+
+    def _allocate(self, decoder_input_len):
+        # Time-major buffers: row `t` holds the batch column for decoder step `t`.
+        rows = self.capacity if self.capacity is not None else self.size
+        self.decoder_input_len = decoder_input_len
+        self._decoder_inputs = np.zeros((decoder_input_len, rows), dtype=np.int32)
+        self._target_weights = np.zeros((decoder_input_len, rows), dtype=np.float32)
+        self._positions = np.arange(decoder_input_len, dtype=np.int32)
 
     def append(self, datum, label, label_plain, comment):
-        self.data_list.append(datum)
-        self.label_list.append(label)
-        self.label_list_plain.append(label_plain)
-        self.comment_list.append(comment)
-
-        return len(self.data_list)
+        if self.capacity is None:
+            self.data_list.append(datum)
+            self.label_list.append(label)
+            self.label_list_plain.append(label_plain)
+            self.comment_list.append(comment)
+        else:
+            if self.size >= self.capacity:
+                raise IndexError('BucketData is full ({} samples)'.format(self.capacity))
+            self.data_list[self.size] = datum
+            self.label_list[self.size] = label
+            self.label_list_plain[self.size] = label_plain
+            self.comment_list[self.size] = comment
+        self.size += 1
+
+        return self.size
 
     def flush_out(self, bucket_specs, valid_target_length=float('inf'),
                   go_shift=1):
-        # print self.max_width, self.max_label_len
+        """Assemble the samples into a batch and clear the bucket.
+
+        With a fixed capacity, ``res['data']`` is an object array holding one
+        datum per sample, rather than an array built from the data, so the
+        data of a sample is ``res['data'][idx]``.
+        """
         res = {}
+        num_samples = self.size
 
         decoder_input_len = bucket_specs[0][1]
+        if (self._decoder_inputs is None
+                or self.decoder_input_len != decoder_input_len
+                or self._decoder_inputs.shape[1] < num_samples):
+            self._allocate(decoder_input_len)
 
         # ENCODER PART
-        res['data'] = np.array(self.data_list)
-        res['labels'] = self.label_list_plain
-        res['comments'] = self.comment_list
+        if self.capacity is None:
+            res['data'] = np.array(self.data_list)
+        else:
+            res['data'] = self.data_list[:num_samples]
+        res['labels'] = self.label_list_plain[:num_samples]
+        res['comments'] = self.comment_list[:num_samples]
 
         # DECODER PART
-        target_weights = []
-        for l_idx in range(len(self.label_list)):
-            label_len = len(self.label_list[l_idx])
-            if label_len <= decoder_input_len:
-                self.label_list[l_idx] = np.concatenate((
-                    self.label_list[l_idx],
-                    np.zeros(decoder_input_len - label_len, dtype=np.int32)))
-                one_mask_len = min(label_len - go_shift, valid_target_length)
-                target_weights.append(np.concatenate((
-                    np.ones(one_mask_len, dtype=np.float32),
-                    np.zeros(decoder_input_len - one_mask_len,
-                             dtype=np.float32))))
-            else:
-                raise NotImplementedError
-
-        res['decoder_inputs'] = [a.astype(np.int32) for a in
-                                 np.array(self.label_list).T]
-        res['target_weights'] = [a.astype(np.float32) for a in
-                                 np.array(target_weights).T]
+        labels = self.label_list[:num_samples]
+        label_lens = np.fromiter((len(label) for label in labels),
+                                 dtype=np.int32, count=num_samples)
+        if num_samples and label_lens.max() > decoder_input_len:
+            raise NotImplementedError
+
+        # Write all the labels into the padded buffer in a single pass: the
+        # mask selects, row by row, the first `label_len` positions of each
+        # sample, which is exactly the order of the concatenated labels.
+        decoder_inputs = self._decoder_inputs[:, :num_samples]
+        decoder_inputs.fill(0)
+        if num_samples:
+            label_mask = self._positions < label_lens[:, np.newaxis]
+            decoder_inputs.T[label_mask] = np.concatenate(labels)
+
+        one_mask_lens = np.minimum(label_lens - go_shift, valid_target_length)
+        target_weights = self._target_weights[:, :num_samples]
+        np.less(self._positions[:, np.newaxis], one_mask_lens, out=target_weights,
+                casting='unsafe')
+
+        res['decoder_inputs'] = decoder_inputs
+        res['target_weights'] = target_weights
 
         assert len(res['decoder_inputs']) == len(res['target_weights'])
 
-        self.data_list, self.label_list, self.label_list_plain, self.comment_list = [], [], [], []
+        self.clear()
 
         return res
 
+    def clear(self):
+        if self.capacity is None:
+            self.data_list, self.label_list = [], []
+            self.label_list_plain, self.comment_list = [], []
+        # Fixed-capacity buffers are simply overwritten by the next batch.
+        self.size = 0
+
     def __len__(self):
-        return len(self.data_list)
+        return self.size
+
+    def _filled(self):
+        return (list(self.data_list[:self.size]), list(self.label_list[:self.size]),
+                list(self.label_list_plain[:self.size]), list(self.comment_list[:self.size]))
 
     def __iadd__(self, other):
-        self.data_list += other.data_list
-        self.label_list += other.label_list
-        self.label_list_plain += other.label_list_plain
-        self.comment_list += other.comment_list
+        for sample in zip(*other._filled()):  # pylint: disable=protected-access
+            self.append(*sample)
+        return self
 
     def __add__(self, other):
         res = BucketData()
-        res.data_list = self.data_list + other.data_list
-        res.label_list = self.label_list + other.label_list
-        res.label_list_plain = self.label_list_plain + other.label_list_plain
-        res.comment_list = self.comment_list + other.comment_list
+        for bucket in (self, other):
+            for sample in zip(*bucket._filled()):  # pylint: disable=protected-access
+                res.append(*sample)
         return res
@@ -1,7 +1,9 @@
 from __future__ import absolute_import
 
+import math
 import random
 import sys
+import zlib
 from warnings import warn
 
 import numpy as np
@@ -12,12 +14,111 @@ from six import BytesIO as IO
 
 from .bucketdata import BucketData
 from .data_augmentation import full_augmentation
+from .indexed import INDEX_SUFFIX, IndexedReader, is_indexed
 
 try:
     TFRecordDataset = tf.data.TFRecordDataset  # pylint: disable=invalid-name
 except AttributeError:
     TFRecordDataset = tf.contrib.data.TFRecordDataset  # pylint: disable=invalid-name
 
+try:
+    parallel_interleave = tf.data.experimental.parallel_interleave  # pylint: disable=invalid-name
+except AttributeError:
+    try:
+        parallel_interleave = tf.contrib.data.parallel_interleave  # pylint: disable=invalid-name
+    except AttributeError:
+        parallel_interleave = None  # pylint: disable=invalid-name
+
+AUTOTUNE = getattr(getattr(tf.data, 'experimental', None), 'AUTOTUNE', None)
+
+
+def resized_max_width(max_width, max_height, height=32):
+    """Width of the model input once an image of the maximum size is resized to `height`."""
+    return int(math.ceil(1. * max_width / max_height * height))
+
+
+def resize_image(img, width, height):
+    """Resize a decoded image tensor to the height of `height` while
+    maintaining the aspect ratio, unless the image is already low enough.
+    Images that would end up wider than `width` are resized to fit it instead."""
+    dims = tf.shape(img)
+    height_float = tf.cast(height, tf.float64)
+
+    max_width = tf.to_int32(tf.ceil(tf.truediv(dims[1], dims[0]) * height_float))
+    max_height = tf.to_int32(tf.ceil(tf.truediv(width, max_width) * height_float))
+
+    return tf.cond(
+        tf.greater_equal(width, max_width),
+        lambda: tf.cond(
+            tf.less_equal(dims[0], height),
+            lambda: tf.to_float(img),
+            lambda: tf.image.resize_images(img, [height, max_width],
+                                           method=tf.image.ResizeMethod.BICUBIC),
+        ),
+        lambda: tf.image.resize_images(img, [max_height, width],
+                                       method=tf.image.ResizeMethod.BICUBIC)
+    )
+
+
+def prepare_image(image, width, height, channels):
+    """Decode an encoded image, resize it with `resize_image` and pad it to
+    a fixed size of ``[height, width]``: the model input for one image."""
+    img = tf.image.decode_png(image, channels=channels)
+    resized = resize_image(img, width, height)
+    return tf.image.pad_to_bounding_box(resized, 0, 0, height, width)
+
+
+def resize_array(img, width, height):
+    """PIL counterpart of `resize_image`: resize a PIL image and return it as
+    a uint8 array of shape ``[height, width, channels]``."""
+    img_width, img_height = img.size
+    max_width = int(math.ceil(1. * img_width / img_height * height))
+
+    if width >= max_width:
+        if img_height > height:
+            img = img.resize((max_width, height), Image.BICUBIC)
+    else:
+        max_height = int(math.ceil(1. * width / max_width * height))
+        img = img.resize((width, max_height), Image.BICUBIC)
+
+    img = np.asarray(img, dtype=np.uint8)
+    if img.ndim == 2:
+        img = img[..., np.newaxis]
+    return img
+
+
+def compression_type(path):
+    """Detect the compression of a TFRecords file: 'GZIP', 'ZLIB' or '' (none)."""
+    with tf.gfile.GFile(path, 'rb') as records:
+        head = records.read(64)
+    if head[:2] == b'\x1f\x8b':
+        return 'GZIP'
+    if len(head) >= 2 and head[0:1] == b'\x78' and (head[0] * 256 + head[1]) % 31 == 0:
+        # An uncompressed record length can look like a zlib header by chance,
+        # so make sure that the stream actually inflates.
+        try:
+            zlib.decompressobj().decompress(head)
+            return 'ZLIB'
+        except zlib.error:
+            pass
+    return ''
+
+
+def expand_paths(paths):
+    """Expand a path, a glob pattern, or a list of either into a sorted list of files.
+
+    Patterns that do not match anything are kept as they are, so that a missing
+    file is reported by the reader instead of silently producing an empty dataset.
+    The index files of indexed datasets are left out of the matches.
+    """
+    if isinstance(paths, (str, bytes)):
+        paths = [paths]
+    filenames = []
+    for path in paths:
+        matches = [match for match in tf.gfile.Glob(path) if not match.endswith(INDEX_SUFFIX)]
+        filenames.extend(sorted(matches) if matches else [path])
+    return filenames
+
 
 class DataGen(object):
     GO_ID = 1
@@ -47,30 +148,112 @@ class DataGen(object):
                  buckets,
                  augment_data_prob=0.0,
                  epochs=1000,
-                 max_width=None):
+                 max_width=None,
+                 shuffle_buffer_size=10000,
+                 num_parallel_reads=1,
+                 num_parallel_calls=1,
+                 image_width=None,
+                 channels=1,
+                 augment_preprocessed='after',
+                 num_shards=1,
+                 shard_index=0,
+                 charmap=None):
         """
-        :param annotation_fn:
+        :param annotation_fn: TFRecords or indexed dataset file, glob pattern or list of shards
         :param buckets:
         :param augment_data_prob: probability of applying data augmentation functions on the sample
         :param epochs:
-        :param max_width: 
+        :param max_width:
+        :param shuffle_buffer_size: number of records in the shuffle buffer (0 disables shuffling);
+            indexed datasets are shuffled globally on every epoch instead
+        :param num_parallel_reads: number of shards read concurrently
+        :param num_parallel_calls: number of batches parsed concurrently
+        :param image_width: padded width of the model input, used for preprocessed records
+        :param channels: number of color channels of the model input
+        :param augment_preprocessed: augment preprocessed records 'after' the cached resize
+            or 'before' it (the latter needs the original image stored in the record)
+        :param num_shards: number of parts the dataset is split into, see `shard_index`
+        :param shard_index: only read this part of the dataset; whole files are
+            assigned to parts when there are enough of them, records otherwise
+        :param charmap: characters of the label ids, `CHARMAP` by default
         :return:
         """
         self.epochs = epochs
         self.max_width = max_width
         self.augment_data_prob = augment_data_prob
+        self.num_parallel_calls = num_parallel_calls
+        self.image_width = image_width
+        self.channels = channels
+        self.augment_preprocessed = augment_preprocessed
+        self.charmap = list(charmap) if charmap is not None else self.CHARMAP
+        self._image_buffer = None
 
         self.bucket_specs = buckets
         self.bucket_data = BucketData()
 
-        dataset = TFRecordDataset([annotation_fn])
-        dataset = dataset.map(self._parse_record)
-        dataset = dataset.shuffle(buffer_size=10000)
+        self.filenames = expand_paths(annotation_fn)
+        self.shuffle = bool(shuffle_buffer_size)
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.reader = None
+
+        indexed = [is_indexed(path) for path in self.filenames]
+        if any(indexed):
+            if not all(indexed):
+                raise ValueError('Cannot mix indexed and TFRecords files in one dataset.')
+            # Indexed datasets are read directly, in a random order, from memory-mapped files.
+            self.reader = IndexedReader(self.filenames)
+            self.compression_types = [''] * len(self.filenames)
+            self.dataset = None
+            return
+
+        self.compression_types = [compression_type(path) for path in self.filenames]
+        files = tf.data.Dataset.from_tensor_slices((self.filenames, self.compression_types))
+        shard_files = num_shards > 1 and len(self.filenames) >= num_shards
+        if shard_files:
+            files = files.shard(num_shards, shard_index)
+        # Splitting by records needs every part to see the records in the
+        # same order, so the files are read in order, deterministically, and
+        # only the records of the part are shuffled.
+        record_shards = num_shards > 1 and not shard_files
+        if shuffle_buffer_size and len(self.filenames) > 1 and not record_shards:
+            # Shuffle at the shard level first; records are shuffled below.
+            files = files.shuffle(buffer_size=len(self.filenames))
+
+        def read_file(filename, compression):
+            return TFRecordDataset(filename, compression_type=compression)
+
+        if num_parallel_reads > 1 and len(self.filenames) > 1:
+            cycle_length = min(num_parallel_reads, len(self.filenames))
+            if parallel_interleave is not None:
+                dataset = files.apply(parallel_interleave(
+                    read_file, cycle_length=cycle_length,
+                    sloppy=bool(shuffle_buffer_size) and not record_shards))
+            else:
+                dataset = files.interleave(read_file, cycle_length=cycle_length)
+        else:
+            dataset = files.flat_map(read_file)
+
+        if record_shards:
+            dataset = dataset.shard(num_shards, self.shard_index)
+        if shuffle_buffer_size:
+            dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
         self.dataset = dataset.repeat(self.epochs)
 
     def clear(self):
         self.bucket_data = BucketData()
 
+    def count_records(self):
+        """Number of records in the files of the dataset, all parts together."""
+        if self.reader is not None:
+            return len(self.reader)
+        count = 0
+        for filename, compression in zip(self.filenames, self.compression_types):
+            options = tf.python_io.TFRecordOptions(
+                getattr(tf.python_io.TFRecordCompressionType, compression or 'NONE'))
+            count += sum(1 for _ in tf.python_io.tf_record_iterator(filename, options))
+        return count
+
     def _perform_augmentation(self, img, augmentation_fn, **kwargs):
         # Convert images encoded as bytes to PIL.Image
         img = Image.open(IO(img))
@@ -85,39 +268,130 @@ class DataGen(object):
 
         return img
 
-    def gen(self, batch_size):
+    def gen(self, batch_size, drop_remainder=True):
+        """Yield batches of `batch_size` samples; the last, smaller batch is
+        only yielded if `drop_remainder` is False."""
+        # A single fixed-capacity buffer is reused for every batch.
+        self.bucket_data = BucketData(capacity=batch_size,
+                                      decoder_input_len=self.bucket_specs[-1][1])
+
+        if self.reader is not None:
+            samples = self._indexed_samples()
+        else:
+            samples = self._record_samples(batch_size)
+
+        for img, pixels, height, width, lex, comment in samples:
+
+            if len(pixels):
+                img = self._load_preprocessed(img, pixels, height, width)
+            elif random.random() < self.augment_data_prob:
+                # Augment specified percentage of data
+                img = self._perform_augmentation(img, full_augmentation, max_width=self.max_width)
+
+            try:
+                word = self.convert_lex(lex)
+            except IndexError as e:
+                raise ValueError("Failed to convert lexicon for {!r}".format(comment)) from e
+
+            bucket_size = self.bucket_data.append(img, word, lex, comment)
+
+            if bucket_size >= batch_size:
+                bucket = self.bucket_data.flush_out(
+                    self.bucket_specs,
+                    go_shift=1)
+                yield self._pack_preprocessed(bucket)
+
+        if not drop_remainder and len(self.bucket_data):
+            bucket = self.bucket_data.flush_out(
+                self.bucket_specs,
+                go_shift=1)
+            yield self._pack_preprocessed(bucket)
+
+        self.clear()
+
+    def _record_samples(self, batch_size):
+        """Yield the samples of a TFRecords dataset."""
+        # Records are parsed a whole batch at a time with `parse_example`.
         dataset = self.dataset.batch(batch_size)
+        dataset = dataset.map(self._parse_records, num_parallel_calls=self.num_parallel_calls)
+        dataset = dataset.prefetch(AUTOTUNE or 1)
         iterator = dataset.make_one_shot_iterator()
 
-        images, labels, comments = iterator.get_next()
+        next_batch = iterator.get_next()
         with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
 
             while True:
                 try:
-                    raw_images, raw_labels, raw_comments = sess.run([images, labels, comments])
-                    for img, lex, comment in zip(raw_images, raw_labels, raw_comments):
+                    raw_batch = sess.run(next_batch)
+                except tf.errors.OutOfRangeError:
+                    break
+                for sample in zip(*raw_batch):
+                    yield sample
 
-                        # Augment specified percentage of data
-                        if random.random() < self.augment_data_prob:
-                            img = self._perform_augmentation(img, full_augmentation, max_width=self.max_width)
+    def _indexed_samples(self):
+        """Yield the samples of an indexed dataset, in a new random order on every epoch."""
+        records = np.arange(self.shard_index, len(self.reader), self.num_shards)
+        for _ in range(self.epochs):
+            order = np.random.permutation(records) if self.shuffle else records
+            for idx in order:
+                img, pixels, height, width, lex, comment = self.reader[idx]
+                if not len(pixels):
+                    # Encoded images are fed to the model as strings.
+                    img = img.tobytes()
+                yield img, pixels, height, width, lex, comment
 
-                        try:
-                            word = self.convert_lex(lex)
-                        except IndexError as e:
-                            raise ValueError("Failed to convert lexicon for {!r}".format(comment)) from e
+    def _load_preprocessed(self, img, pixels, height, width):
+        """Turn a preprocessed record into a uint8 array, augmenting it if needed."""
+        pixels = np.frombuffer(pixels, dtype=np.uint8).reshape((height, width, -1))
+        if random.random() >= self.augment_data_prob:
+            return pixels
 
-                        bucket_size = self.bucket_data.append(img, word, lex, comment)
+        mode = 'L' if self.channels == 1 else 'RGB'
+        if self.augment_preprocessed == 'before':
+            if img:
+                augmented = full_augmentation(Image.open(IO(img)).convert(mode),
+                                              max_width=self.max_width)
+                return resize_array(augmented, self.image_width, self.IMAGE_HEIGHT)
+            warn('Preprocessed record has no original image, augmenting after the resize.')
+            self.augment_preprocessed = 'after'
 
-                        if bucket_size >= batch_size:
-                            bucket = self.bucket_data.flush_out(
-                                self.bucket_specs,
-                                go_shift=1)
-                            yield bucket
+        img = Image.fromarray(pixels[..., 0] if self.channels == 1 else pixels, mode)
+        augmented = full_augmentation(img, max_width=self.image_width)
+        return resize_array(augmented, self.image_width, self.IMAGE_HEIGHT)
 
-                except tf.errors.OutOfRangeError:
-                    break
+    def _pack_preprocessed(self, bucket):
+        """Pad the uint8 arrays of a preprocessed batch into a reusable float buffer
+        that can be fed to the model instead of the encoded images."""
+        images = bucket['data']
+        preprocessed = [isinstance(img, np.ndarray) for img in images]
+        if not any(preprocessed):
+            return bucket
+        if not all(preprocessed):
+            raise ValueError('Cannot mix preprocessed and raw records in one dataset.')
+        if self.image_width is None:
+            raise ValueError('image_width is required to read preprocessed records.')
 
-        self.clear()
+        capacity = self.bucket_data.capacity or len(images)
+        if self._image_buffer is None or len(self._image_buffer) < capacity:
+            self._image_buffer = np.zeros(
+                (capacity, self.IMAGE_HEIGHT, self.image_width, self.channels),
+                dtype=np.float32)
+
+        padded = self._image_buffer[:len(images)]
+        padded.fill(0)
+        for idx, img in enumerate(images):
+            height, width, channels = img.shape
+            if width > self.image_width or height > self.IMAGE_HEIGHT or channels != self.channels:
+                raise ValueError(
+                    'Preprocessed image of shape {} does not fit the model input {}; '
+                    'check --max-width, --max-height and --color.'.format(
+                        img.shape, padded.shape[1:]))
+            padded[idx, :height, :width, :] = img
+
+        bucket['images'] = images
+        bucket['data'] = padded
+        bucket['preprocessed'] = True
+        return bucket
 
     def convert_lex(self, lex):
         if sys.version_info >= (3,):
@@ -126,17 +400,21 @@ class DataGen(object):
         assert len(lex) < self.bucket_specs[-1][1]
 
         return np.array(
-            [self.GO_ID] + [self.CHARMAP.index(char) for char in lex] + [self.EOS_ID],
+            [self.GO_ID] + [self.charmap.index(char) for char in lex] + [self.EOS_ID],
             dtype=np.int32
         )
 
+    FEATURES = {
+        'image': tf.FixedLenFeature([], tf.string, default_value=''),
+        'pixels': tf.FixedLenFeature([], tf.string, default_value=''),
+        'height': tf.FixedLenFeature([], tf.int64, default_value=0),
+        'width': tf.FixedLenFeature([], tf.int64, default_value=0),
+        'label': tf.FixedLenFeature([], tf.string),
+        'comment': tf.FixedLenFeature([], tf.string, default_value=''),
+    }
+
     @staticmethod
-    def _parse_record(example_proto):
-        features = tf.parse_single_example(
-            example_proto,
-            features={
-                'image': tf.FixedLenFeature([], tf.string),
-                'label': tf.FixedLenFeature([], tf.string),
-                'comment': tf.FixedLenFeature([], tf.string, default_value=''),
-            })
-        return features['image'], features['label'], features['comment']
+    def _parse_records(example_protos):
+        features = tf.parse_example(example_protos, features=DataGen.FEATURES)
+        return (features['image'], features['pixels'], features['height'],
+                features['width'], features['label'], features['comment'])
@@ -1,11 +1,25 @@
 from __future__ import absolute_import
+from __future__ import division
 
+import glob
+import bisect
+import hashlib
+import json
 import logging
+import math
+import multiprocessing
+import os
 import re
+import sqlite3
+import threading
+import time
 
 import tensorflow as tf
 
-from six import b
+from .archive import Archive, LooseFiles, is_streamed
+from .data_gen import DataGen, resize_image, resized_max_width
+from .indexed import IndexedWriter, image_size, index_path
+from .stats import DatasetStats, log_savings, recommend_shape, stats_path
 
 
 def _bytes_feature(value):
@@ -16,52 +30,693 @@ def _int64_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
 
+def _writer_options(compression):
+    compression_type = {
+        'none': tf.python_io.TFRecordCompressionType.NONE,
+        'gzip': tf.python_io.TFRecordCompressionType.GZIP,
+        'zlib': tf.python_io.TFRecordCompressionType.ZLIB,
+    }[compression]
+    return tf.python_io.TFRecordOptions(compression_type)
+
+
+class TFRecordShardWriter(object):
+    """Writes records to a TFRecords shard, with the interface of `IndexedWriter`."""
+
+    def __init__(self, path, compression='none'):
+        self.writer = tf.python_io.TFRecordWriter(path, options=_writer_options(compression))
+
+    def write(self, image, pixels, height, width, label, comment):
+        feature = {'label': _bytes_feature(label.encode('UTF-8'))}
+        if image:
+            feature['image'] = _bytes_feature(image)
+        if pixels:
+            feature['pixels'] = _bytes_feature(pixels)
+            feature['height'] = _int64_feature(height)
+            feature['width'] = _int64_feature(width)
+        if comment:
+            feature['comment'] = _bytes_feature(comment.encode('UTF-8'))
+
+        example = tf.train.Example(features=tf.train.Features(feature=feature))
+        self.writer.write(example.SerializeToString())
+
+    def close(self):
+        self.writer.close()
+
+
+class Preprocessor(object):
+    """Decodes and resizes images exactly like the model input pipeline does,
+    producing the uint8 tensors stored in preprocessed datasets."""
+
+    def __init__(self, max_width, max_height, channels):
+        self.channels = channels
+        self.width = resized_max_width(max_width, max_height, DataGen.IMAGE_HEIGHT)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.img_pl = tf.placeholder(tf.string)
+            img = tf.image.decode_png(self.img_pl, channels=channels)
+            resized = resize_image(img, self.width, DataGen.IMAGE_HEIGHT)
+            self.pixels = tf.cast(tf.clip_by_value(tf.round(resized), 0, 255), tf.uint8)
+        self.sess = tf.Session(graph=self.graph)
+
+    def __call__(self, img):
+        return self.sess.run(self.pixels, {self.img_pl: img})
+
+    def close(self):
+        self.sess.close()
+
+
+def parse_line(line, force_uppercase=True):
+    """Split an annotation line into an image path and a label.
+
+    Returns None if the line does not contain both.
+    """
+    line = line.rstrip('\r\n')
+
+    # Split the line on the first whitespace character and allow empty values for the label
+    # NOTE: this does not allow whitespace in image paths
+    line_match = re.match(r'(\S+)\s(.*)', line)
+    if line_match is None:
+        return None
+    (img_path, label) = line_match.groups()
+
+    if force_uppercase:
+        label = label.upper()
+
+    return img_path, label
+
+
+def check_label(label, charmap, max_prediction):
+    """Return the reason why a label cannot be used for training, or None."""
+    if len(label) > max_prediction:
+        return 'label longer than max prediction length ({} > {})'.format(
+            len(label), max_prediction)
+    unknown = sorted(set(char for char in label if char not in charmap))
+    if unknown:
+        return 'characters not in the charmap: {}'.format(''.join(unknown))
+    return None
+
+
+def shard_path(output_path, shard, num_shards, run=None):
+    """Name of a shard; a dataset with a single shard is written to `output_path` itself.
+
+    Shards of incremental builds carry the number of the run that wrote them.
+    """
+    if run is not None:
+        return '{}-{:04d}-{:05d}-of-{:05d}'.format(output_path, run, shard, num_shards)
+    if num_shards == 1:
+        return output_path
+    return '{}-{:05d}-of-{:05d}'.format(output_path, shard, num_shards)
+
+
+def _temp_path(path):
+    """Shards of incremental builds are written under a hidden name until committed."""
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.tmp-' + basename)
+
+
+def _rename_shard(src, dst):
+    """Rename a shard along with its index, if it has one. The data file is
+    renamed last, so that its presence marks a complete shard."""
+    if os.path.exists(index_path(src)):
+        os.rename(index_path(src), index_path(dst))
+    os.rename(src, dst)
+
+
+def _remove_shard(path):
+    for filename in (index_path(path), path):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def sample_key(img_path, img, key_type):
+    """Key identifying an ingested sample: its image path or the hash of its content."""
+    if key_type == 'hash':
+        return hashlib.sha1(img).hexdigest()
+    return img_path
+
+
+class Manifest(object):
+    """Append-only record of the committed shards of an incrementally built
+    dataset and of the keys of the samples they hold.
+
+    A shard is only committed once it has been completely written, so an
+    interrupted build can resume from the last committed shard.
+    """
+
+    def __init__(self, path, key_type):
+        self.path = path
+        self.key_type = key_type
+        self.keys = set()
+        self.shards = []
+        self.next_run = 0
+
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'r') as manifest:
+            for line in manifest:
+                entry = json.loads(line)
+                if entry['key_type'] != key_type:
+                    raise ValueError('Manifest {} uses {} keys, not {}.'.format(
+                        path, entry['key_type'], key_type))
+                self.keys.update(entry['keys'])
+                self.shards.append(entry['shard'])
+                self.next_run = max(self.next_run, entry['run'] + 1)
+
+                # Finish the commit of a shard that was recorded but not renamed.
+                temp_path = _temp_path(entry['shard'])
+                if not os.path.exists(entry['shard']) and os.path.exists(temp_path):
+                    _rename_shard(temp_path, entry['shard'])
+
+        # Anything else left under a temporary name is from an interrupted run.
+        output_path = path[:-len('.manifest')] if path.endswith('.manifest') else path
+        for stale in glob.glob(_temp_path(output_path) + '-*'):
+            logging.info('Removing incomplete shard %s.', stale)
+            os.remove(stale)
+
+    def commit(self, run, shard, keys):
+        entry = {'run': run, 'shard': shard, 'key_type': self.key_type, 'keys': keys}
+        with open(self.path, 'a') as manifest:
+            manifest.write(json.dumps(entry) + '\n')
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        _rename_shard(_temp_path(shard), shard)
+        self.keys.update(keys)
+        self.shards.append(shard)
+
+
+class DedupIndex(object):
+    """Index of image content hashes, mapping each hash to the first line and
+    label it was seen with.
+
+    The index is kept in memory up to `memory_limit` entries and moved to a
+    SQLite database at `path` beyond that.
+    """
+
+    def __init__(self, path, memory_limit):
+        self.path = path
+        self.memory_limit = memory_limit
+        self.entries = {}
+        self.db = None
+
+    def _spill(self):
+        logging.info('Moving the deduplication index to %s.', self.path)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE entries (digest BLOB PRIMARY KEY, line INTEGER, label TEXT)')
+        self.db.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                            ((digest, line_no, label)
+                             for digest, (line_no, label) in self.entries.items()))
+        self.entries = None
+
+    def add(self, digest, line_no, label):
+        """Add a hash to the index; return ``(first_line, first_label)`` if it is already in."""
+        if self.db is None:
+            first = self.entries.get(digest)
+            if first is None:
+                self.entries[digest] = (line_no, label)
+                if len(self.entries) > self.memory_limit:
+                    self._spill()
+            return first
+
+        first = self.db.execute('SELECT line, label FROM entries WHERE digest = ?',
+                                (digest,)).fetchone()
+        if first is None:
+            self.db.execute('INSERT INTO entries VALUES (?, ?, ?)', (digest, line_no, label))
+        return first
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.path)
+
+
+def _find_duplicates(hashed_shards, shards, policy, index_path, memory_limit, report_path):
+    """Find the annotation lines to leave out as duplicates, per shard.
+
+    `hashed_shards` yields, in line order, lists of ``(line, digest, label)``.
+    Later occurrences of an image are always left out. Occurrences with a
+    different label than the first one are conflicts: the 'first' policy
+    keeps the first occurrence, 'drop' leaves all of them out, and 'report'
+    keeps the first occurrence and writes the conflicts to `report_path`.
+    """
+    index = DedupIndex(index_path, memory_limit)
+    duplicates = set()
+    conflicts = []
+    try:
+        for entries in hashed_shards:
+            for line_no, digest, label in entries:
+                first = index.add(digest, line_no, label)
+                if first is None:
+                    continue
+                duplicates.add(line_no)
+                if label != first[1]:
+                    conflicts.append((line_no, first[0], label, first[1]))
+    finally:
+        index.close()
+
+    if policy == 'drop':
+        duplicates.update(first_line for _, first_line, _, _ in conflicts)
+    logging.info('Removed %i duplicate images, %i of them with conflicting labels.',
+                 len(duplicates), len(conflicts))
+
+    if policy == 'report':
+        with open(report_path, 'w') as report:
+            for line_no, first_line, label, first_label in conflicts:
+                report.write('{}\t{}\t{}\t{}\n'.format(line_no + 1, first_line + 1,
+                                                         label, first_label))
+        logging.info('Conflicting labels written to %s.', report_path)
+
+    # Hand every shard only the duplicates within its own line ranges.
+    starts = []
+    for shard, ranges in enumerate(shards):
+        starts.extend((first_line, num_lines, shard) for first_line, _, num_lines in ranges)
+    starts.sort()
+    first_lines = [start[0] for start in starts]
+    shard_duplicates = [set() for _ in shards]
+    for line_no in duplicates:
+        first_line, num_lines, shard = starts[bisect.bisect_right(first_lines, line_no) - 1]
+        if line_no < first_line + num_lines:
+            shard_duplicates[shard].add(line_no)
+
+    return [frozenset(lines) for lines in shard_duplicates]
+
+
+def _plan_shards(annotations_path, num_shards, records_per_shard, skip_paths=None,
+                 force_uppercase=True):
+    """Split the annotation lines into shards of consecutive lines.
+
+    The split only depends on the annotation file and the sharding options,
+    so the output does not depend on the number of workers. Lines whose image
+    path is in `skip_paths` are left out.
+    Returns a list of shards, each a list of ``(first_line, byte_offset, num_lines)``
+    ranges of the annotation file.
+    """
+    def selected_lines():
+        offset = 0
+        with open(annotations_path, 'rb') as annotations:
+            for idx, line in enumerate(annotations):
+                if skip_paths:
+                    parsed = parse_line(line.decode('UTF-8'), force_uppercase)
+                    skip = parsed is not None and parsed[0] in skip_paths
+                else:
+                    skip = False
+                if not skip:
+                    yield idx, offset
+                offset += len(line)
+
+    if not records_per_shard:
+        num_lines = sum(1 for _ in selected_lines())
+        records_per_shard = max(1, int(math.ceil(num_lines / max(num_shards, 1))))
+
+    shards = []
+    for count, (idx, offset) in enumerate(selected_lines()):
+        if count % records_per_shard == 0:
+            shards.append([])
+        ranges = shards[-1]
+        if ranges and ranges[-1][0] + ranges[-1][2] == idx:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1], ranges[-1][2] + 1)
+        else:
+            ranges.append((idx, offset, 1))
+
+    return shards
+
+
+def _read_lines(annotations_path, ranges):
+    """Yield ``(line_number, line)`` for the given ranges of the annotation file."""
+    with open(annotations_path, 'rb') as annotations:
+        for first_line, offset, num_lines in ranges:
+            annotations.seek(offset)
+            for idx in range(first_line, first_line + num_lines):
+                yield idx, annotations.readline().decode('UTF-8')
+
+
+class _Options(object):
+    """Dataset generation options passed to the shard workers."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+_PROGRESS = None
+_SKIP_KEYS = frozenset()
+_SOURCES = {}
+
+
+def _init_worker(progress, skip_keys=frozenset()):
+    global _PROGRESS, _SKIP_KEYS  # pylint: disable=global-statement
+    _PROGRESS = progress
+    _SKIP_KEYS = skip_keys
+
+
+def _image_source(archive_path):
+    """Where the images are read from: loose files, or the members of an archive.
+
+    Archives are opened once per process, as indexing them can take a while.
+    """
+    if not archive_path:
+        return LooseFiles()
+    if archive_path not in _SOURCES:
+        _SOURCES[archive_path] = Archive(archive_path)
+    return _SOURCES[archive_path]
+
+
+def _hash_shard(args):
+    """Hash the images of one shard for deduplication."""
+    ranges, options = args
+
+    def samples():
+        for idx, line in _read_lines(options.annotations_path, ranges):
+            parsed = parse_line(line, options.force_uppercase)
+            if parsed is not None:
+                yield (idx,) + parsed
+
+    entries = []
+    source = _image_source(options.archive)
+    for (idx, _, label), img, error in source.read_many(samples(), name=lambda sample: sample[1]):
+        if error is not None:
+            # Left for the writer to report.
+            continue
+        entries.append((idx, hashlib.sha1(img).digest(), label))
+
+        if _PROGRESS is not None:
+            with _PROGRESS.get_lock():
+                _PROGRESS.value += 1
+
+    return entries
+
+
+def _write_shard(args):
+    """Read the images of one shard and write them into their own file."""
+    path, ranges, options, duplicates = args
+
+    stats = {
+        'path': path,
+        'records': 0,
+        'keys': [],
+        'skipped': 0,
+        'duplicates': 0,
+        'rejected': [],
+        'longest_label': '',
+        'raw_bytes': 0,
+        'preprocess_time': 0.0,
+        'shape': DatasetStats(),
+    }
+
+    preprocessor = None
+    if options.preprocess or options.validate:
+        preprocessor = Preprocessor(options.max_width, options.max_height, options.channels)
+    charmap = set(options.charmap)
+
+    output = _temp_path(path) if options.append else path
+    if options.record_format == 'indexed':
+        writer = IndexedWriter(output)
+    else:
+        writer = TFRecordShardWriter(output, options.compression)
+
+    def samples():
+        for idx, line in _read_lines(options.annotations_path, ranges):
+            if idx in duplicates:
+                stats['duplicates'] += 1
+                continue
+
+            parsed = parse_line(line, options.force_uppercase)
+            if parsed is None:
+                stats['rejected'].append((idx + 1, 'missing filename or label', line))
+                continue
+            (img_path, label) = parsed
+
+            if options.validate:
+                reason = check_label(label, charmap, options.max_prediction)
+                if reason is not None:
+                    stats['rejected'].append((idx + 1, reason, line))
+                    continue
+
+            yield idx, line, img_path, label
+
+    # Samples come in line order, except from compressed tar archives,
+    # which can only be streamed.
+    source = _image_source(options.archive)
+    for (idx, line, img_path, label), img, error in source.read_many(
+            samples(), name=lambda sample: sample[2]):
+        if error is not None:
+            if not options.validate:
+                raise error
+            stats['rejected'].append((idx + 1, 'cannot read image: {}'.format(error), line))
+            continue
+
+        key = None
+        if options.append:
+            key = sample_key(img_path, img, options.manifest_key)
+            if key in _SKIP_KEYS:
+                stats['skipped'] += 1
+                continue
+
+        pixels = None
+        if preprocessor is not None:
+            start_time = time.time()
+            try:
+                pixels = preprocessor(img)
+            except tf.errors.OpError as e:
+                if not options.validate:
+                    raise
+                stats['rejected'].append((idx + 1, 'cannot decode image: {}'.format(
+                    e.message.splitlines()[0]), line))
+                continue
+            if not pixels.size:
+                stats['rejected'].append((idx + 1, 'empty image', line))
+                continue
+            stats['preprocess_time'] += time.time() - start_time
+
+        if len(label) > len(stats['longest_label']):
+            stats['longest_label'] = label
+
+        stats['raw_bytes'] += len(img)
+        height, width = image_size(img)
+        if height and width:
+            stats['shape'].add(height, width, len(label))
+
+        if options.preprocess:
+            writer.write(img if options.keep_original else b'', pixels.tobytes(),
+                         pixels.shape[0], pixels.shape[1], label,
+                         img_path if options.save_filename else '')
+        else:
+            writer.write(img, b'', 0, 0, label, img_path if options.save_filename else '')
+        stats['records'] += 1
+        if key is not None:
+            stats['keys'].append(key)
+
+        if _PROGRESS is not None:
+            with _PROGRESS.get_lock():
+                _PROGRESS.value += 1
+
+    writer.close()
+    if preprocessor is not None:
+        preprocessor.close()
+
+    return stats
+
+
+class _ProgressLogger(threading.Thread):
+    """Logs the number of written records and the write rate every `log_step` records."""
+
+    def __init__(self, progress, log_step, interval=0.5):
+        super(_ProgressLogger, self).__init__()
+        self.daemon = True
+        self.progress = progress
+        self.log_step = log_step
+        self.interval = interval
+        self.start_time = time.time()
+        self.finished = threading.Event()
+
+    def run(self):
+        logged = 0
+        while not self.finished.wait(self.interval):
+            processed = self.progress.value
+            if processed // self.log_step > logged // self.log_step:
+                logging.info('Processed %i pairs (%.0f records/s).',
+                             processed, processed / (time.time() - self.start_time))
+                logged = processed
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
 def generate(annotations_path, output_path, log_step=5000,
-             force_uppercase=True, save_filename=False):
+             force_uppercase=True, save_filename=False, preprocess=False,
+             max_width=160, max_height=60, channels=1, keep_original=False,
+             workers=1, num_shards=1, records_per_shard=0, validate=False,
+             max_prediction=8, charmap=None, rejected_path=None, append=False,
+             manifest_key='path', compression='none', dedup=False, dedup_policy='first',
+             dedup_memory_limit=5000000, record_format='tfrecords', archive=None):
 
     logging.info('Building a dataset from %s.', annotations_path)
-    logging.info('Output file: %s', output_path)
+    if archive:
+        logging.info('Reading images from archive %s.', archive)
 
-    writer = tf.python_io.TFRecordWriter(output_path)
-    longest_label = ''
-    idx = 0
+    if record_format == 'indexed' and compression != 'none':
+        raise ValueError('Indexed datasets are memory-mapped and cannot be compressed.')
 
-    with open(annotations_path, 'r') as annotations:
-        for idx, line in enumerate(annotations):
-            line = line.rstrip('\n')
+    manifest = None
+    run = None
+    skip_paths = None
+    skip_keys = frozenset()
+    if append:
+        manifest = Manifest(output_path + '.manifest', manifest_key)
+        run = manifest.next_run
+        logging.info('Appending to %i shards holding %i samples (run %i).',
+                     len(manifest.shards), len(manifest.keys), run)
+        if manifest_key == 'path':
+            skip_paths = manifest.keys
+        else:
+            skip_keys = frozenset(manifest.keys)
 
-            # Split the line on the first whitespace character and allow empty values for the label
-            # NOTE: this does not allow whitespace in image paths
-            line_match = re.match(r'(\S+)\s(.*)', line)
-            if line_match is None:
-                logging.error('missing filename or label, ignoring line %i: %s', idx+1, line)
-                continue
-            (img_path, label) = line_match.groups()
+    shards = _plan_shards(annotations_path, num_shards, records_per_shard,
+                          skip_paths=skip_paths, force_uppercase=force_uppercase)
+    if append and not shards:
+        logging.info('No new samples to add.')
+        return
+    shards = shards or [[]]
+    num_shards = len(shards)
+    workers = max(1, min(workers, num_shards))
+    paths = [shard_path(output_path, shard, num_shards, run) for shard in range(num_shards)]
+    if num_shards == 1:
+        logging.info('Output file: %s', paths[0])
+    else:
+        logging.info('Output files: %s (%i shards, %i workers)',
+                     paths[0], num_shards, workers)
 
-            with open(img_path, 'rb') as img_file:
-                img = img_file.read()
+    if archive and num_shards > 1 and is_streamed(archive):
+        logging.warning('Every shard streams the whole compressed archive %s; an uncompressed'
+                        ' tar or a zip file can be read in place instead.', archive)
 
-            if force_uppercase:
-                label = label.upper()
+    if preprocess:
+        logging.info('Preprocessing images to %ix%ix%i.', DataGen.IMAGE_HEIGHT,
+                     resized_max_width(max_width, max_height, DataGen.IMAGE_HEIGHT), channels)
 
-            if len(label) > len(longest_label):
-                longest_label = label
+    options = _Options(
+        annotations_path=annotations_path,
+        force_uppercase=force_uppercase,
+        save_filename=save_filename,
+        preprocess=preprocess,
+        max_width=max_width,
+        max_height=max_height,
+        channels=channels,
+        keep_original=keep_original,
+        validate=validate,
+        max_prediction=max_prediction,
+        charmap=list(charmap if charmap is not None else DataGen.CHARMAP),
+        append=append,
+        manifest_key=manifest_key,
+        compression=compression,
+        record_format=record_format,
+        archive=archive,
+    )
 
-            feature = {}
-            feature['image'] = _bytes_feature(img)
-            feature['label'] = _bytes_feature(label.encode('UTF-8'))
-            if save_filename:
-                feature['comment'] = _bytes_feature(img_path.encode('UTF-8'))
+    # Workers are spawned rather than forked: the parent process may already
+    # hold a TensorFlow session, which is not fork-safe.
+    context = multiprocessing.get_context('spawn')
+    progress = context.Value('q', 0)
+    progress_logger = _ProgressLogger(progress, log_step)
+    progress_logger.start()
 
-            example = tf.train.Example(features=tf.train.Features(feature=feature))
+    results = []
+    start_time = time.time()
+    pool = None
+    if workers == 1:
+        _init_worker(progress, skip_keys)
+    else:
+        pool = context.Pool(workers, initializer=_init_worker, initargs=(progress, skip_keys))
 
-            writer.write(example.SerializeToString())
+    def map_shards(func, tasks, ordered=False):
+        if pool is None:
+            return (func(task) for task in tasks)
+        if ordered:
+            return pool.imap(func, tasks, chunksize=1)
+        return pool.imap_unordered(func, tasks, chunksize=1)
 
-            if idx % log_step == 0:
-                logging.info('Processed %s pairs.', idx+1)
+    try:
+        duplicates = [frozenset()] * num_shards
+        if dedup:
+            logging.info('Hashing images to find duplicates.')
+            duplicates = _find_duplicates(
+                map_shards(_hash_shard, [(ranges, options) for ranges in shards], ordered=True),
+                shards, dedup_policy, output_path + '.dedup.sqlite', dedup_memory_limit,
+                output_path + '.conflicts.txt')
+            progress.value = 0
 
-    if idx:
-        logging.info('Dataset is ready: %i pairs.', idx+1)
+        tasks = [(path, ranges, options, shard_duplicates)
+                 for path, ranges, shard_duplicates in zip(paths, shards, duplicates)]
+        for stats in map_shards(_write_shard, tasks):
+            # Commit every finished shard right away, so that an interrupted
+            # build can resume from it.
+            if manifest is not None:
+                if stats['records']:
+                    manifest.commit(run, stats['path'], stats['keys'])
+                else:
+                    _remove_shard(_temp_path(stats['path']))
+            results.append(stats)
+    finally:
+        if pool is None:
+            _init_worker(None)
+        else:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start_time
+    progress_logger.stop()
+    results.sort(key=lambda stats: stats['path'])
+
+    records = sum(stats['records'] for stats in results)
+    longest_label = max((stats['longest_label'] for stats in results), key=len)
+    raw_bytes = sum(stats['raw_bytes'] for stats in results)
+    preprocess_time = sum(stats['preprocess_time'] for stats in results)
+    skipped = sum(stats['skipped'] for stats in results)
+
+    rejected = sorted(rejection for stats in results for rejection in stats['rejected'])
+    if not validate:
+        for line_no, reason, line in rejected:
+            logging.error('%s, ignoring line %i: %s', reason, line_no, line.rstrip('\r\n'))
+    else:
+        rejected_path = rejected_path or output_path + '.rejected.txt'
+        with open(rejected_path, 'w') as report:
+            for line_no, reason, line in rejected:
+                report.write('{}\t{}\t{}\n'.format(line_no, reason, line.rstrip('\r\n')))
+        logging.info('Rejected %i lines, see %s.', len(rejected), rejected_path)
+
+    if skipped:
+        logging.info('Skipped %i samples that are already in the dataset.', skipped)
+    if dedup:
+        logging.info('Left out %i duplicates.', sum(stats['duplicates'] for stats in results))
+
+    if records:
+        shape = DatasetStats()
+        if append and tf.gfile.Exists(stats_path(output_path)):
+            shape += DatasetStats.load(stats_path(output_path))
+        for stats in results:
+            shape += stats['shape']
+        shape.save(stats_path(output_path))
+        recommended_width, recommended_prediction = recommend_shape(shape, 0.999, max_height)
+        logging.info('Statistics written to %s; %i samples fit --max-width=%i --max-height=%i'
+                     ' --max-prediction=%i at 99.9%% coverage.', stats_path(output_path),
+                     len(shape), recommended_width, max_height, recommended_prediction)
+        log_savings((max_width, max_height, max_prediction),
+                    (recommended_width, max_height, recommended_prediction))
+
+        logging.info('Dataset is ready: %i pairs (%.0f records/s).', records,
+                     records / max(elapsed, 1e-6))
         logging.info('Longest label (%i): %s', len(longest_label), longest_label)
 
-    writer.close()
+        output_bytes = sum(tf.gfile.Stat(filename).length
+                           for stats in results if stats['records']
+                           for filename in (stats['path'], index_path(stats['path']))
+                           if tf.gfile.Exists(filename))
+        logging.info('Encoded images: %.1f MB, %s dataset (%s compression): %.1f MB (%.0f%%).',
+                     raw_bytes / 1e6, 'preprocessed' if preprocess else 'output', compression,
+                     output_bytes / 1e6, 100. * output_bytes / max(raw_bytes, 1))
+
+        if preprocess:
+            logging.info('Decoding and resizing took %.1fs; this is saved on every training epoch.',
+                         preprocess_time)
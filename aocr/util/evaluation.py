@@ -0,0 +1,265 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from ..model.model import Model
+from ..model.metrics import EvaluationMetrics
+from .bucketdata import BucketData
+from .data_gen import DataGen, prepare_image, resized_max_width
+from .export import Exporter
+
+
+def _init_worker(full_ascii):
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)-15s %(name)-5s %(processName)-18s %(levelname)-8s %(message)s')
+    if full_ascii:
+        DataGen.set_full_ascii_charmap()
+
+
+def _test_shard(args):
+    """Restore the model in a new session and evaluate one part of the dataset."""
+    model_params, test_params, shard_index, num_shards = args
+    with tf.Graph().as_default(), \
+            tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        model = Model(session=sess, **model_params)
+        if test_params.get('attention_dump'):
+            # Every worker dumps its part of the dataset into its own directory.
+            test_params = dict(test_params, attention_dump=os.path.join(
+                test_params['attention_dump'], 'shard-{:05d}'.format(shard_index)))
+        return model.test(num_shards=num_shards, shard_index=shard_index, **test_params)
+
+
+def merge_sums(results):
+    """Add up the metric sums returned by `Model.test` for parts of a dataset."""
+    return dict((key, sum(result[key] for result in results)) for key in results[0])
+
+
+def test_sharded(model_params, test_params, workers, full_ascii=False):
+    """Evaluate a dataset with `workers` processes, each restoring the model
+    and evaluating its own part of the dataset, and report the merged metrics.
+
+    :param model_params: keyword arguments of `Model`, except the session
+    :param test_params: keyword arguments of `Model.test`
+    """
+    # Workers are spawned rather than forked: the parent process may already
+    # hold a TensorFlow session, which is not fork-safe.
+    context = multiprocessing.get_context('spawn')
+    tasks = [(model_params, test_params, shard, workers) for shard in range(workers)]
+
+    logging.info('Evaluating with %i workers.', workers)
+    start_time = time.time()
+    pool = context.Pool(workers, initializer=_init_worker, initargs=(full_ascii,))
+    try:
+        results = pool.map(_test_shard, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    sums = merge_sums(results)
+    Model.log_test_summary(sums, sums['loss'], start_time)
+    return sums
+
+
+class DecodedDataset(object):
+    """Samples of a dataset decoded and resized to the model input once, and
+    stored in a directory of memory-mappable files, so that any number of
+    evaluations, in any number of processes, can share them.
+
+    The images are stored as uint8 pixels, like preprocessed records, and
+    converted to floats one batch at a time. The labels are encoded with
+    `charmap`, `DataGen.CHARMAP` by default."""
+
+    def __init__(self, path, charmap=None):
+        charmap = charmap if charmap is not None else DataGen.CHARMAP
+        self.path = path
+        with open(os.path.join(path, 'samples.json'), 'r') as samples_file:
+            samples = json.load(samples_file)
+        self.labels = [label.encode('UTF-8') for label in samples['labels']]
+        self.comments = [comment.encode('UTF-8') for comment in samples['comments']]
+        self.words = [
+            np.array([DataGen.GO_ID] + [charmap.index(char) for char in label]
+                     + [DataGen.EOS_ID], dtype=np.int32)
+            for label in samples['labels']]
+        self.images = np.memmap(os.path.join(path, 'images.u8'), dtype=np.uint8, mode='r',
+                                shape=tuple(samples['shape']))
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def build(cls, path, data_path, max_width, max_height, max_prediction, channels,
+              batch_size=64, num_parallel_reads=1, num_parallel_calls=1, charmap=None):
+        """Read and decode a dataset into `path` like the model input does, the
+        resized images being rounded to uint8 pixels."""
+        image_width = resized_max_width(max_width, max_height, DataGen.IMAGE_HEIGHT)
+        buckets = [(int(math.ceil(image_width / 4)), max_prediction + 2)]
+        # The records are read in the graph of the session decoding them.
+        graph = tf.Graph()
+        with graph.as_default():
+            s_gen = DataGen(
+                data_path,
+                buckets,
+                epochs=1,
+                max_width=max_width,
+                shuffle_buffer_size=0,
+                num_parallel_reads=num_parallel_reads,
+                num_parallel_calls=num_parallel_calls,
+                image_width=image_width,
+                channels=channels,
+                charmap=charmap
+            )
+
+        sample_size = DataGen.IMAGE_HEIGHT * image_width * channels
+        num_samples = s_gen.count_records()
+        logging.info('Decoding %i samples into %s (%.1f MB).',
+                     num_samples, path, num_samples * sample_size / 2 ** 20)
+
+        with graph.as_default():
+            img_pl = tf.placeholder(tf.string, [None])
+            images = tf.map_fn(
+                lambda img: prepare_image(img, image_width, DataGen.IMAGE_HEIGHT, channels),
+                img_pl, dtype=tf.float32)
+            images = tf.saturate_cast(tf.round(images), tf.uint8)
+
+        labels, comments = [], []
+        with tf.Session(graph=graph) as sess, \
+                open(os.path.join(path, 'images.u8'), 'wb') as images_file:
+            for batch in s_gen.gen(batch_size, drop_remainder=False):
+                if batch.get('preprocessed'):
+                    # Padded from uint8 pixels, so the conversion is exact.
+                    data = batch['data'].astype(np.uint8)
+                else:
+                    data = sess.run(images, {img_pl: batch['data']})
+                images_file.write(np.ascontiguousarray(data).tobytes())
+                labels.extend(label.decode('UTF-8') for label in batch['labels'])
+                comments.extend(comment.decode('UTF-8') for comment in batch['comments'])
+
+        if not labels:
+            raise ValueError('No samples in {}.'.format(data_path))
+        with open(os.path.join(path, 'samples.json'), 'w') as samples_file:
+            json.dump({
+                'shape': [len(labels), DataGen.IMAGE_HEIGHT, image_width, channels],
+                'labels': labels,
+                'comments': comments,
+            }, samples_file)
+        return cls(path, charmap)
+
+    def batches(self, batch_size, bucket_specs):
+        """Yield batches in the format of `DataGen.gen`, holding the decoded images."""
+        bucket = BucketData(capacity=batch_size, decoder_input_len=bucket_specs[-1][1])
+        buffer = np.empty((batch_size,) + self.images.shape[1:], dtype=np.float32)
+        for start in range(0, len(self), batch_size):
+            end = min(start + batch_size, len(self))
+            for idx in range(start, end):
+                bucket.append(None, self.words[idx], self.labels[idx], self.comments[idx])
+            batch = bucket.flush_out(bucket_specs, go_shift=1)
+            batch['data'] = buffer[:end - start]
+            batch['data'][...] = self.images[start:end]
+            batch['preprocessed'] = True
+            yield batch
+
+
+def _test_checkpoint(args):
+    """Restore one checkpoint in a new session and evaluate it on a decoded dataset."""
+    model_params, decoded_path, log_step = args
+    with tf.Graph().as_default(), \
+            tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        model = Model(session=sess, **model_params)
+        return model.test(None, log_step=log_step, decoded=DecodedDataset(decoded_path, model.charmap))
+
+
+def checkpoint_step(checkpoint_path):
+    match = re.search(r'-(\d+)$', checkpoint_path)
+    return int(match.group(1)) if match else 0
+
+
+def test_checkpoints(model_params, test_params, workers, full_ascii=False,
+                     summary_path=None, export_path=None, export_format='savedmodel'):
+    """Evaluate every checkpoint of the checkpoint state of the model directory.
+
+    The dataset is decoded once and shared by all the evaluations, which
+    run in a pool of `workers` processes. A summary table is written to
+    `summary_path`, and the best checkpoint, by accuracy, is exported to
+    `export_path` if it is set. Returns the path of the best checkpoint.
+    """
+    state = tf.train.get_checkpoint_state(model_params['model_dir'])
+    if state is None or not state.all_model_checkpoint_paths:
+        raise ValueError('No checkpoints in {}.'.format(model_params['model_dir']))
+    checkpoints = list(state.all_model_checkpoint_paths)
+    summary_path = summary_path or os.path.join(model_params['model_dir'], 'evaluation.tsv')
+
+    decoded_path = tempfile.mkdtemp(prefix='aocr-decoded-')
+    try:
+        logging.info('Decoding the dataset once for %i checkpoints.', len(checkpoints))
+        decoded = DecodedDataset.build(
+            decoded_path,
+            test_params['data_path'],
+            model_params['max_image_width'],
+            model_params['max_image_height'],
+            model_params['max_prediction_length'],
+            model_params['channels'],
+            batch_size=model_params['batch_size'],
+            num_parallel_reads=test_params.get('num_parallel_reads', 1),
+            num_parallel_calls=test_params.get('num_parallel_calls', 1),
+            charmap=model_params.get('charmap'))
+        logging.info('Decoded %i samples.', len(decoded))
+
+        tasks = [(dict(model_params, checkpoint_path=checkpoint, visualize=False),
+                  decoded_path, test_params.get('log_step', 500))
+                 for checkpoint in checkpoints]
+        workers = max(1, min(workers, len(checkpoints)))
+        if workers == 1:
+            results = [_test_checkpoint(task) for task in tasks]
+        else:
+            context = multiprocessing.get_context('spawn')
+            pool = context.Pool(workers, initializer=_init_worker, initargs=(full_ascii,))
+            try:
+                results = pool.map(_test_checkpoint, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        shutil.rmtree(decoded_path, ignore_errors=True)
+
+    rows = []
+    for checkpoint, sums in zip(checkpoints, results):
+        rates = EvaluationMetrics.rates(sums)
+        rates['loss'] = sums['loss'] / max(rates['samples'], 1)
+        rows.append((checkpoint, checkpoint_step(checkpoint), rates))
+    best = max(rows, key=lambda row: (row[2]['accuracy'], -row[2]['cer'], row[1]))
+
+    columns = ('samples', 'accuracy', 'exact_match', 'cer', 'wer', 'loss')
+    with tf.gfile.GFile(summary_path, 'w') as summary:
+        summary.write('\t'.join(('checkpoint', 'step') + columns) + '\n')
+        for checkpoint, step, rates in rows:
+            summary.write('\t'.join([checkpoint, str(step)]
+                                    + ['{:.6g}'.format(rates[column]) for column in columns])
+                          + '\n')
+    for checkpoint, step, rates in rows:
+        logging.info('%s step %i: accuracy %6.2f%%, CER %6.2f%%, WER %6.2f%%, loss %f.%s',
+                     checkpoint, step, 100. * rates['accuracy'], 100. * rates['cer'],
+                     100. * rates['wer'], rates['loss'], ' (best)' if checkpoint == best[0] else '')
+    logging.info('Summary written to %s.', summary_path)
+
+    if export_path:
+        logging.info('Exporting %s to %s.', best[0], export_path)
+        with tf.Graph().as_default(), \
+                tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+            model = Model(session=sess, **dict(model_params, phase='export', visualize=False,
+                                               checkpoint_path=best[0]))
+            Exporter(model).save(export_path, export_format)
+
+    return best[0]
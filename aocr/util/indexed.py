@@ -0,0 +1,135 @@
+"""
+Indexed random-access record store.
+
+A shard is made of a data file holding the concatenated fields of every
+record, and an index file (``<shard>.idx``, in the NumPy ``.npy`` format)
+holding, per record, the offsets of its fields in the data file along with
+the image size and the label length. The data file is memory-mapped when
+read, so records can be accessed in any order without a scan.
+"""
+
+from __future__ import absolute_import
+
+import mmap
+import os
+
+import numpy as np
+
+from PIL import Image
+from six import BytesIO as IO
+
+
+INDEX_SUFFIX = '.idx'
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('image_length', '<u4'),
+    ('pixels_length', '<u4'),
+    ('label_length', '<u4'),
+    ('comment_length', '<u4'),
+    ('height', '<u4'),
+    ('width', '<u4'),
+    ('label_chars', '<u4'),
+])
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def is_indexed(path):
+    """Whether `path` is the data file of an indexed shard."""
+    return os.path.exists(index_path(path))
+
+
+def image_size(image):
+    """Height and width of an encoded image, read from its header only."""
+    try:
+        width, height = Image.open(IO(image)).size
+    except (IOError, ValueError):
+        return 0, 0
+    return height, width
+
+
+class IndexedWriter(object):
+    """Writes records to an indexed shard at `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.data_file = open(path, 'wb')
+        self.offset = 0
+        self.entries = []
+
+    def write(self, image, pixels, height, width, label, comment):
+        """Append a record; `image` is the encoded image and `pixels` the
+        preprocessed uint8 tensor, either of which may be empty. The size of
+        encoded images is read from their header when no pixels are given."""
+        if not len(pixels):
+            height, width = image_size(image)
+        label_bytes = label.encode('UTF-8')
+        comment_bytes = comment.encode('UTF-8')
+        for field in (image, pixels, label_bytes, comment_bytes):
+            self.data_file.write(field)
+        self.entries.append((self.offset, len(image), len(pixels), len(label_bytes),
+                             len(comment_bytes), height, width, len(label)))
+        self.offset += len(image) + len(pixels) + len(label_bytes) + len(comment_bytes)
+
+    def close(self):
+        self.data_file.close()
+        with open(index_path(self.path), 'wb') as index_file:
+            np.save(index_file, np.array(self.entries, dtype=INDEX_DTYPE))
+
+
+class IndexedReader(object):
+    """Random access to the records of one or more indexed shards.
+
+    `index` holds the index entries of all the shards, with a `shard`
+    field added, so records can be selected with NumPy operations on the
+    label lengths and image sizes without touching the data files.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.data = []
+        indices = []
+        for shard, path in enumerate(paths):
+            index = np.load(index_path(path))
+            entries = np.empty(len(index), dtype=INDEX_DTYPE.descr + [('shard', '<u4')])
+            for name in INDEX_DTYPE.names:
+                entries[name] = index[name]
+            entries['shard'] = shard
+            indices.append(entries)
+
+            with open(path, 'rb') as data_file:
+                if os.fstat(data_file.fileno()).st_size:
+                    self.data.append(mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ))
+                else:
+                    self.data.append(b'')
+        self.index = np.concatenate(indices) if indices else np.empty(0, INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        """Return ``(image, pixels, height, width, label, comment)`` for a record.
+
+        The image is a zero-copy memoryview and the pixels a zero-copy uint8
+        array over the memory-mapped data file.
+        """
+        entry = self.index[idx]
+        data = memoryview(self.data[entry['shard']])
+        offset = int(entry['offset'])
+
+        image_end = offset + int(entry['image_length'])
+        pixels_end = image_end + int(entry['pixels_length'])
+        label_end = pixels_end + int(entry['label_length'])
+        comment_end = label_end + int(entry['comment_length'])
+
+        pixels = np.frombuffer(data[image_end:pixels_end], dtype=np.uint8)
+        return (data[offset:image_end], pixels, int(entry['height']), int(entry['width']),
+                data[pixels_end:label_end].tobytes(), data[label_end:comment_end].tobytes())
+
+    def close(self):
+        for data in self.data:
+            if isinstance(data, mmap.mmap):
+                data.close()
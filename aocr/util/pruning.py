@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+import tensorflow as tf
+
+from ..model.cnn import STRIPPABLE_LAYERS
+from ..model.metrics import EvaluationMetrics
+from ..model.model import Model
+from ..model.pruning import prunable_variables, variable_sparsity
+from .benchmark import synthetic_batch, time_steps
+
+
+def variable_values(sess):
+    """Values of all the global variables of the graph of `sess`, by name."""
+    variables = tf.global_variables()
+    return dict(zip([var.op.name for var in variables], sess.run(variables)))
+
+
+def _output_weights(values, layer):
+    """Weights of `layer` that produce its output channels, on the last axis."""
+    if layer + '/W_pointwise' in values:
+        return values[layer + '/W_pointwise']
+    return values[layer + '/W']
+
+
+def strip_pruned_filters(values):
+    """Remove the output channels of the backbone layers whose weights were
+    all pruned, along with the weights that read them in the next layer.
+
+    Such channels are always zero, as these layers have neither bias nor
+    batch normalization, so the stripped backbone computes the same
+    function. Returns the number of filters of the stripped layers, as
+    expected by `CNN`, and the stripped values.
+    """
+    values = dict(values)
+    filters = {}
+    for layer, next_layer in sorted(STRIPPABLE_LAYERS.items()):
+        weights = _output_weights(values, layer)
+        channels = weights.shape[-1]
+        keep = np.flatnonzero(np.any(weights.reshape(-1, channels) != 0, axis=0))
+        if len(keep) == channels:
+            continue
+        # Keep a channel so that the layer still exists.
+        keep = keep if len(keep) else np.arange(1)
+        logging.info('%s: %i of %i filters left.', layer, len(keep), channels)
+        filters[layer] = len(keep)
+
+        for name in ('/W', '/W_pointwise'):
+            if layer + name in values:
+                values[layer + name] = values[layer + name][..., keep]
+        for name in ('/W', '/W_depthwise', '/W_pointwise'):
+            if next_layer + name in values:
+                values[next_layer + name] = values[next_layer + name][:, :, keep, :]
+    return filters, values
+
+
+def model_from_values(session, model_params, values, architecture, filters=None, phase='export'):
+    """Build a model in the default graph with `session`, from the variable
+    `values` of a model with the given `architecture` (see
+    `Model.resolve_architecture`), instead of restoring a checkpoint."""
+    params = dict(model_params)
+    params.update(architecture)
+    model_dir = tempfile.mkdtemp(prefix='aocr-model-')
+    try:
+        model = Model(session=session, **dict(
+            params, phase=phase, model_dir=model_dir, load_model=False,
+            checkpoint_path=None, visualize=False, filters=filters))
+    finally:
+        shutil.rmtree(model_dir, ignore_errors=True)
+    for var in tf.global_variables():
+        if var.op.name in values:
+            var.load(values[var.op.name], session)
+    return model
+
+
+def restore_values(model_params, model_dir):
+    """Variable values and architecture of the latest checkpoint of `model_dir`."""
+    with tf.Graph().as_default(), \
+            tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        model = Model(session=sess, **dict(model_params, phase='export', model_dir=model_dir,
+                                           load_model=True, checkpoint_path=None,
+                                           visualize=False))
+        return variable_values(sess), model.architecture
+
+
+def pruning_report(model_params, data_path, baseline_model_dir, batch_size=64, num_steps=20,
+                   test_params=None):
+    """Compare a pruned model (in ``model_params['model_dir']``), with and
+    without its pruned filters stripped, to the model it was pruned from:
+    parameters, sparsity, compressed size, CPU inference time and metrics
+    on a test dataset."""
+    test_params = test_params or {}
+    model_params = dict(model_params, batch_size=batch_size, gpu_id=-1)
+    baseline_values, baseline_architecture = restore_values(model_params, baseline_model_dir)
+    pruned_values, pruned_architecture = restore_values(model_params, model_params['model_dir'])
+    filters, stripped_values = strip_pruned_filters(pruned_values)
+
+    rows = []
+    for name, values, architecture, layer_filters in (
+            ('baseline', baseline_values, baseline_architecture, None),
+            ('pruned', pruned_values, pruned_architecture, None),
+            ('pruned, stripped', stripped_values, pruned_architecture, filters)):
+        with tf.Graph().as_default(), \
+                tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+            model = model_from_values(sess, model_params, values, architecture,
+                                      filters=layer_filters, phase='test')
+            weights = variable_values(sess)
+            prunable = dict((var.op.name, weights[var.op.name])
+                            for var in prunable_variables())
+            trainable = [weights[var.op.name] for var in tf.trainable_variables()]
+            sums = model.test(data_path, **test_params)
+            step_time = time_steps(model, synthetic_batch(model, batch_size), True, num_steps, 3)
+
+        rows.append((name,
+                     sum(value.size for value in trainable),
+                     variable_sparsity(prunable),
+                     sum(len(zlib.compress(value.tobytes())) for value in trainable),
+                     step_time,
+                     EvaluationMetrics.rates(sums)))
+
+    logging.info('%-18s %10s %9s %15s %13s %9s %7s', 'model', 'params', 'sparsity',
+                 'compressed MB', 'CPU ms/batch', 'accuracy', 'CER')
+    for name, params, sparsity, compressed, step_time, rates in rows:
+        logging.info('%-18s %9.2fM %8.1f%% %15.2f %13.1f %8.2f%% %6.2f%%', name, params / 1e6,
+                     100. * sparsity, compressed / 1e6, 1000. * step_time,
+                     100. * rates['accuracy'], 100. * rates['cer'])
+    return rows
@@ -0,0 +1,132 @@
+"""
+Dataset statistics recorded next to a dataset, used to size the model to the data.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import logging
+import math
+import re
+from collections import Counter
+
+import tensorflow as tf
+
+from .data_gen import DataGen, resized_max_width
+
+
+STATS_SUFFIX = '.stats.json'
+
+
+def stats_path(output_path):
+    return output_path + STATS_SUFFIX
+
+
+def input_width(height, width, image_height=DataGen.IMAGE_HEIGHT):
+    """Width of an image once resized for the model, before padding."""
+    if height <= image_height:
+        return width
+    return int(math.ceil(1. * width / height * image_height))
+
+
+class DatasetStats(object):
+    """Distributions of the image sizes and label lengths of a dataset."""
+
+    FIELDS = ('width', 'height', 'input_width', 'label_length')
+
+    def __init__(self):
+        self.histograms = dict((field, Counter()) for field in self.FIELDS)
+
+    def add(self, height, width, label_length):
+        self.histograms['width'][width] += 1
+        self.histograms['height'][height] += 1
+        self.histograms['input_width'][input_width(height, width)] += 1
+        self.histograms['label_length'][label_length] += 1
+
+    def __iadd__(self, other):
+        for field in self.FIELDS:
+            self.histograms[field].update(other.histograms[field])
+        return self
+
+    def __len__(self):
+        return sum(self.histograms['label_length'].values())
+
+    def quantile(self, field, coverage):
+        """Smallest value that at least a `coverage` fraction of the samples does not exceed."""
+        histogram = self.histograms[field]
+        needed = int(math.ceil(coverage * len(self)))
+        seen = 0
+        for value in sorted(histogram):
+            seen += histogram[value]
+            if seen >= needed:
+                return value
+        return max(histogram) if histogram else 0
+
+    def save(self, path):
+        content = {'samples': len(self)}
+        for field in self.FIELDS:
+            content[field] = dict((str(value), count) for value, count
+                                  in sorted(self.histograms[field].items()))
+        with tf.gfile.GFile(path, 'w') as stats_file:
+            json.dump(content, stats_file, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls()
+        with tf.gfile.GFile(path, 'r') as stats_file:
+            content = json.load(stats_file)
+        for field in cls.FIELDS:
+            stats.histograms[field].update(dict(
+                (int(value), count) for value, count in content.get(field, {}).items()))
+        return stats
+
+
+def find_stats(dataset_paths):
+    """Find the statistics written by `aocr dataset` for the given dataset files or patterns.
+
+    The statistics of a sharded dataset are named after the output path of
+    the build, without the shard suffix.
+    """
+    if isinstance(dataset_paths, (str, bytes)):
+        dataset_paths = [dataset_paths]
+    for path in dataset_paths:
+        candidates = [path,
+                      re.sub(r'(-\d{4})?-\d{5}-of-\d{5}$', '', path),
+                      re.sub(r'-?\*.*$', '', path)]
+        for candidate in candidates:
+            if candidate and tf.gfile.Exists(stats_path(candidate)):
+                return stats_path(candidate)
+    return None
+
+
+def recommend_shape(stats, coverage, max_height):
+    """Return the ``(max_width, max_prediction)`` that fit the dataset.
+
+    The width is chosen so that a `coverage` fraction of the images fits the
+    model input without being shrunk; wider images are still usable. Labels
+    longer than `max_prediction` cannot be learned at all, so the longest one
+    always sets it.
+    """
+    width = stats.quantile('input_width', coverage)
+    max_width = int(math.ceil(1. * width * max_height / DataGen.IMAGE_HEIGHT))
+    max_prediction = stats.quantile('label_length', 1.)
+    return max(max_width, 1), max(max_prediction, 1)
+
+
+def log_savings(old_shape, new_shape):
+    """Log how much smaller the unrolled graph gets with `new_shape`.
+
+    Shapes are ``(max_width, max_height, max_prediction)`` tuples.
+    """
+    def sizes(shape):
+        width = resized_max_width(shape[0], shape[1], DataGen.IMAGE_HEIGHT)
+        return width, int(math.ceil(width / 4)), shape[2] + 2
+
+    old_width, old_encoder, old_decoder = sizes(old_shape)
+    new_width, new_encoder, new_decoder = sizes(new_shape)
+    logging.info('Model input width %i -> %i, encoder steps %i -> %i, decoder steps %i -> %i.',
+                 old_width, new_width, old_encoder, new_encoder, old_decoder, new_decoder)
+    logging.info('Relative cost: CNN and encoder %.0f%%, decoder %.0f%%, attention %.0f%%.',
+                 100. * new_width / old_width, 100. * new_decoder / old_decoder,
+                 100. * new_encoder * new_decoder / (old_encoder * old_decoder))
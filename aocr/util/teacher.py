@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+from ..model.model import Model
+from .data_gen import DataGen
+
+
+class Teacher(object):
+    """A trained model, restored in its own graph and session and kept frozen,
+    that computes the soft targets of the batches of a distillation.
+
+    The teacher is run in forward-only mode, with the labels fed to its
+    decoder like in training, so that its outputs line up with those of the
+    student. With `cache_size`, the soft targets of up to that many samples
+    are kept in memory, keyed by the comment and label of the sample, and
+    the teacher only runs on the samples of a batch that are not cached yet;
+    samples without a comment are never cached. The cache holds the targets
+    of the first version of each sample seen, so it is only exact when the
+    samples are not augmented.
+
+    :param model_params: keyword arguments of `Model`, except the session;
+        the backbone recorded in `model_dir` takes precedence, but the
+        character map and the prediction length must match those of the student
+    :param model_dir: directory of the teacher checkpoints
+    :param temperature: softmax temperature of the soft targets
+    :param cache_size: maximum number of cached samples, 0 to disable the cache
+    """
+
+    def __init__(self, model_params, model_dir, temperature=1.0, cache_size=0):
+        if tf.train.get_checkpoint_state(model_dir) is None:
+            raise ValueError('No checkpoint in the teacher model directory {}.'.format(model_dir))
+
+        logging.info('Loading the teacher model from %s.', model_dir)
+        charmap = list(model_params.get('charmap') or DataGen.CHARMAP)
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph,
+                               config=tf.ConfigProto(allow_soft_placement=True))
+        try:
+            with self.graph.as_default():
+                self.model = Model(session=self.sess, **dict(
+                    model_params, phase='teacher', model_dir=model_dir, load_model=True,
+                    checkpoint_path=None, visualize=False, teacher_forcing=True,
+                    distillation_weight=0.))
+                self.soft_targets = tf.nn.softmax(
+                    tf.stack(self.model.logits, axis=1) / temperature)
+            self.graph.finalize()
+            self._check_outputs(model_dir, charmap, model_params['max_prediction_length'])
+        except Exception:
+            self.sess.close()
+            raise
+
+        self.cache = {} if cache_size else None
+        self.cache_size = cache_size
+        self.cache_hits = 0
+
+    def _check_outputs(self, model_dir, charmap, max_prediction_length):
+        """Make sure that the soft targets line up with the outputs of the student."""
+        architecture = self.model.architecture
+        if list(architecture['charmap']) != charmap:
+            raise ValueError(
+                'The teacher model in {} was trained with a different character map '
+                '({} characters) than the student ({} characters).'.format(
+                    model_dir, len(architecture['charmap']), len(charmap)))
+        if architecture['max_prediction_length'] != max_prediction_length:
+            raise ValueError(
+                'The teacher model in {} predicts {} characters, the student {}.'.format(
+                    model_dir, architecture['max_prediction_length'], max_prediction_length))
+
+    def __call__(self, batch):
+        """``[batch, decoder steps, vocabulary]`` soft targets of a batch."""
+        if self.cache is None:
+            return self.sess.run(self.soft_targets, self.model.input_feed(batch))
+
+        keys = [comment + b'\0' + label if comment else None
+                for comment, label in zip(batch['comments'], batch['labels'])]
+        soft_targets = [self.cache.get(key) for key in keys]
+        missing = [idx for idx, soft in enumerate(soft_targets) if soft is None]
+        self.cache_hits += len(keys) - len(missing)
+
+        if missing:
+            computed = self.sess.run(self.soft_targets,
+                                     self.model.input_feed(self._rows(batch, missing)))
+            for idx, soft in zip(missing, computed):
+                soft_targets[idx] = soft
+                if keys[idx] is not None and len(self.cache) < self.cache_size:
+                    self.cache[keys[idx]] = soft.astype(np.float16)
+        return np.stack(soft_targets).astype(np.float32)
+
+    @staticmethod
+    def _rows(batch, rows):
+        """The inputs of the given rows of a batch."""
+        if len(rows) == len(batch['labels']):
+            return batch
+        return dict(batch,
+                    data=np.asarray(batch['data'])[rows],
+                    labels=[batch['labels'][idx] for idx in rows],
+                    comments=[batch['comments'][idx] for idx in rows],
+                    decoder_inputs=batch['decoder_inputs'][:, rows],
+                    target_weights=batch['target_weights'][:, rows])
+
+    def close(self):
+        self.sess.close()
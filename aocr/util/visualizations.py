@@ -1,9 +1,15 @@
 from __future__ import absolute_import
 from __future__ import division
 
+import heapq
+import itertools
+import logging
 import math
+import multiprocessing
 import os
+import threading
 
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 
 import numpy as np
@@ -11,6 +17,32 @@ import numpy as np
 from PIL import Image
 
 
+_NAME_COUNTERS = {}
+
+
+def _unique_dir(output_dir, filestring):
+    """Create a new directory named `filestring`, or `filestring-N` if it is
+    taken, in `output_dir`.
+
+    Names are claimed atomically with `mkdir`, and the next suffix to try is
+    remembered, so naming takes constant time however full the directory is.
+    """
+    key = (output_dir, filestring)
+    idx = _NAME_COUNTERS.get(key, 1)
+    while True:
+        name = filestring if idx == 1 else '{}-{}'.format(filestring, idx)
+        path = os.path.join(output_dir, name.replace('/', '_'))
+        try:
+            os.mkdir(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            idx += 1
+            continue
+        _NAME_COUNTERS[key] = idx + 1
+        return path
+
+
 def visualize_attention(filename, output_dir, attentions, pred, pad_width,
                         pad_height, threshold=1, normalize=False,
                         binarize=True, ground=None, flag=None):
@@ -18,8 +50,8 @@ def visualize_attention(filename, output_dir, attentions, pred, pad_width,
 
     Parameters
     ----------
-    filename : string
-        Input filename.
+    filename : string, bytes or array
+        Input filename, encoded image or decoded uint8 image array.
     output_dir : string
         Output directory for visualizations.
     attentions : array of shape [len(pred), attention_size]
@@ -46,22 +78,14 @@ def visualize_attention(filename, output_dir, attentions, pred, pad_width,
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     if flag is None:
-        filestring = 'predict-{}'.format(str(pred))
-        idx = 2
-        while filestring in os.listdir(output_dir):
-            filestring = 'predict-{}-{}'.format(str(pred), idx)
-            idx += 1
-        out_dir = output_dir
-    elif flag:
-        filestring = os.path.splitext(os.path.basename(filename))[0]
-        out_dir = os.path.join(output_dir, 'incorrect')
+        out_dir = _unique_dir(output_dir, 'predict-{}'.format(str(pred)))
     else:
         filestring = os.path.splitext(os.path.basename(filename))[0]
-        out_dir = os.path.join(output_dir, 'correct')
-    out_dir = os.path.join(out_dir, filestring.replace('/', '_'))
+        out_dir = os.path.join(output_dir, 'incorrect' if flag else 'correct')
+        out_dir = os.path.join(out_dir, filestring.replace('/', '_'))
 
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
 
     with open(os.path.join(out_dir, 'word.txt'), 'w') as fword:
         fword.write(pred + '\n')
@@ -71,6 +95,9 @@ def visualize_attention(filename, output_dir, attentions, pred, pad_width,
         if isinstance(filename, str):
             img_file = open(filename, 'rb')
             img = Image.open(img_file)
+        elif isinstance(filename, np.ndarray):
+            img = Image.fromarray(filename.squeeze(axis=-1) if filename.shape[-1] == 1
+                                  else filename)
         else:
             img = Image.open(BytesIO(filename))
 
@@ -168,3 +195,57 @@ def map_attentions(img_data, attentions, pred, pad_width, pad_height,
         img_out_agg += attention
 
     return img_out_frames, img_out_agg
+
+
+class VisualizationWriter(object):
+    """Renders attention visualizations in a pool of background processes.
+
+    At most `max_pending` visualizations are queued: `submit` blocks beyond
+    that, so a slow disk cannot make the queue grow without bounds. With
+    `lowest`, only the `lowest` samples with the smallest probability are
+    kept, and rendered when the writer is closed.
+    """
+
+    def __init__(self, workers=2, max_pending=64, lowest=0):
+        # Workers are spawned rather than forked: the parent process holds a
+        # TensorFlow session, which is not fork-safe.
+        self.executor = ProcessPoolExecutor(workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lowest = lowest
+        self.candidates = []
+        self.counter = itertools.count()
+        self.errors = 0
+
+    def _done(self, future):
+        self.pending.release()
+        if future.exception() is not None:
+            self.errors += 1
+            logging.error('Visualization failed: %s', future.exception())
+
+    def _render(self, args, kwargs):
+        self.pending.acquire()
+        future = self.executor.submit(visualize_attention, *args, **kwargs)
+        future.add_done_callback(self._done)
+
+    def submit(self, probability, *args, **kwargs):
+        """Queue a visualization; the arguments are those of `visualize_attention`."""
+        if not self.lowest:
+            self._render(args, kwargs)
+            return
+        # Keep the samples with the lowest probabilities in a bounded heap,
+        # whose top is the most probable one.
+        entry = (-probability, next(self.counter), args, kwargs)
+        if len(self.candidates) < self.lowest:
+            heapq.heappush(self.candidates, entry)
+        else:
+            heapq.heappushpop(self.candidates, entry)
+
+    def close(self):
+        """Render the kept samples, if any, and wait for all the visualizations."""
+        for _, _, args, kwargs in sorted(self.candidates, key=lambda entry: -entry[0]):
+            self._render(args, kwargs)
+        self.candidates = []
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            logging.error('%i visualizations failed.', self.errors)
@@ -0,0 +1,83 @@
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from aocr.util.archive import Archive, is_archive
+
+MEMBERS = [('images/%d.jpg' % idx, b'image-%d' % idx) for idx in range(6)]
+
+
+def write_tar(path, mode):
+    with tarfile.open(path, mode) as tar:
+        for name, data in MEMBERS:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def write_zip(path):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, data in MEMBERS:
+            archive.writestr(name, data)
+    return path
+
+
+@pytest.fixture(params=['tar', 'tar.gz', 'zip'])
+def archive_path(request, tmp_path):
+    path = str(tmp_path / ('images.' + request.param))
+    if request.param == 'zip':
+        return write_zip(path)
+    return write_tar(path, 'w:gz' if request.param == 'tar.gz' else 'w')
+
+
+def test_is_archive(archive_path, tmp_path):
+    assert is_archive(archive_path)
+    text_path = tmp_path / 'annotations.txt'
+    text_path.write_text(u'images/0.jpg label\n')
+    assert not is_archive(str(text_path))
+    assert not is_archive(str(tmp_path / 'missing.tar'))
+
+
+def test_members(archive_path):
+    archive = Archive(archive_path)
+    assert list(archive.members()) == MEMBERS
+    assert list(archive.members(names=['images/1.jpg', 'images/4.jpg'])) == \
+        [MEMBERS[1], MEMBERS[4]]
+    archive.close()
+
+
+def test_members_stops_after_the_last_name(archive_path, monkeypatch):
+    archive = Archive(archive_path)
+    read = []
+    if archive.zip is not None:
+        zip_read = archive.zip.read
+        monkeypatch.setattr(archive.zip, 'read',
+                            lambda info: read.append(info.filename) or zip_read(info))
+        assert list(archive.members(names=['images/2.jpg'])) == [MEMBERS[2]]
+        assert read == ['images/2.jpg']
+    else:
+        extractfile = tarfile.TarFile.extractfile
+        monkeypatch.setattr(tarfile.TarFile, 'extractfile',
+                            lambda tar, member: read.append(member.name)
+                            or extractfile(tar, member))
+        members = archive.members(names=['images/2.jpg'])
+        assert next(members) == MEMBERS[2]
+        assert list(members) == []
+        assert read == ['images/2.jpg']
+    archive.close()
+
+
+def test_read_many(archive_path):
+    archive = Archive(archive_path)
+    items = ['./images/3.jpg', 'images/0.jpg', 'images/missing.jpg', 'images/3.jpg']
+    results = list(archive.read_many(items))
+    archive.close()
+
+    found = sorted((item, data) for item, data, error in results if error is None)
+    assert found == [('./images/3.jpg', b'image-3'), ('images/0.jpg', b'image-0'),
+                     ('images/3.jpg', b'image-3')]
+    errors = [(item, data) for item, data, error in results if error is not None]
+    assert errors == [('images/missing.jpg', None)]
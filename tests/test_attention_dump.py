@@ -0,0 +1,80 @@
+import csv
+import os
+
+import numpy as np
+from PIL import Image
+
+from aocr.util.attention_dump import INDEX_COLUMNS, AttentionDump, AttentionDumpWriter
+
+
+def write_dump(path, batch_sizes, chunk_size):
+    rng = np.random.RandomState(0)
+    writer = AttentionDumpWriter(path, chunk_size=chunk_size)
+    samples = []
+    for batch_size in batch_sizes:
+        attentions = rng.rand(batch_size, 6, 10).astype(np.float32)
+        images = rng.uniform(0, 255, (batch_size, 32, 40, 1)).astype(np.float32)
+        predictions = ['P%d' % (len(samples) + idx) for idx in range(batch_size)]
+        grounds = ['G%d' % (len(samples) + idx) for idx in range(batch_size)]
+        probabilities = rng.rand(batch_size)
+        incorrect = (rng.rand(batch_size) > 0.5).astype(np.float32)
+        comments = ['image-%d.jpg' % (len(samples) + idx) for idx in range(batch_size)]
+        writer.add_batch(attentions, images, predictions, grounds, probabilities, incorrect,
+                         comments)
+        for idx in range(batch_size):
+            samples.append((attentions[idx], images[idx], predictions[idx], grounds[idx],
+                            probabilities[idx], incorrect[idx], comments[idx]))
+    writer.close()
+    return samples
+
+
+def test_dump_round_trip(tmp_path):
+    path = str(tmp_path / 'dump')
+    # Batches straddling the chunk boundaries.
+    samples = write_dump(path, [3, 5, 4, 1], chunk_size=4)
+    dump = AttentionDump(path)
+    assert len(dump) == len(samples) == 13
+    assert dump.meta == {'samples': 13, 'chunks': 4, 'chunk_size': 4}
+
+    with open(os.path.join(path, 'index.tsv')) as index_file:
+        rows = list(csv.reader(index_file, delimiter='\t'))
+    assert tuple(rows[0]) == INDEX_COLUMNS
+
+    for sample, (attentions, image, pred, ground, probability, incorrect, comment) in \
+            enumerate(samples):
+        entry = dump.index[sample]
+        assert int(entry['sample']) == sample
+        assert (int(entry['chunk']), int(entry['row'])) == divmod(sample, 4)
+        assert (entry['prediction'], entry['ground'], entry['comment']) == \
+            (pred, ground, comment)
+        assert float(entry['probability']) == np.round(probability, 6)
+        assert float(entry['incorrect']) == incorrect
+
+        np.testing.assert_array_equal(dump.attentions(sample), attentions)
+        chunk_images = dump.chunk(int(entry['chunk']))[1]
+        np.testing.assert_array_equal(chunk_images[int(entry['row'])],
+                                      np.clip(np.round(image), 0, 255).astype(np.uint8))
+
+
+def test_select(tmp_path):
+    path = str(tmp_path / 'dump')
+    samples = write_dump(path, [7], chunk_size=4)
+    dump = AttentionDump(path)
+    assert dump.select() == list(range(7))
+    assert dump.select(mistakes=True) == [idx for idx, sample in enumerate(samples)
+                                          if sample[5]]
+    lowest = sorted(range(7), key=lambda idx: samples[idx][4])[:3]
+    assert dump.select(lowest=3) == sorted(lowest)
+
+
+def test_render(tmp_path):
+    path = str(tmp_path / 'dump')
+    write_dump(path, [5], chunk_size=4)
+    dump = AttentionDump(path)
+    output_dir = str(tmp_path / 'render')
+    dump.render(output_dir, [1, 4])
+    assert sorted(os.listdir(output_dir)) == ['00000001.png', '00000004.png']
+    # The model input followed by one row per predicted character.
+    strip = np.asarray(Image.open(os.path.join(output_dir, '00000004.png')))
+    assert strip.shape == (32 * (len('P4') + 1), 40)
+    np.testing.assert_array_equal(strip[:32], dump.chunk(1)[1][0][..., 0])
@@ -0,0 +1,73 @@
+import numpy as np
+
+from aocr.util.bucketdata import BucketData
+
+
+def reference_flush_out(labels, decoder_input_len, valid_target_length=float('inf'),
+                        go_shift=1):
+    """The list-based `BucketData.flush_out` of the previous implementation."""
+    padded = []
+    target_weights = []
+    for label in labels:
+        label_len = len(label)
+        padded.append(np.concatenate((label, np.zeros(decoder_input_len - label_len,
+                                                       dtype=np.int32))))
+        one_mask_len = min(label_len - go_shift, valid_target_length)
+        target_weights.append(np.concatenate((
+            np.ones(one_mask_len, dtype=np.float32),
+            np.zeros(decoder_input_len - one_mask_len, dtype=np.float32))))
+    return ([a.astype(np.int32) for a in np.array(padded).T],
+            [a.astype(np.float32) for a in np.array(target_weights).T])
+
+
+def random_samples(rng, num_samples, decoder_input_len):
+    samples = []
+    for idx in range(num_samples):
+        length = rng.randint(2, decoder_input_len + 1)
+        label = np.concatenate([[1], rng.randint(3, 40, size=length - 2), [2]]).astype(np.int32)
+        samples.append((b'image-%d' % idx, label, b'label-%d' % idx, b'comment-%d' % idx))
+    return samples
+
+
+def check_batch(res, samples, decoder_input_len, **kwargs):
+    decoder_inputs, target_weights = reference_flush_out(
+        [sample[1] for sample in samples], decoder_input_len, **kwargs)
+    assert len(res['decoder_inputs']) == decoder_input_len
+    for step in range(decoder_input_len):
+        np.testing.assert_array_equal(res['decoder_inputs'][step], decoder_inputs[step])
+        np.testing.assert_array_equal(res['target_weights'][step], target_weights[step])
+        assert res['decoder_inputs'][step].dtype == np.int32
+        assert res['target_weights'][step].dtype == np.float32
+    assert list(res['data']) == [sample[0] for sample in samples]
+    assert list(res['labels']) == [sample[2] for sample in samples]
+    assert list(res['comments']) == [sample[3] for sample in samples]
+
+
+def test_flush_out_matches_previous_output():
+    rng = np.random.RandomState(0)
+    bucket = BucketData()
+    samples = random_samples(rng, 7, 10)
+    for sample in samples:
+        bucket.append(*sample)
+    check_batch(bucket.flush_out([(40, 10)]), samples, 10)
+    assert len(bucket) == 0
+
+
+def test_fixed_capacity_buffers_are_reused():
+    rng = np.random.RandomState(1)
+    bucket = BucketData(capacity=8, decoder_input_len=10)
+    for num_samples in (8, 8, 3):
+        samples = random_samples(rng, num_samples, 10)
+        for sample in samples:
+            bucket.append(*sample)
+        check_batch(bucket.flush_out([(40, 10)]), samples, 10)
+
+
+def test_valid_target_length():
+    rng = np.random.RandomState(2)
+    bucket = BucketData(capacity=4, decoder_input_len=10)
+    samples = random_samples(rng, 4, 10)
+    for sample in samples:
+        bucket.append(*sample)
+    check_batch(bucket.flush_out([(40, 10)], valid_target_length=3), samples, 10,
+                valid_target_length=3)
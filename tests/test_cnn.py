@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.model.cnn import CNN  # noqa: E402
+
+# (filters, kernel size, batch normalization) of the layers of the backbone.
+LAYERS = [(64, 3, False), (128, 3, False), (256, 3, True), (256, 3, False),
+          (512, 3, True), (512, 3, False), (512, 2, True)]
+
+
+def expected_parameters(backbone, width_multiplier, channels=1):
+    total = 0
+    inputs = channels
+    for idx, (filters, size, bn) in enumerate(LAYERS):
+        filters = max(8, int(round(filters * width_multiplier)))
+        if backbone == 'separable' and idx:
+            total += size * size * inputs + inputs * filters
+        else:
+            total += size * size * inputs * filters
+        if bn:
+            # Scale and offset of the batch normalization.
+            total += 2 * filters
+        inputs = filters
+    return total
+
+
+def backbone_parameters(backbone, width_multiplier, channels=1):
+    with tf.Graph().as_default():
+        images = tf.placeholder(tf.float32, [None, 32, 100, channels])
+        features = CNN(images, False, backbone=backbone,
+                       width_multiplier=width_multiplier).tf_output()
+        output_depth = features.get_shape().as_list()[-1]
+        params = sum(np.prod(var.get_shape().as_list()) for var in tf.trainable_variables())
+    return params, output_depth
+
+
+@pytest.mark.parametrize('backbone', ['vgg', 'separable'])
+@pytest.mark.parametrize('width_multiplier', [1.0, 0.5])
+def test_backbone_parameters(backbone, width_multiplier):
+    params, output_depth = backbone_parameters(backbone, width_multiplier)
+    assert params == expected_parameters(backbone, width_multiplier)
+    assert output_depth == int(512 * width_multiplier)
+
+
+def test_half_width_backbone_is_about_a_quarter_of_the_parameters():
+    full, _ = backbone_parameters('vgg', 1.0)
+    half, _ = backbone_parameters('vgg', 0.5)
+    assert (full, half) == (5549120, 1388064)
+    assert 0.24 < half / full < 0.26
+    separable, _ = backbone_parameters('separable', 1.0)
+    assert separable < full / 7
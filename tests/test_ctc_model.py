@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.model.ctc_model import CTCModel  # noqa: E402
+
+EOS_ID = 2
+NUM_SYMBOLS = 6
+BLANK = NUM_SYMBOLS
+ENCODER_SIZE = 6
+
+# Best paths: the repeated 3s are separated by a blank, the 5s of the
+# second sample too, and its last two positions are masked out.
+PATHS = [[3, 3, BLANK, 3, 4, BLANK],
+         [5, BLANK, 5, 5, 3, 3]]
+LENGTHS = [6, 4]
+
+
+def decode(beam_width=0):
+    """Decode logits peaked on `PATHS` with the CTC head; returns the
+    predictions, the probabilities and the logits."""
+    rng = np.random.RandomState(0)
+    logits = rng.uniform(-1., 1., (ENCODER_SIZE, len(PATHS), NUM_SYMBOLS + 1))
+    for idx, path in enumerate(PATHS):
+        logits[np.arange(ENCODER_SIZE), idx, path] += 5.
+    masks = (np.arange(ENCODER_SIZE) < np.array(LENGTHS)[:, np.newaxis]).astype(np.float32)
+
+    with tf.Graph().as_default():
+        encoder_inputs = tf.zeros([ENCODER_SIZE, len(PATHS), 4])
+        decoder_inputs = [tf.zeros([len(PATHS)], tf.int32)] * 4
+        model = CTCModel(tf.split(tf.constant(masks), ENCODER_SIZE, axis=1), encoder_inputs,
+                         decoder_inputs, NUM_SYMBOLS, EOS_ID, ENCODER_SIZE, num_hidden=3,
+                         beam_width=beam_width)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            predictions, probability = sess.run(
+                [model.predictions, model.probability], {model.logits: logits})
+    return predictions, probability, logits
+
+
+def test_greedy_decoding():
+    predictions, probability, logits = decode()
+    np.testing.assert_array_equal(predictions, [[3, 3, 4, EOS_ID], [5, 5, EOS_ID, EOS_ID]])
+
+    # The probability of the best path, over the unmasked positions.
+    softmax = np.exp(logits) / np.exp(logits).sum(axis=2, keepdims=True)
+    expected = [np.prod(softmax[:length, idx].max(axis=1))
+                for idx, length in enumerate(LENGTHS)]
+    np.testing.assert_allclose(probability, expected, rtol=1e-5)
+
+
+def test_beam_search_decoding():
+    predictions, probability, _ = decode(beam_width=4)
+    np.testing.assert_array_equal(predictions, [[3, 3, 4, EOS_ID], [5, 5, EOS_ID, EOS_ID]])
+    greedy_probability = decode()[1]
+    # The prefix sums the probabilities of all its alignments.
+    assert np.all(probability >= greedy_probability * (1 - 1e-5))
@@ -0,0 +1,71 @@
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.util.data_gen import DataGen  # noqa: E402
+
+
+def write_records(tmp_path, num_files, records_per_file):
+    paths = []
+    for file_idx in range(num_files):
+        path = str(tmp_path / ('records-%d.tfrecords' % file_idx))
+        with tf.python_io.TFRecordWriter(path) as writer:
+            for idx in range(records_per_file):
+                writer.write(b'record-%d-%d' % (file_idx, idx))
+        paths.append(path)
+    return paths
+
+
+def read_records(paths, **kwargs):
+    with tf.Graph().as_default():
+        data = DataGen(paths, [(40, 10)], epochs=1, **kwargs)
+        next_record = data.dataset.make_one_shot_iterator().get_next()
+        records = []
+        with tf.Session() as sess:
+            while True:
+                try:
+                    records.append(sess.run(next_record))
+                except tf.errors.OutOfRangeError:
+                    return records
+
+
+def read_shards(paths, num_shards, **kwargs):
+    return [read_records(paths, num_shards=num_shards, shard_index=shard_index, **kwargs)
+            for shard_index in range(num_shards)]
+
+
+@pytest.mark.parametrize('num_shards', [3, 5])
+def test_record_shards_match_single_process(tmp_path, num_shards):
+    # Fewer files than shards: the records are split.
+    paths = write_records(tmp_path, 2, 50)
+    expected = read_records(paths, shuffle_buffer_size=0)
+    assert len(expected) == 100
+
+    for kwargs in ({'shuffle_buffer_size': 0},
+                   {'shuffle_buffer_size': 0, 'num_parallel_reads': 2},
+                   {'shuffle_buffer_size': 20, 'num_parallel_reads': 2}):
+        shards = read_shards(paths, num_shards, **kwargs)
+        assert sorted(sum(shards, [])) == sorted(expected)
+        if not kwargs['shuffle_buffer_size']:
+            single = read_records(paths, **kwargs)
+            assert shards == [single[idx::num_shards] for idx in range(num_shards)]
+
+
+def test_file_shards_match_single_process(tmp_path):
+    paths = write_records(tmp_path, 4, 10)
+    expected = read_records(paths, shuffle_buffer_size=0)
+    shards = read_shards(paths, 2, shuffle_buffer_size=20, num_parallel_reads=2)
+    assert sorted(sum(shards, [])) == sorted(expected)
+
+
+def test_count_records(tmp_path):
+    paths = write_records(tmp_path, 3, 7)
+    assert DataGen(paths, [(40, 10)], num_shards=2).count_records() == 21
+
+
+def test_charmap(tmp_path):
+    paths = write_records(tmp_path, 1, 1)
+    data = DataGen(paths, [(40, 10)], charmap=['', '', ''] + list('ab'))
+    assert data.convert_lex(b'ba').tolist() == [DataGen.GO_ID, 4, 3, DataGen.EOS_ID]
+    assert DataGen(paths, [(40, 10)]).convert_lex(b'A1').tolist() == [
+        DataGen.GO_ID, DataGen.CHARMAP.index('A'), DataGen.CHARMAP.index('1'), DataGen.EOS_ID]
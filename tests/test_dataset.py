@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from aocr.util.dataset import DedupIndex, _plan_shards, _read_lines  # noqa: E402
+
+
+def write_annotations(path, num_lines):
+    with open(path, 'w') as annotations:
+        for idx in range(num_lines):
+            annotations.write('images/%d.jpg label%d\n' % (idx, idx))
+    return str(path)
+
+
+def planned_lines(annotations_path, shards):
+    return [[line for _, line in _read_lines(annotations_path, ranges)] for ranges in shards]
+
+
+def test_plan_shards_is_deterministic(tmp_path):
+    annotations_path = write_annotations(tmp_path / 'annotations.txt', 23)
+    shards = _plan_shards(annotations_path, 4, None)
+    assert shards == _plan_shards(annotations_path, 4, None)
+    assert [sum(count for _, _, count in ranges) for ranges in shards] == [6, 6, 6, 5]
+
+    lines = [line for shard in planned_lines(annotations_path, shards) for line in shard]
+    with open(annotations_path) as annotations:
+        assert lines == annotations.readlines()
+
+
+def test_plan_shards_by_records_per_shard(tmp_path):
+    annotations_path = write_annotations(tmp_path / 'annotations.txt', 10)
+    # The split only depends on the number of records per shard.
+    shards = _plan_shards(annotations_path, 2, 3)
+    assert shards == _plan_shards(annotations_path, 8, 3)
+    assert [sum(count for _, _, count in ranges) for ranges in shards] == [3, 3, 3, 1]
+
+
+def test_plan_shards_skips_paths(tmp_path):
+    annotations_path = write_annotations(tmp_path / 'annotations.txt', 10)
+    skip_paths = {'images/1.jpg', 'images/2.jpg', 'images/6.jpg'}
+    shards = _plan_shards(annotations_path, 2, None, skip_paths=skip_paths)
+    assert [[(first, count) for first, _, count in ranges] for ranges in shards] == \
+        [[(0, 1), (3, 3)], [(7, 3)]]
+    assert [line.split()[0] for shard in planned_lines(annotations_path, shards)
+            for line in shard] == ['images/%d.jpg' % idx for idx in (0, 3, 4, 5, 7, 8, 9)]
+
+
+def add_entries(index, entries):
+    return [index.add(digest, line_no, label) for line_no, (digest, label) in enumerate(entries)]
+
+
+def test_dedup_index_spills_to_sqlite(tmp_path):
+    entries = [(b'%d' % (idx % 7), 'label%d' % (idx % 5)) for idx in range(30)]
+    in_memory = DedupIndex(str(tmp_path / 'memory.sqlite'), len(entries))
+    expected = add_entries(in_memory, entries)
+    assert in_memory.db is None
+    assert expected[:7] == [None] * 7
+    assert expected[7] == (0, 'label0')
+
+    path = str(tmp_path / 'index.sqlite')
+    spilled = DedupIndex(path, 3)
+    assert add_entries(spilled, entries) == expected
+    assert spilled.db is not None
+    assert os.path.exists(path)
+    spilled.close()
+    assert not os.path.exists(path)
@@ -0,0 +1,90 @@
+import io
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from PIL import Image  # noqa: E402
+
+from aocr.util.data_gen import DataGen, prepare_image, resized_max_width  # noqa: E402
+from aocr.util.evaluation import DecodedDataset  # noqa: E402
+
+MAX_WIDTH = 100
+MAX_HEIGHT = 32
+MAX_PREDICTION = 8
+IMAGE_WIDTH = resized_max_width(MAX_WIDTH, MAX_HEIGHT, DataGen.IMAGE_HEIGHT)
+BUCKET_SPECS = [(int(np.ceil(IMAGE_WIDTH / 4)), MAX_PREDICTION + 2)]
+
+
+def bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def write_records(path, num_samples, preprocessed):
+    rng = np.random.RandomState(0)
+    with tf.python_io.TFRecordWriter(path) as writer:
+        for idx in range(num_samples):
+            # Images no higher than the model input are not resized.
+            pixels = rng.randint(0, 256, (DataGen.IMAGE_HEIGHT, rng.randint(10, 90), 1))
+            pixels = pixels.astype(np.uint8)
+            features = {
+                'label': bytes_feature(str(1000 + idx * 37).encode('UTF-8')),
+                'comment': bytes_feature(b'image-%d' % idx),
+            }
+            if preprocessed:
+                features.update(pixels=bytes_feature(pixels.tobytes()),
+                                height=int64_feature(pixels.shape[0]),
+                                width=int64_feature(pixels.shape[1]))
+            else:
+                png = io.BytesIO()
+                Image.fromarray(pixels[..., 0], 'L').save(png, 'PNG')
+                features.update(image=bytes_feature(png.getvalue()))
+            writer.write(tf.train.Example(
+                features=tf.train.Features(feature=features)).SerializeToString())
+    return path
+
+
+def model_inputs(batch):
+    """Images of a `DataGen.gen` batch, as the model input computes them."""
+    if batch.get('preprocessed'):
+        return batch['data']
+    with tf.Graph().as_default(), tf.Session() as sess:
+        img_pl = tf.placeholder(tf.string, [None])
+        images = tf.map_fn(
+            lambda img: prepare_image(img, IMAGE_WIDTH, DataGen.IMAGE_HEIGHT, 1),
+            img_pl, dtype=tf.float32)
+        return sess.run(images, {img_pl: batch['data']})
+
+
+@pytest.mark.parametrize('preprocessed', [False, True])
+def test_decoded_batches_match_data_gen(tmp_path, preprocessed):
+    records = write_records(str(tmp_path / 'test.tfrecords'), 11, preprocessed)
+    decoded_path = tmp_path / 'decoded'
+    decoded_path.mkdir()
+    decoded = DecodedDataset.build(str(decoded_path), records, MAX_WIDTH, MAX_HEIGHT,
+                                   MAX_PREDICTION, 1, batch_size=4)
+    assert len(decoded) == 11
+    assert decoded.images.dtype == np.uint8
+
+    s_gen = DataGen(records, BUCKET_SPECS, epochs=1, max_width=MAX_WIDTH,
+                    shuffle_buffer_size=0, image_width=IMAGE_WIDTH, channels=1)
+    # Both reuse their buffers from one batch to the next.
+    num_batches = 0
+    for batch, expected in zip(decoded.batches(4, BUCKET_SPECS),
+                               s_gen.gen(4, drop_remainder=False)):
+        num_batches += 1
+        assert batch['preprocessed']
+        assert batch['data'].dtype == np.float32
+        np.testing.assert_array_equal(batch['data'], model_inputs(expected))
+        assert list(batch['labels']) == list(expected['labels'])
+        assert list(batch['comments']) == list(expected['comments'])
+        for key in ('decoder_inputs', 'target_weights'):
+            assert len(batch[key]) == len(expected[key])
+            for step, expected_step in zip(batch[key], expected[key]):
+                np.testing.assert_array_equal(step, expected_step)
+    assert num_batches == 3
@@ -0,0 +1,61 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from aocr.util.dataset import Manifest, _temp_path  # noqa: E402
+
+
+def write_temp_shard(path):
+    with open(_temp_path(path), 'wb') as shard:
+        shard.write(b'records')
+
+
+def test_resume_from_committed_shards(tmp_path):
+    output = str(tmp_path / 'train.tfrecords')
+    manifest_path = output + '.manifest'
+    shard = output + '-0000-00000-of-00001'
+
+    manifest = Manifest(manifest_path, 'path')
+    write_temp_shard(shard)
+    manifest.commit(0, shard, ['a.jpg', 'b.jpg'])
+    assert os.path.exists(shard)
+    assert not os.path.exists(_temp_path(shard))
+
+    resumed = Manifest(manifest_path, 'path')
+    assert resumed.keys == {'a.jpg', 'b.jpg'}
+    assert resumed.shards == [shard]
+    assert resumed.next_run == 1
+
+
+def test_resume_finishes_recorded_commit_and_drops_incomplete_shards(tmp_path):
+    output = str(tmp_path / 'train.tfrecords')
+    manifest_path = output + '.manifest'
+    committed = output + '-0000-00000-of-00002'
+    incomplete = output + '-0000-00001-of-00002'
+
+    # Interrupted between the manifest entry and the rename of its shard,
+    # while another shard was still being written.
+    write_temp_shard(committed)
+    write_temp_shard(incomplete)
+    with open(manifest_path, 'w') as manifest:
+        manifest.write(json.dumps({'run': 0, 'shard': committed, 'key_type': 'path',
+                                   'keys': ['a.jpg']}) + '\n')
+
+    resumed = Manifest(manifest_path, 'path')
+    assert os.path.exists(committed)
+    assert not os.path.exists(_temp_path(committed))
+    assert not os.path.exists(_temp_path(incomplete))
+    assert resumed.keys == {'a.jpg'}
+    assert resumed.next_run == 1
+
+
+def test_key_type_mismatch(tmp_path):
+    manifest_path = str(tmp_path / 'train.tfrecords.manifest')
+    with open(manifest_path, 'w') as manifest:
+        manifest.write(json.dumps({'run': 0, 'shard': 'x', 'key_type': 'hash',
+                                   'keys': []}) + '\n')
+    with pytest.raises(ValueError):
+        Manifest(manifest_path, 'path')
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.model.metrics import EvaluationMetrics  # noqa: E402
+
+EOS_ID = 2
+CHARMAP = ['', '', ''] + [chr(i) for i in range(32, 127)]
+
+SAMPLES = [
+    # (prediction, label)
+    ('HELLO', 'HELLO'),
+    ('HELO', 'HELLO'),
+    ('WORLD', 'WORD'),
+    ('ABCDEFGHIJ', 'XY'),
+    ('', ''),
+    ('A', ''),
+    ('', 'ABC'),
+    ('NEW YORK', 'NEW YORK CITY'),
+    ('THE CAT', 'THE BAT'),
+]
+
+
+def levenshtein(seq1, seq2):
+    row = list(range(len(seq2) + 1))
+    for idx1, item1 in enumerate(seq1, 1):
+        previous, row[0] = row[0], idx1
+        for idx2, item2 in enumerate(seq2, 1):
+            previous, row[idx2] = row[idx2], min(row[idx2] + 1, row[idx2 - 1] + 1,
+                                                  previous + (item1 != item2))
+    return row[-1]
+
+
+def previous_accuracy(output, ground):
+    """Per-sample accuracy of the previous `Model.test` loop."""
+    if not ground:
+        incorrect = 1 if output else 0
+    else:
+        incorrect = min(1., levenshtein(output, ground) / len(ground))
+    return 1. - incorrect
+
+
+def encode(texts, length, junk=()):
+    ids = np.zeros((len(texts), length), dtype=np.int64)
+    for row, text in enumerate(texts):
+        seq = [CHARMAP.index(char) for char in text] + [EOS_ID] + list(junk)
+        ids[row, :len(seq)] = seq
+    return ids
+
+
+def evaluate(samples, use_distance):
+    predictions, labels = zip(*samples)
+    length = max(len(text) for text in predictions + labels) + 3
+    with tf.Graph().as_default():
+        table = tf.contrib.lookup.MutableHashTable(
+            key_dtype=tf.int64, value_dtype=tf.string, default_value='', checkpoint=True)
+        insert = table.insert(tf.constant(list(range(len(CHARMAP))), dtype=tf.int64),
+                              tf.constant(CHARMAP))
+        # Anything after the first EOS of a prediction is ignored.
+        metrics = EvaluationMetrics(tf.constant(encode(predictions, length, junk=[40, 41])),
+                                    tf.constant(encode(labels, length)),
+                                    table, EOS_ID, use_distance=use_distance)
+        with tf.Session() as sess:
+            sess.run(insert)
+            sess.run(metrics.reset)
+            sess.run(metrics.update)
+            return metrics.result(sess)
+
+
+def test_accuracy_matches_previous_evaluation():
+    sums = evaluate(SAMPLES, use_distance=True)
+    assert sums['samples'] == len(SAMPLES)
+    np.testing.assert_allclose(
+        sums['correct'], sum(previous_accuracy(output, ground) for output, ground in SAMPLES))
+    assert sums['exact'] == sum(output == ground for output, ground in SAMPLES)
+
+
+def test_exact_match_accuracy():
+    sums = evaluate(SAMPLES, use_distance=False)
+    assert sums['correct'] == sum(output == ground for output, ground in SAMPLES)
+
+
+def test_error_rate_sums():
+    sums = evaluate(SAMPLES, use_distance=True)
+    assert sums['char_errors'] == sum(levenshtein(output, ground) for output, ground in SAMPLES)
+    assert sums['chars'] == sum(len(ground) for _, ground in SAMPLES)
+    assert sums['word_errors'] == sum(levenshtein(output.split(), ground.split())
+                                      for output, ground in SAMPLES)
+    assert sums['words'] == sum(len(ground.split()) for _, ground in SAMPLES)
+
+    rates = EvaluationMetrics.rates(sums)
+    assert rates['samples'] == len(SAMPLES)
+    np.testing.assert_allclose(rates['cer'], sums['char_errors'] / sums['chars'])
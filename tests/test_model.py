@@ -0,0 +1,32 @@
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.model.model import Model  # noqa: E402
+from aocr.util.data_gen import DataGen  # noqa: E402
+
+CHARMAP = ['', '', ''] + list('0123456789')
+
+
+def build_model(model_dir, **kwargs):
+    with tf.Graph().as_default():
+        sess = tf.Session()
+        return Model(phase='test', visualize=False, output_dir=str(model_dir / 'out'),
+                     batch_size=2, initial_learning_rate=1.0, steps_per_checkpoint=10,
+                     model_dir=str(model_dir), target_embedding_size=4, attn_num_hidden=16,
+                     attn_num_layers=2, clip_gradients=True, max_gradient_norm=5.0,
+                     session=sess, load_model=False, gpu_id=-1, use_gru=False,
+                     max_image_width=40, max_prediction_length=4, **kwargs)
+
+
+def test_charmap_is_a_parameter(tmp_path):
+    global_charmap = list(DataGen.CHARMAP)
+    model = build_model(tmp_path / 'digits', charmap=CHARMAP)
+    assert DataGen.CHARMAP == global_charmap
+    assert model.charmap == CHARMAP
+    assert model.architecture['charmap'] == CHARMAP
+    assert all(logits.get_shape().as_list()[-1] == len(CHARMAP) for logits in model.logits)
+
+    default = build_model(tmp_path / 'default')
+    assert default.charmap == global_charmap
+    assert default.logits[0].get_shape().as_list()[-1] == len(global_charmap)
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.model.pruning import MagnitudePruning, sparsity_schedule  # noqa: E402
+from aocr.util.pruning import strip_pruned_filters  # noqa: E402
+
+LAYERS = ['conv_conv%d' % idx for idx in range(1, 8)]
+
+
+def conv(inputs, weights):
+    """Valid convolution of a ``[height, width, channels]`` array."""
+    height, width = weights.shape[:2]
+    rows, cols = inputs.shape[0] - height + 1, inputs.shape[1] - width + 1
+    return sum(np.dot(inputs[dy:dy + rows, dx:dx + cols], weights[dy, dx])
+               for dy in range(height) for dx in range(width))
+
+
+def depthwise_conv(inputs, weights):
+    height, width = weights.shape[:2]
+    rows, cols = inputs.shape[0] - height + 1, inputs.shape[1] - width + 1
+    return sum(inputs[dy:dy + rows, dx:dx + cols] * weights[dy, dx, :, 0]
+               for dy in range(height) for dx in range(width))
+
+
+def backbone(values, inputs):
+    net = inputs
+    for layer in LAYERS:
+        if layer + '/W' in values:
+            net = conv(net, values[layer + '/W'])
+        else:
+            net = conv(depthwise_conv(net, values[layer + '/W_depthwise']),
+                       values[layer + '/W_pointwise'])
+        net = np.maximum(net, 0.)
+    return net
+
+
+def random_values(rng, separable, num_filters=6):
+    values = {}
+    channels = 1
+    for idx, layer in enumerate(LAYERS):
+        if separable and idx:
+            values[layer + '/W_depthwise'] = rng.randn(3, 3, channels, 1)
+            values[layer + '/W_pointwise'] = rng.randn(1, 1, channels, num_filters)
+        else:
+            values[layer + '/W'] = rng.randn(3, 3, channels, num_filters)
+        channels = num_filters
+    return values
+
+
+def prune_filters(values, layer, filters):
+    name = layer + '/W_pointwise' if layer + '/W_pointwise' in values else layer + '/W'
+    values[name][..., filters] = 0.
+
+
+@pytest.mark.parametrize('separable', [False, True])
+def test_strip_pruned_filters_computes_the_same_function(separable):
+    rng = np.random.RandomState(0)
+    values = random_values(rng, separable)
+    prune_filters(values, 'conv_conv1', [1, 4])
+    prune_filters(values, 'conv_conv2', [2, 3])
+    prune_filters(values, 'conv_conv4', [0])
+    # conv_conv3 is followed by a batch normalization, its filters stay.
+    prune_filters(values, 'conv_conv3', [5])
+
+    filters, stripped = strip_pruned_filters(values)
+    assert filters == {'conv_conv1': 4, 'conv_conv2': 4, 'conv_conv4': 5}
+    if separable:
+        assert stripped['conv_conv2/W_depthwise'].shape == (3, 3, 4, 1)
+        assert stripped['conv_conv2/W_pointwise'].shape == (1, 1, 4, 4)
+    else:
+        assert stripped['conv_conv2/W'].shape == (3, 3, 4, 4)
+    assert stripped['conv_conv6/W' if not separable else 'conv_conv6/W_pointwise'].shape[-1] == 6
+
+    inputs = rng.randn(17, 17, 1)
+    outputs = backbone(values, inputs)
+    assert np.any(outputs != 0)
+    np.testing.assert_allclose(backbone(stripped, inputs), outputs)
+
+
+def test_strip_keeps_a_filter_of_fully_pruned_layers():
+    values = random_values(np.random.RandomState(1), False)
+    prune_filters(values, 'conv_conv6', slice(None))
+    filters, stripped = strip_pruned_filters(values)
+    assert filters == {'conv_conv6': 1}
+    assert stripped['conv_conv6/W'].shape == (3, 3, 6, 1)
+    assert stripped['conv_conv7/W'].shape == (3, 3, 1, 6)
+
+
+def test_sparsity_schedule():
+    assert sparsity_schedule(0, 100, 0.1, 0.8) == pytest.approx(0.1)
+    assert sparsity_schedule(100, 100, 0.1, 0.8) == pytest.approx(0.8)
+    assert sparsity_schedule(500, 100, 0.1, 0.8) == pytest.approx(0.8)
+    steps = [sparsity_schedule(step, 100, 0., 0.8) for step in range(0, 101, 10)]
+    assert steps == sorted(steps)
+
+
+def test_pruning_resumes_from_the_saved_start(tmp_path):
+    checkpoint = str(tmp_path / 'model.ckpt')
+    with tf.Graph().as_default():
+        weights = tf.Variable(np.arange(1., 11.).reshape(2, 5), dtype=tf.float32)
+        pruning = MagnitudePruning([weights])
+        saver = tf.train.Saver(tf.global_variables())
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(pruning.init_masks)
+            assert pruning.start(sess, 1000, 0.8) == (1000, 0.)
+            sess.run(pruning.update_masks, {pruning.sparsity: 0.3})
+            saver.save(sess, checkpoint)
+
+        with tf.Session() as sess:
+            saver.restore(sess, checkpoint)
+            sess.run(pruning.init_masks)
+            assert pruning.current_sparsity(sess) == pytest.approx(0.3)
+            # The same pruning resumes where it started, at any later step.
+            assert pruning.start(sess, 1500, 0.8) == (1000, 0.)
+            # Another target starts over, from the current sparsity.
+            start_step, initial_sparsity = pruning.start(sess, 1500, 0.9)
+            assert start_step == 1500
+            assert initial_sparsity == pytest.approx(0.3)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.model.seq2seq import embedding_attention_decoder  # noqa: E402
+
+BATCH_SIZE = 3
+ATTN_LENGTH = 12
+ATTN_SIZE = 10
+NUM_HIDDEN = 8
+NUM_SYMBOLS = 7
+DECODER_STEPS = 5
+
+
+def inputs(seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.randn(BATCH_SIZE, ATTN_LENGTH, ATTN_SIZE).astype(np.float32),
+            rng.randn(BATCH_SIZE, 2 * NUM_HIDDEN).astype(np.float32),
+            rng.randint(0, NUM_SYMBOLS, (DECODER_STEPS, BATCH_SIZE)).astype(np.int32))
+
+
+def decode(checkpoint, save, feed_previous=False, **options):
+    """Run the attention decoder on fixed inputs, saving its variables to
+    `checkpoint` or restoring them; returns the outputs, the attention
+    weights and the variable shapes."""
+    attention_states, initial_state, decoder_inputs = inputs()
+    with tf.Graph().as_default():
+        cell = tf.contrib.rnn.BasicLSTMCell(NUM_HIDDEN, forget_bias=0.0, state_is_tuple=False)
+        outputs, _, attentions = embedding_attention_decoder(
+            [tf.constant(step) for step in decoder_inputs], tf.constant(initial_state),
+            tf.constant(attention_states), cell, num_symbols=NUM_SYMBOLS, embedding_size=6,
+            output_size=NUM_SYMBOLS, feed_previous=feed_previous, attn_num_hidden=NUM_HIDDEN,
+            **options)
+        shapes = dict((var.op.name, var.get_shape().as_list())
+                      for var in tf.global_variables())
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            if save:
+                sess.run(tf.global_variables_initializer())
+                saver.save(sess, checkpoint)
+            else:
+                saver.restore(sess, checkpoint)
+            outputs, attentions = sess.run([outputs, attentions])
+    return np.array(outputs), np.array(attentions), shapes
+
+
+@pytest.mark.parametrize('feed_previous', [False, True])
+def test_matmul_attention_matches_default_attention(tmp_path, feed_previous):
+    checkpoint = str(tmp_path / 'model.ckpt')
+    expected, expected_attentions, shapes = decode(checkpoint, True, feed_previous)
+    outputs, attentions, matmul_shapes = decode(checkpoint, False, feed_previous,
+                                                matmul_attention=True)
+    assert matmul_shapes == shapes
+    assert attentions.shape == (DECODER_STEPS, BATCH_SIZE, ATTN_LENGTH)
+    np.testing.assert_allclose(attentions, expected_attentions, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(outputs, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('attention_window', [ATTN_LENGTH // 2, ATTN_LENGTH])
+def test_window_covering_the_full_width_matches_full_attention(tmp_path, attention_window):
+    checkpoint = str(tmp_path / 'model.ckpt')
+    expected, expected_attentions, shapes = decode(checkpoint, True, True)
+    outputs, attentions, window_shapes = decode(checkpoint, False, True,
+                                                attention_window=attention_window)
+    assert window_shapes == shapes
+    np.testing.assert_allclose(attentions, expected_attentions, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(outputs, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_narrow_window_only_attends_around_the_focus(tmp_path):
+    checkpoint = str(tmp_path / 'model.ckpt')
+    decode(checkpoint, True)
+    _, attentions, _ = decode(checkpoint, False, attention_window=2)
+    # At most 2 * 2 + 1 positions get any weight, starting from the left.
+    assert np.all(np.count_nonzero(attentions, axis=2) <= 5)
+    assert np.all(attentions[0, :, 5:] == 0)
+    np.testing.assert_allclose(attentions.sum(axis=2), 1., rtol=1e-5)
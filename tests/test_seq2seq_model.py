@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.model.seq2seq_model import (ConcatStateLSTMBlockCell,  # noqa: E402
+                                      bidirectional_encoder)
+
+NUM_HIDDEN = 8
+TIME_STEPS = 5
+DEPTH = 6
+
+
+def build_encoder(fused_lstm, inputs):
+    inputs_pl = [tf.constant(step) for step in inputs]
+    outputs, state_fw, state_bw = bidirectional_encoder(inputs_pl, NUM_HIDDEN, fused_lstm)
+    return tf.stack(outputs), state_fw, state_bw
+
+
+def build_cell(fused_lstm, inputs, state):
+    with tf.variable_scope('decoder'):
+        if fused_lstm:
+            cell = ConcatStateLSTMBlockCell(NUM_HIDDEN)
+        else:
+            cell = tf.contrib.rnn.BasicLSTMCell(NUM_HIDDEN, forget_bias=0.0,
+                                                state_is_tuple=False)
+        return cell(tf.constant(inputs), tf.constant(state))
+
+
+def variable_shapes():
+    return dict((var.op.name, var.get_shape().as_list()) for var in tf.global_variables())
+
+
+def run(build, fused_lstm, checkpoint, save):
+    """Build a model, save its variables to `checkpoint` or restore them,
+    and return its outputs and variable shapes."""
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        outputs = build(fused_lstm)
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            if save:
+                sess.run(tf.global_variables_initializer())
+                saver.save(sess, checkpoint)
+            else:
+                saver.restore(sess, checkpoint)
+            return sess.run(outputs), variable_shapes()
+
+
+@pytest.mark.parametrize('model', ['encoder', 'cell'])
+def test_fused_lstm_loads_unfused_checkpoints(tmp_path, model):
+    rng = np.random.RandomState(0)
+    if model == 'encoder':
+        inputs = rng.randn(TIME_STEPS, 3, DEPTH).astype(np.float32)
+
+        def build(fused_lstm):
+            return build_encoder(fused_lstm, inputs)
+    else:
+        inputs = rng.randn(3, DEPTH).astype(np.float32)
+        state = rng.randn(3, 2 * NUM_HIDDEN).astype(np.float32)
+
+        def build(fused_lstm):
+            return build_cell(fused_lstm, inputs, state)
+
+    checkpoint = str(tmp_path / 'model.ckpt')
+    expected, unfused_variables = run(build, False, checkpoint, save=True)
+    outputs, fused_variables = run(build, True, checkpoint, save=False)
+
+    assert fused_variables == unfused_variables
+    assert len(unfused_variables) == (4 if model == 'encoder' else 2)
+    assert len(outputs) == len(expected)
+    for output, expected_output in zip(outputs, expected):
+        np.testing.assert_allclose(output, expected_output, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from aocr.util import teacher as teacher_module  # noqa: E402
+from aocr.util.data_gen import DataGen  # noqa: E402
+
+STUDENT_CHARMAP = ['', '', ''] + list('0123456789')
+
+
+class FakeModel(object):
+    """Stands for a restored model with the recorded architecture."""
+
+    charmap = STUDENT_CHARMAP
+    max_prediction_length = 8
+
+    def __init__(self, **kwargs):
+        self.architecture = {'charmap': list(self.charmap),
+                             'max_prediction_length': self.max_prediction_length}
+        # The images of the batches are the logits of every decoder step.
+        self.images = tf.placeholder(tf.float32, [None, len(self.charmap)])
+        self.logits = [self.images] * (self.max_prediction_length + 2)
+        self.fed_batches = []
+
+    def input_feed(self, batch):
+        self.fed_batches.append(batch)
+        return {self.images: batch['data']}
+
+
+@pytest.fixture
+def fake_teacher(monkeypatch):
+    monkeypatch.setattr(teacher_module, 'Model', FakeModel)
+    monkeypatch.setattr(tf.train, 'get_checkpoint_state', lambda model_dir: True)
+    monkeypatch.setattr(DataGen, 'CHARMAP', list(STUDENT_CHARMAP))
+    return FakeModel
+
+
+def make_teacher(**kwargs):
+    return teacher_module.Teacher(
+        {'charmap': list(STUDENT_CHARMAP), 'max_prediction_length': 8}, 'teacher', **kwargs)
+
+
+def make_batch(comments, seed=0):
+    images = np.random.RandomState(seed).randn(len(comments), len(STUDENT_CHARMAP))
+    steps = FakeModel.max_prediction_length + 2
+    return {'data': images.astype(np.float32),
+            'labels': [b'123'] * len(comments),
+            'comments': list(comments),
+            'decoder_inputs': np.zeros((steps, len(comments)), dtype=np.int32),
+            'target_weights': np.zeros((steps, len(comments)), dtype=np.float32)}
+
+
+def expected_soft_targets(batch):
+    exp = np.exp(batch['data'] - batch['data'].max(axis=1, keepdims=True))
+    soft = exp / exp.sum(axis=1, keepdims=True)
+    return np.repeat(soft[:, np.newaxis], FakeModel.max_prediction_length + 2, axis=1)
+
+
+def test_matching_teacher(fake_teacher):
+    teacher = make_teacher()
+    teacher.close()
+
+
+def test_charmap_mismatch(fake_teacher, monkeypatch):
+    monkeypatch.setattr(fake_teacher, 'charmap', ['', '', ''] + list('0123456789AB'))
+    with pytest.raises(ValueError, match='character map'):
+        make_teacher()
+
+
+def test_prediction_length_mismatch(fake_teacher, monkeypatch):
+    monkeypatch.setattr(fake_teacher, 'max_prediction_length', 12)
+    with pytest.raises(ValueError, match='predicts 12 characters'):
+        make_teacher()
+
+
+def test_uncached_teacher(fake_teacher):
+    teacher = make_teacher()
+    batch = make_batch([b'a', b'b'])
+    np.testing.assert_allclose(teacher(batch), expected_soft_targets(batch), rtol=1e-5)
+    np.testing.assert_allclose(teacher(batch), expected_soft_targets(batch), rtol=1e-5)
+    assert teacher.cache is None
+    assert len(teacher.model.fed_batches) == 2
+    teacher.close()
+
+
+def test_cache_only_runs_the_teacher_on_missing_rows(fake_teacher):
+    teacher = make_teacher(cache_size=10)
+    first = make_batch([b'a', b'b', b''])
+    np.testing.assert_allclose(teacher(first), expected_soft_targets(first), rtol=1e-5)
+    # Samples without a comment are not cached.
+    assert len(teacher.cache) == 2
+
+    second = make_batch([b'b', b'c', b'', b'a'], seed=1)
+    second['data'][[0, 3]] = first['data'][[1, 0]]
+    soft_targets = teacher(second)
+    np.testing.assert_allclose(soft_targets, expected_soft_targets(second), rtol=1e-3)
+    assert soft_targets.dtype == np.float32
+    assert teacher.cache_hits == 2
+    assert teacher.model.fed_batches[-1]['comments'] == [b'c', b'']
+    np.testing.assert_array_equal(teacher.model.fed_batches[-1]['data'], second['data'][[1, 2]])
+
+    fed = len(teacher.model.fed_batches)
+    teacher(make_batch([b'a', b'c']))
+    assert len(teacher.model.fed_batches) == fed
+    assert teacher.cache_hits == 4
+    teacher.close()
+
+
+def test_cache_size(fake_teacher):
+    teacher = make_teacher(cache_size=2)
+    teacher(make_batch([b'a', b'b', b'c']))
+    assert len(teacher.cache) == 2
+    teacher(make_batch([b'd']))
+    assert len(teacher.cache) == 2
+    teacher.close()
+
+
+def test_cache_requires_no_augmentation(capsys):
+    from aocr.__main__ import process_args
+    from aocr.defaults import Config
+
+    with pytest.raises(SystemExit):
+        process_args(['train', '--teacher-cache', '--teacher-model-dir', 'teacher', 'data'],
+                     Config)
+    assert '--data-augmentation-prob=0' in capsys.readouterr().err
+    parameters = process_args(['train', '--teacher-model-dir', 'teacher', '--teacher-cache',
+                               '--data-augmentation-prob=0', 'data'], Config)
+    assert parameters.teacher_cache == Config.TEACHER_CACHE_SIZE
+    parameters = process_args(['train', '--teacher-cache=16', '--data-augmentation-prob=0',
+                               'data'], Config)
+    assert parameters.teacher_cache == 16
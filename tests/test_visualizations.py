@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+
+from aocr.util.visualizations import VisualizationWriter
+
+
+def sample(rng, pred):
+    image = rng.randint(0, 256, (32, 80, 1)).astype(np.uint8)
+    attentions = rng.rand(1, len(pred), 25).astype(np.float32)
+    return image, attentions
+
+
+def test_writer_renders_the_lowest_probabilities(tmp_path):
+    rng = np.random.RandomState(0)
+    output_dir = str(tmp_path)
+    writer = VisualizationWriter(workers=1, max_pending=2, lowest=2)
+    for pred, probability in (('AB', 0.9), ('CD', 0.2), ('EF', 0.7), ('GH', 0.1), ('IJ', 0.5)):
+        image, attentions = sample(rng, pred)
+        writer.submit(probability, image, output_dir, attentions, pred, 100, 32)
+    # Nothing is rendered before the lowest probabilities are known.
+    assert os.listdir(output_dir) == []
+    writer.close()
+
+    assert writer.errors == 0
+    assert sorted(os.listdir(output_dir)) == ['predict-CD', 'predict-GH']
+    for name in ('predict-CD', 'predict-GH'):
+        assert sorted(os.listdir(os.path.join(output_dir, name))) == ['image.gif', 'word.txt']
+        with open(os.path.join(output_dir, name, 'word.txt')) as word:
+            assert word.read() == name[len('predict-'):] + '\n'
+
+
+def test_writer_renders_every_sample(tmp_path):
+    rng = np.random.RandomState(1)
+    output_dir = str(tmp_path)
+    writer = VisualizationWriter(workers=2, max_pending=1)
+    for _ in range(3):
+        image, attentions = sample(rng, 'AB')
+        writer.submit(0.5, image, output_dir, attentions, 'AB', 100, 32)
+    writer.close()
+
+    assert writer.errors == 0
+    # Identical predictions get their own directories.
+    assert sorted(os.listdir(output_dir)) == ['predict-AB', 'predict-AB-2', 'predict-AB-3']